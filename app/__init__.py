@@ -7,6 +7,16 @@ from .routes import train_data_routes
 from .routes import deploy_model_routes
 from .routes import predict_routes
 from .routes import health_routes
+from .services.job_cache import job_cache
+from .services.audio_features import feature_extractor
+from .services.inference_backends import SageMakerBackend, local_model_cache
+from .services.prediction_cache import prediction_cache
+from .services.micro_batching import micro_batcher
+from .services.hedging import hedger
+from .services.prediction_log import prediction_logger
+from .services.feature_pool import feature_pool
+from .services.zip_ingest import zip_ingester
+from .services.ingest_jobs import ingest_jobs
 from flask_cors import CORS
 
 
@@ -18,6 +28,45 @@ def create_app(config_class='app.config.TestConfig'):
 
     app.config.from_object(config_class)
 
+    job_cache.configure(maxsize=app.config['JOB_CACHE_MAX_SIZE'],
+                        ttl=app.config['JOB_CACHE_TTL_SECONDS'])
+    feature_extractor.configure(sample_rate=app.config['FEATURE_SAMPLE_RATE'] or None,
+                                res_type=app.config['FEATURE_RESAMPLE_TYPE'],
+                                max_duration=app.config['FEATURE_MAX_DURATION_SECONDS'],
+                                trim_top_db=app.config['FEATURE_TRIM_TOP_DB'])
+    SageMakerBackend.configure(content_type=app.config['INFERENCE_CONTENT_TYPE'],
+                               accept=app.config['INFERENCE_ACCEPT'])
+    local_model_cache.configure(version_ttl=app.config['LOCAL_MODEL_VERSION_TTL_SECONDS'])
+    prediction_cache.configure(maxsize=app.config['PREDICTION_CACHE_MAX_SIZE'],
+                               ttl=app.config['PREDICTION_CACHE_TTL_SECONDS'])
+    micro_batcher.configure(max_batch_size=app.config['MICRO_BATCH_MAX_SIZE'],
+                            max_wait_ms=app.config['MICRO_BATCH_MAX_WAIT_MS'],
+                            max_in_flight=app.config['MICRO_BATCH_MAX_IN_FLIGHT'],
+                            idle_seconds=app.config['MICRO_BATCH_IDLE_SECONDS'])
+    hedger.configure(max_ratio=app.config['HEDGE_MAX_RATIO'],
+                     quantile=app.config['HEDGE_QUANTILE'],
+                     min_delay_ms=app.config['HEDGE_MIN_DELAY_MS'],
+                     workers=app.config['HEDGE_WORKERS'])
+    prediction_logger.configure(s3_client=predict_routes.s3_client,
+                                bucket_name=app.config['S3_BUCKET'],
+                                queue_size=app.config['PREDICTION_LOG_QUEUE_SIZE'],
+                                batch_size=app.config['PREDICTION_LOG_BATCH_SIZE'],
+                                flush_seconds=app.config['PREDICTION_LOG_FLUSH_SECONDS'],
+                                prefix=app.config['PREDICTION_LOG_PREFIX'])
+    zip_ingester.configure(workers=app.config['ZIP_INGEST_WORKERS'],
+                           queue_size=app.config['ZIP_INGEST_QUEUE_SIZE'],
+                           max_workers=app.config['ZIP_INGEST_MAX_WORKERS'],
+                           retries=app.config['ZIP_INGEST_RETRIES'],
+                           deduplicate=bool(app.config['ZIP_INGEST_DEDUPLICATE']),
+                           min_sample_rate=app.config['ZIP_INGEST_MIN_SAMPLE_RATE'],
+                           max_sample_rate=app.config['ZIP_INGEST_MAX_SAMPLE_RATE'],
+                           quarantine=bool(app.config['ZIP_INGEST_QUARANTINE']))
+    ingest_jobs.configure(min_members=app.config['ZIP_INGEST_BACKGROUND_MIN_MEMBERS'],
+                          workers=app.config['ZIP_INGEST_JOB_WORKERS'],
+                          keep=app.config['ZIP_INGEST_JOBS_KEPT'])
+    # Started last, the workers fork with the feature settings above
+    feature_pool.configure(workers=app.config['FEATURE_POOL_WORKERS'])
+
     # Enable CORS
     CORS(app, resources={r"/api/*": {"origins": "*"}})
 
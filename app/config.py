@@ -10,6 +10,89 @@ class Config:
     AWS_SECRET_ACCESS_KEY = os.getenv('aws_secret_access_key')
     TRAIN_IMAGE = os.getenv("TRAIN_IMAGE")
     PREPROCESS_IMAGE = os.getenv('PREPROCESS_IMAGE')
+
+    # Process-level cache of the `jobs` records read by the predict routes
+    JOB_CACHE_MAX_SIZE = int(os.getenv('JOB_CACHE_MAX_SIZE', 1024))
+    JOB_CACHE_TTL_SECONDS = float(os.getenv('JOB_CACHE_TTL_SECONDS', 60))
+
+    # Rate the predict uploads are decoded at (0 keeps the native rate) and the resampler used
+    FEATURE_SAMPLE_RATE = int(os.getenv('FEATURE_SAMPLE_RATE', 22050))
+    FEATURE_RESAMPLE_TYPE = os.getenv('FEATURE_RESAMPLE_TYPE', 'soxr_hq')
+
+    # Decode at most this many seconds of a predict upload and drop leading/trailing silence
+    # quieter than FEATURE_TRIM_TOP_DB below the loudest frame, 0 disables either
+    FEATURE_MAX_DURATION_SECONDS = float(os.getenv('FEATURE_MAX_DURATION_SECONDS', 0))
+    FEATURE_TRIM_TOP_DB = float(os.getenv('FEATURE_TRIM_TOP_DB', 0))
+
+    # Payload format for invoke_endpoint, application/json or application/x-npy
+    INFERENCE_CONTENT_TYPE = os.getenv(
+        'INFERENCE_CONTENT_TYPE', 'application/json')
+    INFERENCE_ACCEPT = os.getenv('INFERENCE_ACCEPT', 'application/json')
+
+    # How often the local backend checks a loaded model.tar.gz's ETag for a retrained model
+    LOCAL_MODEL_VERSION_TTL_SECONDS = float(os.getenv('LOCAL_MODEL_VERSION_TTL_SECONDS', 60))
+
+    # Results of byte-identical predict uploads, 0 disables the cache
+    PREDICTION_CACHE_MAX_SIZE = int(os.getenv('PREDICTION_CACHE_MAX_SIZE', 4096))
+    PREDICTION_CACHE_TTL_SECONDS = float(
+        os.getenv('PREDICTION_CACHE_TTL_SECONDS', 3600))
+
+    # Batch concurrent single-clip predictions per endpoint, a wait of 0 disables batching.
+    # Up to MICRO_BATCH_MAX_IN_FLIGHT batches per endpoint are sent at once, an endpoint's
+    # batching thread stops after MICRO_BATCH_IDLE_SECONDS without predictions
+    MICRO_BATCH_MAX_SIZE = int(os.getenv('MICRO_BATCH_MAX_SIZE', 16))
+    MICRO_BATCH_MAX_WAIT_MS = float(os.getenv('MICRO_BATCH_MAX_WAIT_MS', 0))
+    MICRO_BATCH_MAX_IN_FLIGHT = int(os.getenv('MICRO_BATCH_MAX_IN_FLIGHT', 8))
+    MICRO_BATCH_IDLE_SECONDS = float(os.getenv('MICRO_BATCH_IDLE_SECONDS', 60))
+
+    # Worker processes for predict decode and feature extraction, 0 runs it on the request thread
+    FEATURE_POOL_WORKERS = int(os.getenv('FEATURE_POOL_WORKERS', 0))
+
+    # Duplicate invoke_endpoint calls slower than the endpoint's recent latency quantile,
+    # for at most HEDGE_MAX_RATIO of the calls per endpoint, a ratio of 0 disables hedging
+    HEDGE_MAX_RATIO = float(os.getenv('HEDGE_MAX_RATIO', 0))
+    HEDGE_QUANTILE = float(os.getenv('HEDGE_QUANTILE', 0.95))
+    HEDGE_MIN_DELAY_MS = float(os.getenv('HEDGE_MIN_DELAY_MS', 20))
+    # Most duplicate calls in flight at once across all endpoints
+    HEDGE_WORKERS = int(os.getenv('HEDGE_WORKERS', 32))
+
+    # Predictions are written to s3://S3_BUCKET/PREDICTION_LOG_PREFIX/ as gzip NDJSON by a
+    # background thread, a queue size of 0 disables the prediction log
+    PREDICTION_LOG_QUEUE_SIZE = int(os.getenv('PREDICTION_LOG_QUEUE_SIZE', 10000))
+    PREDICTION_LOG_BATCH_SIZE = int(os.getenv('PREDICTION_LOG_BATCH_SIZE', 1000))
+    PREDICTION_LOG_FLUSH_SECONDS = float(os.getenv('PREDICTION_LOG_FLUSH_SECONDS', 60))
+    PREDICTION_LOG_PREFIX = os.getenv('PREDICTION_LOG_PREFIX', 'prediction_logs')
+
+    # Upload workers for sounds.zip members and how many extracted members may wait for them.
+    # Concurrency starts at ZIP_INGEST_WORKERS and ramps up to ZIP_INGEST_MAX_WORKERS while
+    # objects/s keeps rising, halving on S3 throttling, a maximum of 0 keeps it fixed. The limit
+    # is shared: concurrent ingests never have more uploads in flight than one ingest could
+    ZIP_INGEST_WORKERS = int(os.getenv('ZIP_INGEST_WORKERS', 5))
+    ZIP_INGEST_MAX_WORKERS = int(os.getenv('ZIP_INGEST_MAX_WORKERS', 32))
+    ZIP_INGEST_QUEUE_SIZE = int(os.getenv('ZIP_INGEST_QUEUE_SIZE', 16))
+    ZIP_INGEST_RETRIES = int(os.getenv('ZIP_INGEST_RETRIES', 3))
+
+    # Skip sounds.zip members whose content the class already has, by sha256 kept in
+    # zip_data_index/<class_name>/hashes.json, 0 uploads every member (still indexing them)
+    ZIP_INGEST_DEDUPLICATE = int(os.getenv('ZIP_INGEST_DEDUPLICATE', 1))
+
+    # sounds.zip members must be readable WAV files with frames and a sample rate within these
+    # bounds (0 for no bound). Rejected members go to zip_quarantine/<class_name>/, a
+    # ZIP_INGEST_QUARANTINE of 0 only reports them
+    ZIP_INGEST_MIN_SAMPLE_RATE = int(os.getenv('ZIP_INGEST_MIN_SAMPLE_RATE', 8000))
+    ZIP_INGEST_MAX_SAMPLE_RATE = int(os.getenv('ZIP_INGEST_MAX_SAMPLE_RATE', 192000))
+    ZIP_INGEST_QUARANTINE = int(os.getenv('ZIP_INGEST_QUARANTINE', 1))
+
+    # Archives with at least this many members are ingested by a background job the client
+    # polls, 0 ingests every archive within the request
+    ZIP_INGEST_BACKGROUND_MIN_MEMBERS = int(os.getenv('ZIP_INGEST_BACKGROUND_MIN_MEMBERS', 500))
+    ZIP_INGEST_JOB_WORKERS = int(os.getenv('ZIP_INGEST_JOB_WORKERS', 2))
+    ZIP_INGEST_JOBS_KEPT = int(os.getenv('ZIP_INGEST_JOBS_KEPT', 100))
+
+    # Direct uploads: sounds.zip goes to presigned multipart URLs of this part size, valid for
+    # ZIP_UPLOAD_URL_EXPIRES_SECONDS, and is extracted from the staged object on finalize
+    ZIP_UPLOAD_PART_SIZE_MB = int(os.getenv('ZIP_UPLOAD_PART_SIZE_MB', 64))
+    ZIP_UPLOAD_URL_EXPIRES_SECONDS = int(os.getenv('ZIP_UPLOAD_URL_EXPIRES_SECONDS', 3600))
 # TESTING = False
 
 
@@ -1,14 +1,17 @@
 from flask import Blueprint, request, jsonify, current_app
+from flask_sock import Sock
 from ..services.predict_services import PredictService
 import boto3
 
 
 bp = Blueprint('predict_routes', __name__)
+sock = Sock()
 
 
 s3_client = boto3.client('s3')
 sagemaker_client = boto3.client('sagemaker')
 dynamodb_client = boto3.client('dynamodb')
+runtime_client = boto3.client('runtime.sagemaker')
 
 
 @bp.before_request
@@ -17,7 +20,7 @@ def before_request():
     bucket_name = current_app.config['S3_BUCKET']
     role_arn = current_app.config['SAGEMAKER_ROLE_ARN']
     predict_service = PredictService(
-        s3_client, sagemaker_client, dynamodb_client, bucket_name, role_arn)
+        s3_client, sagemaker_client, dynamodb_client, bucket_name, role_arn, runtime_client)
 
 
 @bp.route('/predict', methods=['POST'])
@@ -50,11 +53,51 @@ def get_approved_jobs():
     return predict_service.get_approved_jobs(request)
 
 
+@bp.route('/set-inference-backend', methods=['POST'])
+def set_inference_backend():
+    return predict_service.set_inference_backend(request)
+
+
+@bp.route('/cache-stats', methods=['GET'])
+def get_cache_stats():
+    return predict_service.get_cache_stats()
+
+
+@bp.route('/metrics', methods=['GET'])
+def get_metrics():
+    return predict_service.get_metrics()
+
+
 @bp.route('/predict-with-display-names', methods=['POST'])
 def predict_with_display_names():
     return predict_service.predict_with_display_names(request)
 
 
+@bp.route('/predict-batch', methods=['POST'])
+def predict_batch():
+    return predict_service.predict_batch(request)
+
+
+@bp.route('/predict-features', methods=['POST'])
+def predict_features():
+    return predict_service.predict_features(request)
+
+
+@bp.route('/predict-ensemble', methods=['POST'])
+def predict_ensemble():
+    return predict_service.predict_ensemble(request)
+
+
+@bp.route('/predict-windows', methods=['POST'])
+def predict_windows():
+    return predict_service.predict_windows(request)
+
+
 @bp.route('/predict-test', methods=['POST'])
 def predict_with_display_names_test():
     return predict_service.predict_with_display_names_test(request)
+
+
+@sock.route('/stream', bp=bp)
+def stream_predict(ws):
+    return predict_service.stream_predict(ws, request)
@@ -1,11 +1,17 @@
 from flask import Blueprint, request, jsonify, current_app
 import boto3
 from ..services.zip_data_services import DataService
+from ..config import Config
 from botocore.config import Config as BotoConfig
 
 bp = Blueprint('zip_data_routes', __name__)
-# Setup S3 client with Transfer Acceleration
-s3_config = BotoConfig(s3={'use_accelerate_endpoint': True})
+# Setup S3 client with Transfer Acceleration. botocore keeps 10 connections per client by
+# default, the zip ingests (in requests and background jobs alike) share one connection per
+# ingest worker on top of that for the other routes.
+s3_config = BotoConfig(
+    s3={'use_accelerate_endpoint': True},
+    max_pool_connections=10 + max(Config.ZIP_INGEST_WORKERS, Config.ZIP_INGEST_MAX_WORKERS),
+    retries={'mode': 'standard', 'max_attempts': 3})
 s3_client = boto3.client('s3', config=s3_config)
 
 
@@ -14,7 +20,10 @@ s3_client = boto3.client('s3', config=s3_config)
 def before_request():
     global data_service
     bucket_name = current_app.config['S3_BUCKET']
-    data_service = DataService(s3_client, bucket_name)
+    data_service = DataService(
+        s3_client, bucket_name,
+        part_size=current_app.config['ZIP_UPLOAD_PART_SIZE_MB'] * 1024 * 1024,
+        url_expires=current_app.config['ZIP_UPLOAD_URL_EXPIRES_SECONDS'])
 
 
 # @bp.route('/get-all-s3')
@@ -32,6 +41,36 @@ def upload_zip_fast():
     return data_service.upload_zip_fast(request)
 
 
+@bp.route('/ingest-jobs', methods=['GET'])
+def list_ingest_jobs():
+    return data_service.list_ingest_jobs()
+
+
+@bp.route('/ingest-jobs/<job_id>', methods=['GET'])
+def get_ingest_job(job_id):
+    return data_service.get_ingest_job(job_id)
+
+
+@bp.route('/direct-upload/start', methods=['POST'])
+def start_direct_upload():
+    return data_service.start_direct_upload(request)
+
+
+@bp.route('/direct-upload/parts', methods=['POST'])
+def get_direct_upload_parts():
+    return data_service.get_direct_upload_parts(request)
+
+
+@bp.route('/direct-upload/finalize', methods=['POST'])
+def finalize_direct_upload():
+    return data_service.finalize_direct_upload(request)
+
+
+@bp.route('/direct-upload/abort', methods=['DELETE'])
+def abort_direct_upload():
+    return data_service.abort_direct_upload(request)
+
+
 @bp.route('/class-count', methods=['POST'])
 def get_class_count():
     return data_service.get_class_count(request)
@@ -0,0 +1,98 @@
+import io
+import numpy as np
+import soundfile as sf
+
+# libsndfile format of the containers it decodes from memory. Opus is left to libavcodec,
+# which decodes it about twice as fast (benchmarks/audio_decode_benchmark.py).
+SOUNDFILE_FORMATS = {'wav': 'WAV', 'flac': 'FLAC', 'aiff': 'AIFF', 'ogg': 'OGG', 'mp3': 'MP3'}
+
+
+def detect_container(data):
+    # Container of an upload from its first bytes, None if not recognised
+    head = data[:12]
+    if head[:4] == b'RIFF' and head[8:12] == b'WAVE':
+        return 'wav'
+    if head[:4] == b'fLaC':
+        return 'flac'
+    if head[:4] == b'OggS':
+        # the first page of an Ogg Opus stream carries the OpusHead packet
+        return 'opus' if data[28:36] == b'OpusHead' else 'ogg'
+    if head[:4] == b'FORM' and head[8:12] in (b'AIFF', b'AIFC'):
+        return 'aiff'
+    if head[4:8] == b'ftyp':
+        return 'mp4'
+    if head[:3] == b'ID3':
+        return 'mp3'
+    if len(head) > 1 and head[0] == 0xFF:
+        # ADTS AAC and MPEG audio share the frame sync, the layer bits tell them apart
+        if head[1] & 0xF6 == 0xF0:
+            return 'aac'
+        if head[1] & 0xE0 == 0xE0:
+            return 'mp3'
+    return None
+
+
+def soundfile_decodes(container):
+    return SOUNDFILE_FORMATS.get(container) in sf.available_formats()
+
+
+def read_with_soundfile(data, max_duration=0):
+    with sf.SoundFile(io.BytesIO(data)) as f:
+        native_sr = f.samplerate
+        frames = int(max_duration * native_sr) if max_duration else -1
+        audio = f.read(frames, dtype='float32', always_2d=True).mean(axis=1)
+        return audio, native_sr, max(f.frames, len(audio))
+
+
+def read_with_av(data, max_duration=0):
+    # libavcodec in-process through PyAV, reading the upload bytes from memory. The input is
+    # seekable, so MP4/M4A files with the moov atom at the end decode too.
+    try:
+        import av
+    except ImportError:
+        raise RuntimeError('av is required to decode compressed audio uploads')
+
+    with av.open(io.BytesIO(data)) as container:
+        if not container.streams.audio:
+            raise ValueError('The upload has no audio stream')
+        stream = container.streams.audio[0]
+        native_sr = stream.codec_context.sample_rate
+        limit = int(max_duration * native_sr) if max_duration else None
+        # planar float at the native rate, channels are averaged below like the soundfile path
+        resampler = av.AudioResampler(format='fltp', rate=native_sr)
+
+        chunks = []
+        decoded = 0
+        for frame in container.decode(stream):
+            for out in resampler.resample(frame):
+                chunk = out.to_ndarray().mean(axis=0)
+                chunks.append(chunk)
+                decoded += len(chunk)
+            if limit and decoded >= limit:
+                break
+        else:
+            for out in resampler.resample(None):
+                chunks.append(out.to_ndarray().mean(axis=0))
+
+        total = int(container.duration * native_sr / av.time_base) if container.duration else 0
+
+    audio = np.concatenate(chunks).astype(np.float32, copy=False) if chunks else np.empty(0, dtype=np.float32)
+    if limit:
+        audio = audio[:limit]
+    return audio, native_sr, max(total, len(audio))
+
+
+def read_audio(data, max_duration=0):
+    # Decodes an upload in memory to (mono float32 audio at its native rate, native rate,
+    # total frames in the file). WAV/FLAC/AIFF and, with libsndfile >= 1.1, OGG Vorbis and MP3
+    # go through libsndfile, Opus, MP4/M4A/AAC and anything libsndfile cannot open through
+    # libavcodec.
+    container = detect_container(data)
+    if container is not None and not soundfile_decodes(container):
+        return read_with_av(data, max_duration)
+    try:
+        return read_with_soundfile(data, max_duration)
+    except sf.LibsndfileError:
+        if container is not None:
+            raise
+        return read_with_av(data, max_duration)
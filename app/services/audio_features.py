@@ -0,0 +1,260 @@
+import itertools
+import threading
+import time
+import numpy as np
+import librosa
+import scipy.fft
+import soundfile as sf
+import soxr
+from .audio_decoding import read_audio, detect_container, soundfile_decodes
+
+# librosa.load() resamples to 22050 Hz by default, the models were trained on that rate
+TARGET_SAMPLE_RATE = 22050
+
+
+def read_upload(file_storage):
+    # Read the uploaded file straight from the request buffer
+    file_storage.stream.seek(0)
+    return file_storage.stream.read()
+
+
+def soundfile_blocks(f, block_frames):
+    # Mono float32 blocks of an open SoundFile, closed once it is read
+    with f:
+        while True:
+            block = f.read(block_frames, dtype='float32', always_2d=True)
+            if len(block):
+                yield block.mean(axis=1)
+            if len(block) < block_frames:
+                return
+
+
+def audio_blocks(stream, block_seconds):
+    # (native rate, mono float32 blocks) of an upload. libsndfile streams it block by block,
+    # containers it cannot read are decoded whole through read_audio like the other routes.
+    container = detect_container(stream.read(36))
+    stream.seek(0)
+    if container is None or soundfile_decodes(container):
+        try:
+            f = sf.SoundFile(stream)
+        except sf.LibsndfileError:
+            if container is not None:
+                raise
+            stream.seek(0)
+        else:
+            return f.samplerate, soundfile_blocks(f, int(block_seconds * f.samplerate))
+    audio, native_sr, _ = read_audio(stream.read())
+    return native_sr, iter([audio])
+
+
+def load_audio(data, sr=TARGET_SAMPLE_RATE, res_type='soxr_hq'):
+    # Decode the bytes in memory into a mono float32 signal, sr=None keeps the native rate
+    audio, native_sr, _ = read_audio(data)
+
+    if sr is not None and native_sr != sr:
+        audio = librosa.resample(
+            audio, orig_sr=native_sr, target_sr=sr, res_type=res_type)
+        native_sr = sr
+
+    return audio, native_sr
+
+
+def energy_trim_bounds(audio, top_db=60, frame_length=2048):
+    # Sample bounds without the leading and trailing frames more than top_db below the
+    # loudest frame, the same gate as librosa.effects.trim but on non-overlapping frames
+    n_frames = len(audio) // frame_length
+    full = audio[:n_frames * frame_length].reshape(n_frames, frame_length)
+    power = np.einsum('ij,ij->i', full, full) / frame_length
+    tail = audio[n_frames * frame_length:]
+    if len(tail):
+        power = np.append(power, np.dot(tail, tail) / len(tail))
+
+    peak = power.max() if len(power) else 0
+    if peak <= 0:
+        return 0, len(audio)
+    loud = np.flatnonzero(power > peak * 10 ** (-top_db / 10))
+    return loud[0] * frame_length, min(len(audio), (loud[-1] + 1) * frame_length)
+
+
+def soxr_quality(res_type):
+    # 'soxr_hq' -> 'HQ', anything else falls back to the librosa default
+    if res_type and res_type.startswith('soxr_'):
+        return res_type[len('soxr_'):].upper()
+    return 'HQ'
+
+
+class MelFeatureExtractor:
+    # Computes the same time-averaged mel vector as
+    # np.mean(librosa.feature.melspectrogram(y=audio, sr=sr).T, axis=0)
+    # without rebuilding the window and mel filterbank on every call.
+    # The mel projection is linear, so the power spectra are averaged over time first
+    # and projected once instead of projecting every frame.
+    def __init__(self, n_fft=2048, hop_length=512, n_mels=128, block_frames=256,
+                 sample_rate=TARGET_SAMPLE_RATE, res_type='soxr_hq', max_duration=0, trim_top_db=0):
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        self.n_mels = n_mels
+        self.block_frames = block_frames
+        self.sample_rate = sample_rate
+        self.res_type = res_type
+        self.max_duration = max_duration
+        self.trim_top_db = trim_top_db
+        self._windows = {}
+        self._mel_bases = {}
+        self._lock = threading.Lock()
+        self._buffers = threading.local()
+
+    def configure(self, sample_rate=TARGET_SAMPLE_RATE, res_type='soxr_hq', max_duration=0, trim_top_db=0):
+        # sample_rate=None decodes at the native rate of every upload.
+        # max_duration > 0 decodes only the start of longer uploads, trim_top_db > 0 drops
+        # leading and trailing silence quieter than that many dB below the loudest frame.
+        self.sample_rate = sample_rate
+        self.res_type = res_type
+        self.max_duration = max_duration
+        self.trim_top_db = trim_top_db
+
+    def window(self, n_fft):
+        window = self._windows.get(n_fft)
+        if window is None:
+            with self._lock:
+                window = self._windows.setdefault(n_fft, librosa.filters.get_window(
+                    'hann', n_fft, fftbins=True).astype(np.float32))
+        return window
+
+    def mel_basis(self, sr, n_fft, n_mels):
+        key = (sr, n_fft, n_mels)
+        basis = self._mel_bases.get(key)
+        if basis is None:
+            with self._lock:
+                basis = self._mel_bases.setdefault(
+                    key, librosa.filters.mel(sr=sr, n_fft=n_fft, n_mels=n_mels))
+        return basis
+
+    def _frame_buffer(self):
+        # One preallocated windowed-frame buffer per thread
+        buffer = getattr(self._buffers, 'frames', None)
+        if buffer is None or buffer.shape != (self.block_frames, self.n_fft):
+            buffer = np.empty((self.block_frames, self.n_fft), dtype=np.float32)
+            self._buffers.frames = buffer
+        return buffer
+
+    def power_spectrum_sum(self, audio):
+        # Sum of the STFT power spectra over all frames (center=True, zero padding)
+        padded = np.pad(audio.astype(np.float32, copy=False), self.n_fft // 2)
+        n_frames = 1 + (len(padded) - self.n_fft) // self.hop_length
+        frames = np.lib.stride_tricks.sliding_window_view(
+            padded, self.n_fft)[::self.hop_length][:n_frames]
+
+        window = self.window(self.n_fft)
+        buffer = self._frame_buffer()
+        total = np.zeros(self.n_fft // 2 + 1, dtype=np.float64)
+
+        for start in range(0, n_frames, self.block_frames):
+            block = frames[start:start + self.block_frames]
+            windowed = buffer[:len(block)]
+            np.multiply(block, window, out=windowed)
+            spectrum = scipy.fft.rfft(windowed, axis=1)
+            total += (spectrum.real ** 2 + spectrum.imag ** 2).sum(axis=0)
+
+        return total, n_frames
+
+    def extract(self, audio, sr):
+        total, n_frames = self.power_spectrum_sum(audio)
+        mean_power = (total / n_frames).astype(np.float32)
+        return self.mel_basis(sr, self.n_fft, self.n_mels) @ mean_power
+
+    def decode(self, data, info=None):
+        if not self.max_duration and not self.trim_top_db:
+            return load_audio(data, sr=self.sample_rate, res_type=self.res_type)
+
+        audio, native_sr, total = read_audio(data, self.max_duration)
+        decoded = len(audio)
+        if self.trim_top_db:
+            start, end = energy_trim_bounds(audio, self.trim_top_db)
+            audio = audio[start:end]
+
+        if info is not None:
+            info['duration_seconds'] = round(max(total, decoded) / native_sr, 3)
+            info['decoded_seconds'] = round(decoded / native_sr, 3)
+            info['kept_seconds'] = round(len(audio) / native_sr, 3)
+
+        sr = self.sample_rate or native_sr
+        if sr != native_sr:
+            audio = librosa.resample(audio, orig_sr=native_sr, target_sr=sr, res_type=self.res_type)
+        return audio, sr
+
+    def extract_from_bytes(self, data, timings=None, info=None):
+        # timings, when given, receives the decode and feature stage durations in seconds.
+        # info receives the decoded and kept durations when trimming or a decode budget is on,
+        # with an estimate of the decode and feature time saved on the dropped audio.
+        start = time.perf_counter()
+        audio_info = {}
+        audio, sr = self.decode(data, audio_info)
+        decoded = time.perf_counter()
+        features = self.extract(audio, sr)
+        finished = time.perf_counter()
+
+        if timings is not None:
+            timings['decode'] = decoded - start
+            timings['features'] = finished - decoded
+        if info is not None and audio_info:
+            # the work is linear in the samples, scale it to the samples that were skipped
+            kept = max(audio_info['kept_seconds'], 1e-3)
+            skipped = audio_info['duration_seconds'] - audio_info['kept_seconds']
+            audio_info['estimated_saved_ms'] = round((finished - start) * 1000 * skipped / kept, 3)
+            info['audio'] = audio_info
+        return features
+
+    def iter_window_features(self, stream, window_seconds, hop_seconds, block_seconds=10):
+        # Streams a long recording block by block and yields (start, end, features) per window.
+        # Only about one window plus one block of audio is held in memory at a time, except for
+        # containers libsndfile cannot read, which are decoded whole.
+        native_sr, blocks = audio_blocks(stream, block_seconds)
+        sr = self.sample_rate or native_sr
+        resampler = None
+        if sr != native_sr:
+            resampler = soxr.ResampleStream(
+                native_sr, sr, 1, dtype='float32', quality=soxr_quality(self.res_type))
+
+        window = max(1, int(round(window_seconds * sr)))
+        hop = max(1, int(round(hop_seconds * sr)))
+
+        buffer = np.empty(0, dtype=np.float32)
+        offset = 0  # sample index of buffer[0]
+        emitted = False
+
+        for audio in itertools.chain(blocks, [None]):
+            if resampler is not None:
+                # an empty last chunk flushes the resampler
+                audio = resampler.resample_chunk(
+                    np.empty(0, dtype=np.float32) if audio is None else audio, last=audio is None)
+            elif audio is None:
+                break
+            buffer = np.concatenate([buffer, audio.astype(np.float32, copy=False)])
+
+            while len(buffer) >= window:
+                yield offset / sr, (offset + window) / sr, self.extract(buffer[:window], sr)
+                emitted = True
+                buffer = buffer[hop:]
+                offset += hop
+
+        # Recordings shorter than one window, or a tail not covered by the last full window
+        if len(buffer) and (not emitted or len(buffer) > window - hop):
+            yield offset / sr, (offset + len(buffer)) / sr, self.extract(buffer, sr)
+
+
+feature_extractor = MelFeatureExtractor()
+
+
+def extract_features(audio, sr):
+    # Time-averaged 128-bin mel spectrogram
+    return feature_extractor.extract(audio, sr)
+
+
+def audio_to_features(data):
+    # Decode an uploaded clip and return its 128-bin feature vector
+    return feature_extractor.extract_from_bytes(data)
+
+
+def iter_window_features(stream, window_seconds, hop_seconds):
+    return feature_extractor.iter_window_features(stream, window_seconds, hop_seconds)
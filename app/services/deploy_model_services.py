@@ -3,6 +3,7 @@ from flask import current_app, request, jsonify
 import time
 from botocore.exceptions import ClientError
 from sagemaker.tensorflow import TensorFlowModel
+from .job_cache import invalidate_job
 
 instances = [
     "ml.r5d.large", "ml.r5d.xlarge", "ml.r5d.2xlarge", "ml.r5d.4xlarge", "ml.r5d.8xlarge", "ml.r5d.12xlarge", "ml.r5d.16xlarge", "ml.r5d.24xlarge",
@@ -185,6 +186,7 @@ class DeployingService:
                         ':endpoint_name': {'S': predictor.endpoint_name}
                     }
                 )
+                invalidate_job(job_id)
                 if response['ResponseMetadata']['HTTPStatusCode'] == 200:
                     return jsonify({'status': 'success', 'EndpointName': predictor.endpoint_name}), 200
                 else:
@@ -343,6 +345,7 @@ class DeployingService:
                 Key={'job_id': {'S': job_id}},
                 UpdateExpression='REMOVE deploy_instance_type, deploy_instance_count, deploy_date, endpoint_name'
             )
+            invalidate_job(job_id)
 
             if response['ResponseMetadata']['HTTPStatusCode'] == 200:
                 return jsonify({'status': 'success', 'message': 'Deployment details deleted successfully'}), 200
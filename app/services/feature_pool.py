@@ -0,0 +1,164 @@
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory, resource_tracker
+from threading import Lock
+import numpy as np
+from .audio_features import feature_extractor, TARGET_SAMPLE_RATE
+from .metrics import metrics
+
+
+class DecodeError(Exception):
+    # Raised by extract_many() with the position of the upload that could not be decoded
+    def __init__(self, index, error):
+        super().__init__(str(error))
+        self.index = index
+
+
+def _attach(name):
+    shm = shared_memory.SharedMemory(name=name)
+    # The parent owns the segment and unlinks it. Python < 3.13 also registers attached
+    # segments with the resource tracker, which would then warn about (or unlink) it again.
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+
+def _extract_from_shared_memory(name, size):
+    shm = _attach(name)
+    try:
+        timings, info = {}, {}
+        features = feature_extractor.extract_from_bytes(bytes(shm.buf[:size]), timings, info)
+        return features, timings, info
+    finally:
+        shm.close()
+
+
+def _configure_worker(settings):
+    # Workers spawned to replace a broken pool start from a fresh interpreter
+    feature_extractor.configure(**settings)
+
+
+def _warm_up_worker():
+    # Keep the worker busy for a moment so the executor starts every process
+    time.sleep(0.1)
+    return multiprocessing.current_process().pid
+
+
+class FeaturePool:
+    # Decodes uploads and extracts their features in worker processes so the CPU-heavy part
+    # of predict does not serialize on the GIL. Upload bytes reach the workers through shared
+    # memory instead of being pickled through the executor's pipe.
+    # A worker that dies (e.g. killed for memory) breaks the whole executor, it is replaced
+    # and the request retried once.
+    def __init__(self):
+        self.workers = 0
+        self.rebuilds = 0
+        self._executor = None
+        self._lock = Lock()
+
+    def configure(self, workers=0):
+        self.shutdown()
+        self.workers = workers
+        if workers <= 0:
+            return
+
+        # Build the window and mel basis before forking so every worker inherits them.
+        # Workers are forked at startup, before any request threads exist.
+        feature_extractor.extract(np.zeros(4096, dtype=np.float32),
+                                  feature_extractor.sample_rate or TARGET_SAMPLE_RATE)
+        self._executor = ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context('fork'))
+        for future in [self._executor.submit(_warm_up_worker) for _ in range(workers)]:
+            future.result()
+
+    @property
+    def enabled(self):
+        return self._executor is not None
+
+    def extract(self, data, timer=None):
+        features, timings, info = self._extract_many([data])[0]
+        if timer is not None:
+            for stage, seconds in timings.items():
+                timer.record(stage, seconds)
+            timer.info.update(info)
+        if 'audio' in info:
+            metrics.increment('feature_estimated_saved_ms', info['audio']['estimated_saved_ms'])
+        return features
+
+    def extract_many(self, datas):
+        # Returns one 128-bin feature vector per upload, in order
+        return [features for features, _, _ in self._extract_many(datas)]
+
+    def _rebuild(self, broken):
+        # Request threads exist by now, so the new workers are spawned rather than forked and
+        # are handed the feature settings
+        with self._lock:
+            if self._executor is not broken:
+                # replaced by another request already
+                return
+            broken.shutdown(wait=False)
+            settings = {'sample_rate': feature_extractor.sample_rate, 'res_type': feature_extractor.res_type,
+                        'max_duration': feature_extractor.max_duration, 'trim_top_db': feature_extractor.trim_top_db}
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'),
+                initializer=_configure_worker, initargs=(settings,))
+            self.rebuilds += 1
+        metrics.increment('feature_pool_rebuilds')
+        print(f'Feature pool: a worker died, started {self.workers} new workers')
+
+    def _extract_many(self, datas):
+        # (features, stage timings, audio info) per upload
+        executor = self._executor
+        if executor is None:
+            results = []
+            for index, data in enumerate(datas):
+                try:
+                    timings, info = {}, {}
+                    features = feature_extractor.extract_from_bytes(data, timings, info)
+                    results.append((features, timings, info))
+                except Exception as e:
+                    raise DecodeError(index, e) from e
+            return results
+
+        for attempt in range(2):
+            try:
+                return self._extract_in_pool(executor, datas)
+            except BrokenProcessPool:
+                self._rebuild(executor)
+                if attempt:
+                    # the upload brought down a fresh worker as well
+                    raise
+                executor = self._executor
+
+    def _extract_in_pool(self, executor, datas):
+        segments = []
+        try:
+            futures = []
+            for data in datas:
+                shm = shared_memory.SharedMemory(create=True, size=max(1, len(data)))
+                segments.append(shm)
+                shm.buf[:len(data)] = data
+                futures.append(executor.submit(
+                    _extract_from_shared_memory, shm.name, len(data)))
+            results = []
+            for index, future in enumerate(futures):
+                try:
+                    results.append(future.result())
+                except BrokenProcessPool:
+                    raise
+                except Exception as e:
+                    raise DecodeError(index, e) from e
+            return results
+        finally:
+            for shm in segments:
+                shm.close()
+                shm.unlink()
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+feature_pool = FeaturePool()
@@ -0,0 +1,154 @@
+import json
+from contextlib import contextmanager, nullcontext
+from threading import Condition, Lock
+from botocore.exceptions import ClientError
+
+# Per-class content index, outside zip_data/ so class listings and counts do not see it
+INDEX_PREFIX = 'zip_data_index'
+
+_class_locks = {}
+_class_locks_lock = Lock()
+
+
+def index_key(class_name):
+    return f'{INDEX_PREFIX}/{class_name}/hashes.json'
+
+
+def class_lock(class_name):
+    # Serialises ingests and deletes of one class so their index updates do not overwrite
+    # each other. In-process, like the ingest jobs.
+    with _class_locks_lock:
+        lock = _class_locks.get(class_name)
+        if lock is None:
+            lock = _class_locks[class_name] = Lock()
+        return lock
+
+
+class ClassBusyError(Exception):
+    pass
+
+
+@contextmanager
+def class_lock_or_busy(class_name):
+    # For requests that change a class's objects. Its lock is held for a whole ingest, which
+    # may be a background job running for minutes, so they fail fast instead of waiting.
+    lock = class_lock(class_name)
+    if not lock.acquire(blocking=False):
+        raise ClassBusyError(f'Class {class_name} is being ingested, try again once the ingest has finished')
+    try:
+        yield
+    finally:
+        lock.release()
+
+
+def delete_class_index(s3_client, bucket_name, class_name):
+    s3_client.delete_object(Bucket=bucket_name, Key=index_key(class_name))
+
+
+class ClassHashIndex:
+    # sha256 of every object ingested into zip_data/<class_name>/ -> its key, stored as
+    # zip_data_index/<class_name>/hashes.json. Upload workers claim a digest before uploading a
+    # member, so a second copy, in S3 already or earlier in the same archive, is skipped.
+    # A copy claimed by an upload still in flight waits for it to be committed or released.
+    def __init__(self, s3_client, bucket_name, class_name, hashes=None):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.class_name = class_name
+        self.hashes = dict(hashes or {})
+        self.keys = {key: digest for digest, key in self.hashes.items()}
+        self._pending = set()
+        self._lock = Condition()
+        self.dirty = False
+
+    @classmethod
+    def load(cls, s3_client, bucket_name, class_name):
+        try:
+            response = s3_client.get_object(Bucket=bucket_name, Key=index_key(class_name))
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return cls(s3_client, bucket_name, class_name)
+            raise
+        return cls(s3_client, bucket_name, class_name, json.loads(response['Body'].read())['hashes'])
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def claim(self, digest, connections=None):
+        # False when the content is stored already. An indexed object that is gone, deleted by
+        # something that did not update the index, no longer counts. connections is held for
+        # the HEAD request only, never while waiting for another upload.
+        with self._lock:
+            self._lock.wait_for(lambda: digest not in self._pending)
+            key = self.hashes.get(digest)
+            if key is None:
+                self._pending.add(digest)
+                return True
+        if self._exists(key, connections):
+            return False
+        with self._lock:
+            if self.hashes.get(digest) == key:
+                del self.hashes[digest]
+                self.keys.pop(key, None)
+                self.dirty = True
+            self._lock.wait_for(lambda: digest not in self._pending)
+            if digest in self.hashes:
+                return False
+            self._pending.add(digest)
+            return True
+
+    def _exists(self, key, connections=None):
+        try:
+            with connections or nullcontext():
+                self.s3_client.head_object(Bucket=self.bucket_name, Key=key)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', 'NotFound', '404'):
+                return False
+            raise
+        return True
+
+    def release(self, digest):
+        with self._lock:
+            self._pending.discard(digest)
+            self._lock.notify_all()
+
+    def commit(self, digest, key):
+        with self._lock:
+            self._pending.discard(digest)
+            self._lock.notify_all()
+            # a member with the name of an existing object replaced that object's content
+            replaced = self.keys.pop(key, None)
+            if replaced is not None:
+                self.hashes.pop(replaced, None)
+            # without deduplication the same content may be stored under several keys, the
+            # index keeps the latest
+            previous = self.hashes.get(digest)
+            if previous is not None and previous != key:
+                self.keys.pop(previous, None)
+            self.hashes[digest] = key
+            self.keys[key] = digest
+            self.dirty = True
+
+    def move(self, key, new_key):
+        with self._lock:
+            digest = self.keys.pop(key, None)
+            if digest is not None:
+                self.hashes[digest] = new_key
+                self.keys[new_key] = digest
+                self.dirty = True
+
+    def remove_keys(self, keys):
+        with self._lock:
+            for key in keys:
+                digest = self.keys.pop(key, None)
+                if digest is not None:
+                    self.hashes.pop(digest, None)
+                    self.dirty = True
+
+    def save(self):
+        with self._lock:
+            if not self.dirty:
+                return
+            body = json.dumps({'version': 1, 'hashes': self.hashes}, separators=(',', ':'))
+            self.dirty = False
+        self.s3_client.put_object(Bucket=self.bucket_name, Key=index_key(self.class_name),
+                                  Body=body.encode(), ContentType='application/json')
@@ -0,0 +1,173 @@
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from threading import Lock, Thread
+import numpy as np
+
+# Hedges an endpoint can save up while it is fast, spent when it stalls
+HEDGE_BURST = 10
+
+
+class EndpointHedgeState:
+    def __init__(self, window):
+        self.latencies = deque(maxlen=window)
+        self.tokens = 0.0
+        self.calls = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.skipped = 0
+        self.skipped_busy = 0
+
+
+class Hedger:
+    # Sends a duplicate invoke_endpoint when the first one is slower than the endpoint's recent
+    # latency quantile, and returns whichever answer arrives first. A boto3 call cannot be
+    # cancelled, the losing call finishes in the background and its result is dropped.
+    # Each call earns max_ratio of a hedge per endpoint, which caps the extra load.
+    # The first call runs on its own thread, so hedging never limits how many calls are in
+    # flight. Only the duplicates go to a pool of workers threads, a hedge that would have to
+    # wait for a free worker is skipped.
+    def __init__(self, max_ratio=0.0, quantile=0.95, min_delay_ms=20, min_samples=20,
+                 window=200, workers=32):
+        self.max_ratio = max_ratio
+        self.quantile = quantile
+        self.min_delay_ms = min_delay_ms
+        self.min_samples = min_samples
+        self.window = window
+        self.workers = workers
+        self._endpoints = {}
+        self._lock = Lock()
+        self._executor = None
+        self._hedges_in_flight = 0
+
+    def configure(self, max_ratio=0.0, quantile=0.95, min_delay_ms=20, workers=32):
+        self.max_ratio = max_ratio
+        self.quantile = quantile
+        self.min_delay_ms = min_delay_ms
+        with self._lock:
+            if self._executor is not None and workers != self.workers:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+            self.workers = workers
+
+    @property
+    def enabled(self):
+        return self.max_ratio > 0
+
+    def _state(self, key):
+        with self._lock:
+            state = self._endpoints.get(key)
+            if state is None:
+                state = self._endpoints[key] = EndpointHedgeState(self.window)
+            return state
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix='hedged-invoke')
+            return self._executor
+
+    def delay(self, key):
+        # Seconds to wait for the first call, None until enough latencies are known
+        state = self._state(key)
+        with self._lock:
+            if len(state.latencies) < self.min_samples:
+                return None
+            latencies = np.array(state.latencies)
+        return max(self.min_delay_ms / 1000, float(np.quantile(latencies, self.quantile)))
+
+    def _run(self, state, call, future, submitted):
+        # Latency counts from when the call was submitted, including any wait for a thread
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            result = call()
+        except BaseException as e:
+            future.set_exception(e)
+            return
+        with self._lock:
+            state.latencies.append(time.perf_counter() - submitted)
+        future.set_result(result)
+
+    def _hedge_done(self, _):
+        with self._lock:
+            self._hedges_in_flight -= 1
+
+    def call(self, key, call):
+        if not self.enabled:
+            return call()
+
+        state = self._state(key)
+        delay = self.delay(key)
+        with self._lock:
+            state.calls += 1
+            state.tokens = min(HEDGE_BURST, state.tokens + self.max_ratio)
+
+        submitted = time.perf_counter()
+        if delay is None:
+            result = call()
+            with self._lock:
+                state.latencies.append(time.perf_counter() - submitted)
+            return result
+
+        primary = Future()
+        Thread(target=self._run, args=(state, call, primary, submitted),
+               daemon=True, name='hedged-invoke').start()
+        done, _ = wait([primary], timeout=delay)
+        if done:
+            return primary.result()
+
+        with self._lock:
+            hedge = None
+            if state.tokens < 1:
+                state.skipped += 1
+            elif self._hedges_in_flight >= self.workers:
+                state.skipped_busy += 1
+            else:
+                state.tokens -= 1
+                state.hedges += 1
+                self._hedges_in_flight += 1
+                hedge = Future()
+        if hedge is None:
+            return primary.result()
+        hedge.add_done_callback(self._hedge_done)
+        self._pool().submit(self._run, state, call, hedge, time.perf_counter())
+
+        pending = {primary, hedge}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is hedge:
+                        with self._lock:
+                            state.hedge_wins += 1
+                    return future.result()
+        # both calls failed
+        return primary.result()
+
+    def stats(self):
+        with self._lock:
+            endpoints = dict(self._endpoints)
+        result = {}
+        for key, state in endpoints.items():
+            delay = self.delay(key)
+            result[key] = {
+                'calls': state.calls,
+                'hedges': state.hedges,
+                'hedge_wins': state.hedge_wins,
+                'skipped_over_budget': state.skipped,
+                'skipped_busy': state.skipped_busy,
+                'hedge_rate': state.hedges / state.calls if state.calls else 0.0,
+                'win_rate': state.hedge_wins / state.hedges if state.hedges else 0.0,
+                'delay_ms': delay * 1000 if delay is not None else None
+            }
+        return {'enabled': self.enabled, 'max_ratio': self.max_ratio,
+                'quantile': self.quantile, 'endpoints': result}
+
+    def reset(self):
+        with self._lock:
+            self._endpoints.clear()
+
+
+hedger = Hedger()
@@ -0,0 +1,231 @@
+import io
+import os
+import tarfile
+import tempfile
+import time
+from threading import Lock
+import numpy as np
+from .caching import TTLCache
+from .tensor_codec import encode_tensor, decode_predictions, JSON_CONTENT_TYPE, CONTENT_TYPES
+from .hedging import hedger
+
+SAGEMAKER_BACKEND = 'sagemaker'
+LOCAL_BACKEND = 'local'
+INFERENCE_BACKENDS = [SAGEMAKER_BACKEND, LOCAL_BACKEND]
+
+
+class SageMakerBackend:
+    # Runs the model on the job's SageMaker endpoint
+    name = SAGEMAKER_BACKEND
+
+    # Payload format of the endpoint requests and responses, JSON unless configured otherwise.
+    # The binary format needs an endpoint whose inference handler accepts application/x-npy.
+    content_type = JSON_CONTENT_TYPE
+    accept = JSON_CONTENT_TYPE
+
+    @classmethod
+    def configure(cls, content_type=JSON_CONTENT_TYPE, accept=JSON_CONTENT_TYPE):
+        for value in (content_type, accept):
+            if value not in CONTENT_TYPES:
+                raise ValueError(
+                    f'Unsupported inference content type {value}, use one of {CONTENT_TYPES}')
+        cls.content_type = content_type
+        cls.accept = accept
+
+    def __init__(self, runtime_client):
+        self.runtime_client = runtime_client
+
+    def check(self, job):
+        if not job['endpoint_name']:
+            return 'Endpoint name not found'
+        return None
+
+    def identity(self, job):
+        return f"{self.name}:{job['endpoint_name']}"
+
+    def predict(self, job, features, timer=None):
+        # features is a (N, 16, 8, 1) array, returns the (N, classes) prediction matrix
+        payload = encode_tensor(features, self.content_type)
+
+        def invoke():
+            response = self.runtime_client.invoke_endpoint(
+                EndpointName=job['endpoint_name'],
+                ContentType=self.content_type,
+                Accept=self.accept,
+                Body=payload
+            )
+            return response['Body'].read(), response.get('ContentType', self.accept)
+
+        # A stalled call is duplicated when hedging is enabled
+        start = time.perf_counter()
+        body, content_type = hedger.call(job['endpoint_name'], invoke)
+        invoked = time.perf_counter()
+
+        # Decode by what the endpoint actually answered, so JSON responses keep working
+        predictions = decode_predictions(body, content_type)
+        if timer is not None:
+            timer.record('invoke_endpoint', invoked - start)
+            timer.record('decode_response', time.perf_counter() - invoked)
+        return predictions
+
+
+class LocalModelCache:
+    # Models loaded into this process, keyed by the S3 key of their model.tar.gz and kept with
+    # the ETag of the object they were loaded from. A retrain overwrites the key, so its ETag
+    # is looked up again at most every version_ttl seconds and a new one loads the new model
+    # in place of the old.
+    def __init__(self, version_ttl=60):
+        self._models = {}  # model_key -> (etag, model_fn)
+        self._registered = {}
+        self._versions = TTLCache(maxsize=1024, ttl=version_ttl)
+        self._load_locks = {}
+        self._lock = Lock()
+
+    def configure(self, version_ttl=60):
+        self._versions.configure(ttl=version_ttl)
+
+    def register(self, model_key, model_fn):
+        # model_fn maps a (N, 16, 8, 1) float32 array to a (N, classes) array.
+        # Used to preload models, and as a stand-in model in tests and benchmarks. A registered
+        # model is served whatever the object in S3.
+        with self._lock:
+            self._registered[model_key] = model_fn
+
+    def version(self, model_key, lookup):
+        # ETag of the model to serve, lookup() asks S3. None for a registered model.
+        if model_key in self._registered:
+            return None
+        etag = self._versions.get(model_key)
+        if etag is None:
+            etag = lookup()
+            self._versions.set(model_key, etag)
+        return etag
+
+    def get(self, model_key, version, loader):
+        # loader() returns (etag, model_fn) of the object it loaded
+        model_fn = self._registered.get(model_key)
+        if model_fn is not None:
+            return model_fn
+        entry = self._models.get(model_key)
+        if entry is not None and entry[0] == version:
+            return entry[1]
+
+        with self._lock:
+            load_lock = self._load_locks.setdefault(model_key, Lock())
+
+        # Only one thread downloads a given model, the others wait for it
+        with load_lock:
+            entry = self._models.get(model_key)
+            if entry is not None and entry[0] == version:
+                return entry[1]
+            etag, model_fn = loader()
+            with self._lock:
+                self._models[model_key] = (etag, model_fn)
+            if etag != version:
+                # overwritten again since the version lookup
+                self._versions.set(model_key, etag)
+            return model_fn
+
+    def evict(self, model_key):
+        with self._lock:
+            self._models.pop(model_key, None)
+            self._registered.pop(model_key, None)
+        self._versions.invalidate(model_key)
+
+    def clear(self):
+        with self._lock:
+            self._models.clear()
+            self._registered.clear()
+        self._versions.clear()
+
+
+local_model_cache = LocalModelCache()
+
+
+def model_key_for_job(job):
+    return f"jobs/{job['job_name']}/train_artifacts/model.tar.gz"
+
+
+def load_tensorflow_model(model_dir):
+    # tensorflow is only needed when a job uses the local backend
+    try:
+        import tensorflow as tf
+    except ImportError:
+        raise RuntimeError(
+            'tensorflow is required for the local inference backend')
+
+    for root, _, files in os.walk(model_dir):
+        if 'saved_model.pb' in files:
+            loaded = tf.saved_model.load(root)
+            serving_fn = loaded.signatures['serving_default']
+            input_name = list(serving_fn.structured_input_signature[1].keys())[0]
+
+            def predict_saved_model(features):
+                outputs = serving_fn(
+                    **{input_name: tf.constant(features, dtype=tf.float32)})
+                return next(iter(outputs.values())).numpy()
+
+            # keep a reference so the loaded object is not garbage collected
+            predict_saved_model.model = loaded
+            return predict_saved_model
+
+        for filename in files:
+            if filename.endswith(('.keras', '.h5')):
+                model = tf.keras.models.load_model(
+                    os.path.join(root, filename), compile=False)
+
+                def predict_keras(features):
+                    return model(features, training=False).numpy()
+
+                predict_keras.model = model
+                return predict_keras
+
+    raise RuntimeError('No SavedModel or Keras model found in model.tar.gz')
+
+
+class LocalModelBackend:
+    # Runs the job's trained model.tar.gz in-process on CPU
+    name = LOCAL_BACKEND
+
+    def __init__(self, s3_client, bucket_name, models=local_model_cache):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.models = models
+
+    def check(self, job):
+        if not job['job_name']:
+            return 'job_name not found'
+        return None
+
+    def _version(self, model_key):
+        return self.models.version(model_key, lambda: self.s3_client.head_object(
+            Bucket=self.bucket_name, Key=model_key)['ETag'])
+
+    def identity(self, job):
+        # changes with the model.tar.gz, so cached predictions of a retrained model are not reused
+        model_key = model_key_for_job(job)
+        version = self._version(model_key)
+        return f'{self.name}:{model_key}' + (f'@{version}' if version else '')
+
+    def _load(self, model_key):
+        response = self.s3_client.get_object(
+            Bucket=self.bucket_name, Key=model_key)
+        archive = io.BytesIO(response['Body'].read())
+
+        # the loaded model is held in memory, its extracted files are not needed afterwards
+        with tempfile.TemporaryDirectory(prefix='model-') as model_dir:
+            with tarfile.open(fileobj=archive, mode='r:gz') as tar:
+                tar.extractall(model_dir, filter='data')
+            return response.get('ETag'), load_tensorflow_model(model_dir)
+
+    def predict(self, job, features, timer=None):
+        model_key = model_key_for_job(job)
+        start = time.perf_counter()
+        version = self._version(model_key)
+        model_fn = self.models.get(model_key, version, lambda: self._load(model_key))
+        loaded = time.perf_counter()
+        predictions = np.asarray(model_fn(features.astype(np.float32, copy=False)), dtype=np.float64)
+        if timer is not None:
+            timer.record('model_load', loaded - start)
+            timer.record('model_run', time.perf_counter() - loaded)
+        return predictions
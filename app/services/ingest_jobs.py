@@ -0,0 +1,173 @@
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from threading import Lock
+
+
+def utc_now():
+    return datetime.now(timezone.utc).isoformat()
+
+
+class IngestJob:
+    # Progress of one sounds.zip ingest. The upload workers update the counters concurrently,
+    # the polling route reads them through snapshot().
+    def __init__(self, class_name, total_members=0, job_id=None):
+        self.job_id = job_id or uuid.uuid4().hex
+        self.class_name = class_name
+        self.total_members = total_members
+        self.status = 'queued'
+        self.error = None
+        self.uploaded = 0
+        self.bytes = 0
+        self.retried = 0
+        self.deduplicated = 0
+        self.failed = []  # {'file', 'error'} per member that was not uploaded
+        self.rejected = []  # {'file', 'reason', 'quarantine_key'} per member that failed the probe
+        self.concurrency = None
+        self.total_count = None
+        self.created_at = utc_now()
+        self.started_at = None
+        self.finished_at = None
+        self._start = None
+        self._seconds = None
+        self._lock = Lock()
+
+    def start(self):
+        with self._lock:
+            self.status = 'running'
+            self.started_at = utc_now()
+            self._start = time.perf_counter()
+
+    def add_uploaded(self, size):
+        with self._lock:
+            self.uploaded += 1
+            self.bytes += size
+
+    def add_failed(self, filename, error):
+        with self._lock:
+            self.failed.append({'file': filename, 'error': str(error)})
+
+    def add_rejected(self, filename, reason, quarantine_key=None):
+        with self._lock:
+            self.rejected.append({'file': filename, 'reason': reason, 'quarantine_key': quarantine_key})
+
+    def add_retried(self):
+        with self._lock:
+            self.retried += 1
+
+    def add_deduplicated(self):
+        with self._lock:
+            self.deduplicated += 1
+
+    def set_concurrency(self, concurrency):
+        with self._lock:
+            self.concurrency = concurrency
+
+    def finish(self, error=None):
+        with self._lock:
+            self.status = 'failed' if error is not None else 'succeeded'
+            self.error = str(error) if error is not None else None
+            self.finished_at = utc_now()
+            if self._start is not None:
+                self._seconds = time.perf_counter() - self._start
+
+    @property
+    def done(self):
+        return self.status in ('succeeded', 'failed')
+
+    @property
+    def seconds(self):
+        if self._seconds is not None:
+            return self._seconds
+        return time.perf_counter() - self._start if self._start is not None else 0.0
+
+    def snapshot(self, failed_files=True):
+        with self._lock:
+            seconds = self.seconds
+            snapshot = {
+                'job_id': self.job_id,
+                'class_name': self.class_name,
+                'state': self.status,
+                'error': self.error,
+                'total_members': self.total_members,
+                'uploaded_count': self.uploaded,
+                'failed_count': len(self.failed),
+                'rejected_count': len(self.rejected),
+                'retried_count': self.retried,
+                'deduplicated_count': self.deduplicated,
+                'bytes': self.bytes,
+                'seconds': round(seconds, 3),
+                'objects_per_second': round(self.uploaded / seconds, 1) if seconds else 0.0,
+                'concurrency': self.concurrency,
+                'total_count': self.total_count,
+                'created_at': self.created_at,
+                'started_at': self.started_at,
+                'finished_at': self.finished_at
+            }
+            if failed_files:
+                snapshot['failed_files'] = list(self.failed)
+                snapshot['rejected_files'] = list(self.rejected)
+            return snapshot
+
+
+class IngestJobs:
+    # Runs ingests of at least min_members members off the request thread and keeps the last
+    # `keep` jobs for polling. Jobs live in this process, the app runs as a single
+    # `flask run` process.
+    def __init__(self, min_members=500, workers=2, keep=100):
+        self.configure(min_members, workers, keep)
+        self._jobs = OrderedDict()
+        self._lock = Lock()
+        self._executor = None
+
+    def configure(self, min_members=500, workers=2, keep=100):
+        self.min_members = min_members
+        self.workers = workers
+        self.keep = keep
+
+    def in_background(self, members):
+        return self.min_members > 0 and members >= self.min_members
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=max(self.workers, 1), thread_name_prefix='ingest-job')
+            return self._executor
+
+    def submit(self, job, run):
+        # run(job) ingests, raising fails the job, its counters are kept either way
+        with self._lock:
+            self._jobs[job.job_id] = job
+            # drop the oldest finished jobs beyond keep, running ones always stay
+            for job_id in list(self._jobs):
+                if len(self._jobs) <= self.keep:
+                    break
+                if self._jobs[job_id].done:
+                    del self._jobs[job_id]
+
+        def execute():
+            job.start()
+            try:
+                run(job)
+            except Exception as e:
+                job.finish(error=e)
+            else:
+                job.finish()
+
+        self._pool().submit(execute)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list(self):
+        with self._lock:
+            jobs = list(self._jobs.values())
+        return [job.snapshot(failed_files=False) for job in reversed(jobs)]
+
+
+ingest_jobs = IngestJobs()
@@ -7,6 +7,7 @@ from botocore.config import Config as BotoConfig
 import io
 import random
 import datetime
+from .hash_index import ClassHashIndex, ClassBusyError, class_lock_or_busy
 
 
 class DataService:
@@ -84,23 +85,32 @@ class DataService:
             ) if filename in input_audio_files}
 
             renamed_files = []
-            for key, filename in common_audio_files.items():
-                # Generate new filename with a timestamp suffix
-                new_filename = f"{filename.rsplit('.', 1)[0]}_{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}.wav"
-                new_key = f'zip_data/{zip_class_name}/{new_filename}'
-
-                # Copy and then delete the old object
-                self.s3_client.copy_object(Bucket=self.bucket_name, CopySource={
-                    'Bucket': self.bucket_name, 'Key': key}, Key=new_key)
-                self.s3_client.delete_object(Bucket=self.bucket_name, Key=key)
-
-                renamed_files.append({
-                    'old_filename': key,
-                    'new_filename': new_key
-                })
+            with class_lock_or_busy(zip_class_name):
+                index = ClassHashIndex.load(self.s3_client, self.bucket_name, zip_class_name)
+                try:
+                    for key, filename in common_audio_files.items():
+                        # Generate new filename with a timestamp suffix
+                        new_filename = f"{filename.rsplit('.', 1)[0]}_{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}.wav"
+                        new_key = f'zip_data/{zip_class_name}/{new_filename}'
+
+                        # Copy and then delete the old object
+                        self.s3_client.copy_object(Bucket=self.bucket_name, CopySource={
+                            'Bucket': self.bucket_name, 'Key': key}, Key=new_key)
+                        self.s3_client.delete_object(Bucket=self.bucket_name, Key=key)
+                        # the content hash index follows the object to its new key
+                        index.move(key, new_key)
+
+                        renamed_files.append({
+                            'old_filename': key,
+                            'new_filename': new_key
+                        })
+                finally:
+                    index.save()
 
             return jsonify({'status': 'success', 'renamed_files': renamed_files}), 200
 
+        except ClassBusyError as e:
+            return jsonify({'status': 'fail', 'message': str(e)}), 409
         except Exception as e:
             return jsonify({'status': 'fail', 'message': str(e)}), 500
 
@@ -0,0 +1,73 @@
+from .caching import TTLCache
+
+# Parsed `jobs` records used by the predict hot path, keyed by job_id.
+# Every service method that changes one of the cached fields must call invalidate_job().
+job_cache = TTLCache(maxsize=1024, ttl=60)
+
+# The approved jobs are cached as one list under a key no job_id can collide with
+APPROVED_JOBS_KEY = ('approved_jobs',)
+
+
+def parse_job_item(item):
+    return {
+        'job_id': item.get('job_id', {}).get('S'),
+        'job_name': item.get('job_name', {}).get('S'),
+        'endpoint_name': item.get('endpoint_name', {}).get('S'),
+        'training_classes': item.get('training_classes', {}).get('SS', []),
+        'threshold': item.get('threshold', {}).get('N', 0.5),
+        'display_names_for_training_classes': item.get(
+            'display_names_for_training_classes', {}).get('L', []),
+        'approved': item.get('approved', {}).get('BOOL', False),
+        'approve_name': item.get('approve_name', {}).get('S'),
+        'inference_backend': item.get('inference_backend', {}).get('S', 'sagemaker')
+    }
+
+
+def get_job(dynamodb_client, job_id):
+    # Returns the parsed job record, or None if the job_id does not exist
+    job = job_cache.get(job_id)
+    if job is not None:
+        return job
+
+    res = dynamodb_client.get_item(
+        TableName='jobs', Key={'job_id': {'S': job_id}}
+    )
+
+    if 'Item' not in res:
+        return None
+
+    job = parse_job_item(res['Item'])
+    job_cache.set(job_id, job)
+    return job
+
+
+def get_approved_job_records(dynamodb_client):
+    # Parsed records of every approved job
+    jobs = job_cache.get(APPROVED_JOBS_KEY)
+    if jobs is not None:
+        return jobs
+
+    jobs = []
+    scan_kwargs = {
+        'TableName': 'jobs',
+        'FilterExpression': 'approved = :approved',
+        'ExpressionAttributeValues': {':approved': {'BOOL': True}}
+    }
+    while True:
+        res = dynamodb_client.scan(**scan_kwargs)
+        for item in res.get('Items', []):
+            job = parse_job_item(item)
+            jobs.append(job)
+            job_cache.set(job['job_id'], job)
+        if 'LastEvaluatedKey' not in res:
+            break
+        scan_kwargs['ExclusiveStartKey'] = res['LastEvaluatedKey']
+
+    job_cache.set(APPROVED_JOBS_KEY, jobs)
+    return jobs
+
+
+def invalidate_job(job_id):
+    job_cache.invalidate(job_id)
+    # a changed job can also change the approved list
+    job_cache.invalidate(APPROVED_JOBS_KEY)
@@ -0,0 +1,151 @@
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from threading import Lock
+
+# Request header that makes the predict routes return their per-stage breakdown
+DEBUG_TIMINGS_HEADER = 'X-Debug-Timings'
+
+# Upper bounds in seconds
+LATENCY_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf')]
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._lock = Lock()
+
+    def observe(self, value):
+        with self._lock:
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[index] += 1
+                    break
+            self.count += 1
+            self.total += value
+            self.max = max(self.max, value)
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-th observation, capped at the max seen
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'count': self.count,
+                'sum_ms': self.total * 1000,
+                'mean_ms': self.total / self.count * 1000 if self.count else 0.0,
+                'max_ms': self.max * 1000,
+                'p50_ms': self.quantile(0.5) * 1000,
+                'p95_ms': self.quantile(0.95) * 1000,
+                'p99_ms': self.quantile(0.99) * 1000,
+                'buckets': {str(bound): count for bound, count in zip(self.buckets, self.counts)}
+            }
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._stages = defaultdict(Histogram)
+        self._job_stages = defaultdict(lambda: defaultdict(Histogram))
+        self._counters = defaultdict(int)
+        self._lock = Lock()
+
+    def observe(self, stage, seconds, job_id=None):
+        with self._lock:
+            histogram = self._stages[stage]
+        histogram.observe(seconds)
+        if job_id:
+            self.observe_job(job_id, stage, seconds)
+
+    def observe_job(self, job_id, stage, seconds):
+        with self._lock:
+            histogram = self._job_stages[job_id][stage]
+        histogram.observe(seconds)
+
+    def increment(self, name, amount=1):
+        with self._lock:
+            self._counters[name] += amount
+
+    def snapshot(self):
+        with self._lock:
+            stages = dict(self._stages)
+            job_stages = {job_id: dict(stages_) for job_id, stages_ in self._job_stages.items()}
+            counters = dict(self._counters)
+        return {
+            'stages': {stage: histogram.snapshot() for stage, histogram in stages.items()},
+            'jobs': {job_id: {stage: histogram.snapshot() for stage, histogram in stages_.items()}
+                     for job_id, stages_ in job_stages.items()},
+            'counters': counters
+        }
+
+    def reset(self):
+        with self._lock:
+            self._stages.clear()
+            self._job_stages.clear()
+            self._counters.clear()
+
+
+metrics = MetricsRegistry()
+
+
+class StageTimer:
+    # Times the stages of one predict request with a monotonic clock. Every stage goes into
+    # the process-wide histograms, and the breakdown can be returned in the response. Per-job
+    # histograms start at attach(), once the job_id is known to exist, so made-up job_ids
+    # cannot grow the registry.
+    def __init__(self, job_id=None, registry=metrics):
+        self.job_id = job_id
+        self.registry = registry
+        self.stages = {}
+        self.info = {}
+        self._recorded = []
+        self._started = {}
+        self._start = time.perf_counter()
+
+    def attach(self, job_id):
+        # the stages timed so far go into the job's histograms too
+        self.job_id = job_id
+        for name, seconds in self._recorded:
+            self.registry.observe_job(job_id, name, seconds)
+        self._recorded = []
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def start_stage(self, name):
+        self._started[name] = time.perf_counter()
+
+    def end_stage(self, name):
+        self.record(name, time.perf_counter() - self._started.pop(name))
+
+    def record(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+        self.registry.observe(name, seconds, self.job_id)
+        if self.job_id is None:
+            self._recorded.append((name, seconds))
+
+    def finish(self):
+        self.record('total', time.perf_counter() - self._start)
+
+    def report(self):
+        return dict(self.info, stages_ms={name: round(seconds * 1000, 3)
+                                          for name, seconds in self.stages.items()})
+
@@ -0,0 +1,134 @@
+import queue
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock, Semaphore, Thread
+import numpy as np
+
+
+class MicroBatcher:
+    # Coalesces single-clip predictions from concurrent requests that target the same model
+    # into one backend call. Rows are queued per model key for up to max_wait_ms or until
+    # max_batch_size rows are waiting, and every request gets back its own row. Up to
+    # max_in_flight batches per model key run at once, the next batch is collected while
+    # earlier ones wait on the backend. A model key's thread and pool stop once it has had no
+    # rows for idle_seconds, local model keys change with every retrained model.
+    def __init__(self, max_batch_size=16, max_wait_ms=0, max_in_flight=8, idle_seconds=60):
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.max_in_flight = max_in_flight
+        self.idle_seconds = idle_seconds
+        self._queues = {}
+        self._lock = Lock()
+        self.batches = 0
+        self.rows = 0
+        self.in_flight = 0
+
+    def configure(self, max_batch_size=16, max_wait_ms=0, max_in_flight=8, idle_seconds=60):
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.max_in_flight = max_in_flight
+        self.idle_seconds = idle_seconds
+
+    @property
+    def enabled(self):
+        return self.max_wait_ms > 0 and self.max_batch_size > 1
+
+    def predict(self, key, features, predict_fn):
+        # features is a (1, 16, 8, 1) array, predict_fn maps a (N, 16, 8, 1) batch to (N, classes)
+        if not self.enabled:
+            return predict_fn(features)
+
+        future = Future()
+        self._put(key, (features[0], predict_fn, future))
+        return future.result()[np.newaxis]
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'max_batch_size': self.max_batch_size,
+            'max_wait_ms': self.max_wait_ms,
+            'max_in_flight': self.max_in_flight,
+            'batches': self.batches,
+            'rows': self.rows,
+            'in_flight': self.in_flight,
+            'models': len(self._queues),
+            'mean_batch_size': self.rows / self.batches if self.batches else 0.0
+        }
+
+    def _put(self, key, row):
+        # Under the lock, so an idle runner cannot stop between finding its queue empty and
+        # a row being queued
+        with self._lock:
+            pending = self._queues.get(key)
+            if pending is None:
+                pending = self._queues[key] = queue.Queue()
+                Thread(target=self._run, args=(key, pending), daemon=True,
+                       name=f'micro-batcher-{key}').start()
+            pending.put(row)
+
+    def _collect(self, key, pending):
+        # None once the key has been idle for idle_seconds, its queue is removed
+        while True:
+            try:
+                batch = [pending.get(timeout=self.idle_seconds)]
+                break
+            except queue.Empty:
+                with self._lock:
+                    if pending.empty():
+                        if self._queues.get(key) is pending:
+                            del self._queues[key]
+                        return None
+        deadline = time.monotonic() + self.max_wait_ms / 1000
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(pending.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self, key, pending):
+        in_flight = max(self.max_in_flight, 1)
+        slots = Semaphore(in_flight)
+        executor = ThreadPoolExecutor(max_workers=in_flight, thread_name_prefix=f'micro-batch-{key}')
+        while True:
+            # a free slot first, so rows arriving while every slot is busy wait in the queue
+            # and make up the next batch
+            slots.acquire()
+            batch = self._collect(key, pending)
+            if batch is None:
+                # batches still in flight finish on their own
+                executor.shutdown(wait=False)
+                return
+            with self._lock:
+                self.batches += 1
+                self.rows += len(batch)
+                self.in_flight += 1
+            executor.submit(self._dispatch, batch, slots)
+
+    def _dispatch(self, batch, slots):
+        try:
+            # every row in the queue targets the same model, so any of the callbacks will do
+            predict_fn = batch[0][1]
+            try:
+                predictions = predict_fn(np.stack([row for row, _, _ in batch]))
+            except Exception as e:
+                for _, _, future in batch:
+                    future.set_exception(e)
+                return
+
+            for (_, _, future), prediction in zip(batch, predictions):
+                future.set_result(prediction)
+            # a short response leaves the rows after it without a prediction
+            for _, _, future in batch[len(predictions):]:
+                future.set_exception(ValueError(
+                    f'Endpoint returned {len(predictions)} predictions for a batch of {len(batch)} rows'))
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+            slots.release()
+
+
+micro_batcher = MicroBatcher()
@@ -1,24 +1,151 @@
 from botocore.config import Config as BotoConfig
 from flask import jsonify
 from botocore.exceptions import ClientError
-import os
 import numpy as np
-import librosa
-import boto3
 import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+from .audio_features import read_upload, iter_window_features
+from .feature_pool import feature_pool, DecodeError
+from .job_cache import get_job, get_approved_job_records, invalidate_job, job_cache
+from .prediction_cache import prediction_cache, prediction_cache_key, content_hash
+from .micro_batching import micro_batcher
+from .hedging import hedger
+from .metrics import metrics, StageTimer, DEBUG_TIMINGS_HEADER
+from .streaming import StreamingFeatures, PCM_FORMATS
+from .prediction_log import prediction_logger
+from .tensor_codec import as_feature_batch, decode_npy, base_content_type, NPY_CONTENT_TYPE
+from .inference_backends import SageMakerBackend, LocalModelBackend, LOCAL_BACKEND, INFERENCE_BACKENDS, model_key_for_job, local_model_cache
+
+
+MAX_BATCH_SIZE = 64
+WINDOW_BATCH_SIZE = 32
+
+# Most endpoint calls one ensemble request runs at once, each request gets its own threads
+# so concurrent ensemble requests do not queue behind each other's models
+ENSEMBLE_MAX_WORKERS = 16
+
+
+def format_display_names(display_names_for_training_classes):
+    return [
+        {
+            'class': dn.get('M', {}).get('class', {}).get('S', ''),
+            'display_name': dn.get('M', {}).get('display_name', {}).get('S', ''),
+            'icon': dn.get('M', {}).get('icon', {}).get('S', ''),
+            'color': dn.get('M', {}).get('color', {}).get('S', '')
+        } for dn in display_names_for_training_classes
+    ]
+
+
+def classify_with_display_names(predictions, training_classes, threshold, display_names):
+    # Threshold / argmax post-processing over the whole (N, classes) prediction matrix at once
+    predictions = np.asarray(predictions, dtype=np.float64)
+    classes = np.asarray(training_classes)
+    threshold = float(threshold)
+
+    if len(training_classes) == 2:
+        # binary models output a single score, apply the threshold to it
+        indices = (predictions[:, 0] > threshold).astype(int)
+        predicted_classes = classes[indices]
+        probabilities = np.where(
+            predicted_classes == 'other', predictions[:, 0], 1 - predictions[:, 0])
+        displays = [display_names[i] for i in indices]
+    else:
+        # maximum prediction should be over the threshold, otherwise send other class
+        indices = np.argmax(predictions, axis=1)
+        probabilities = predictions[np.arange(len(predictions)), indices]
+        is_known = probabilities > threshold
+        predicted_classes = np.where(is_known, classes[indices], 'other')
+
+        other_display = next(
+            (dn for dn in display_names if dn['class'] == 'other'), None)
+        displays = [display_names[i] if known or other_display is None else other_display
+                    for i, known in zip(indices, is_known)]
+
+    return [
+        {'prediction': str(predicted_class), 'probability': float(probability), 'display': display}
+        for predicted_class, probability, display in zip(predicted_classes, probabilities, displays)
+    ]
+
+
+def check_prediction_count(predictions, rows):
+    # A short or long endpoint response would drop or mislabel rows of the results
+    if len(predictions) != rows:
+        raise ValueError(f'Endpoint returned {len(predictions)} predictions for a batch of {rows} rows')
+
+
+def merge_window_segments(timeline):
+    # Merge consecutive windows with the same class into events, 'other' is background
+    segments = []
+    for window in timeline:
+        if window['prediction'] in ('other', 'unknown'):
+            continue
+        last = segments[-1] if segments else None
+        if last and last['prediction'] == window['prediction'] and window['start'] <= last['end']:
+            last['end'] = max(last['end'], window['end'])
+            last['probabilities'].append(window['probability'])
+        else:
+            segments.append({'prediction': window['prediction'], 'display': window['display'],
+                             'start': window['start'], 'end': window['end'],
+                             'probabilities': [window['probability']]})
+
+    for segment in segments:
+        probabilities = segment.pop('probabilities')
+        segment['probability'] = float(np.mean(probabilities))
+        segment['max_probability'] = float(np.max(probabilities))
+    return segments
+
+
+def aggregate_ensemble(results):
+    # Soft vote: the class with the highest summed probability over the models that detected it.
+    # Models that answered 'other' or 'unknown' abstain.
+    votes = {}
+    for result in results:
+        if result['status'] != 'success' or result['prediction'] in ('other', 'unknown'):
+            continue
+        vote = votes.setdefault(result['prediction'], {'prediction': result['prediction'], 'display': result['display'], 'score': 0.0, 'job_ids': []})
+        vote['score'] += result['probability']
+        vote['job_ids'].append(result['job_id'])
+        if result['probability'] > vote.get('best', 0.0):
+            vote['best'] = result['probability']
+            vote['display'] = result['display']
+
+    if not votes:
+        return {'prediction': 'other', 'probability': None, 'display': None, 'votes': 0, 'job_ids': []}
+
+    best = max(votes.values(), key=lambda vote: vote['score'])
+    return {'prediction': best['prediction'], 'probability': best['score'] / len(best['job_ids']),
+            'display': best['display'], 'votes': len(best['job_ids']), 'job_ids': best['job_ids']}
+
+
+def timed_response(result, timer, request):
+    # Records the total request time and queues the prediction for the S3 prediction log,
+    # the stage breakdown is only returned on request
+    timer.finish()
+    prediction_logger.log(request.path, timer.job_id, result, timer.stages['total'] * 1000,
+                          timer.info.get('cache_hit', False))
+    if request.headers.get(DEBUG_TIMINGS_HEADER):
+        result = dict(result, timings=timer.report())
+    return jsonify(result), 200
 
 
 class PredictService:
-    def __init__(self, s3_client, sagemaker_client, dynamodb_client, bucket_name, role_arn):
+    def __init__(self, s3_client, sagemaker_client, dynamodb_client, bucket_name, role_arn, runtime_client=None):
         self.s3_client = s3_client
         self.sagemaker_client = sagemaker_client
         self.dynamodb_client = dynamodb_client
         self.bucket_name = bucket_name
         self.role_arn = role_arn
-        self.runtime_client = boto3.client('runtime.sagemaker')
+        self.runtime_client = runtime_client or boto3.client(
+            'runtime.sagemaker')
+
+    def get_backend(self, job):
+        if job['inference_backend'] == LOCAL_BACKEND:
+            return LocalModelBackend(self.s3_client, self.bucket_name)
+        return SageMakerBackend(self.runtime_client)
 
     def predict(self, request):
-        local_file_path = None  # Initialize local_file_path to None
         try:
             job_id = request.form.get('job_id')
             file_storage = request.files.get('file')
@@ -29,56 +156,54 @@ class PredictService:
                 return jsonify({'status': 'fail', 'message': 'File is required'}), 400
 
             # Check if job_id exists and retrieve class labels
-            res = self.dynamodb_client.get_item(
-                TableName='jobs', Key={'job_id': {'S': job_id}}
-            )
+            timer = StageTimer()
+            with timer.stage('job_lookup'):
+                job = get_job(self.dynamodb_client, job_id)
 
-            if 'Item' not in res:
+            if job is None:
                 return jsonify({'status': 'fail', 'message': 'job_id does not exist'}), 404
+            timer.attach(job_id)
 
-            item = res['Item']
-            endpoint_name = item.get('endpoint_name', {}).get('S')
-            training_classes = item.get('training_classes', {}).get('SS', [])
-            threshold = item.get('threshold', {}).get('N', 0.5)
+            training_classes = job['training_classes']
+            threshold = job['threshold']
 
-            print('the threshold is', threshold)
+            timer.info['threshold'] = threshold
 
-            if not endpoint_name:
-                return jsonify({'status': 'fail', 'message': 'Endpoint name not found'}), 404
+            backend = self.get_backend(job)
+            backend_error = backend.check(job)
+            if backend_error:
+                return jsonify({'status': 'fail', 'message': backend_error}), 404
 
             if not training_classes:
                 return jsonify({'status': 'fail', 'message': 'Training classes not found'}), 400
 
-            UPLOAD_FOLDER = 'uploads'
-            # Save the uploaded file temporarily
-            local_file_path = os.path.join(
-                UPLOAD_FOLDER, file_storage.filename)
-            file_storage.save(local_file_path)
-
-            # Load the audio file and preprocess it
-            audio, sr = librosa.load(local_file_path)
-            melspec = np.mean(librosa.feature.melspectrogram(
-                y=audio, sr=sr).T, axis=0)
+            # Byte-identical uploads skip decode, feature extraction and the model call
+            with timer.stage('read_upload'):
+                data = read_upload(file_storage)
+            with timer.stage('cache_lookup'):
+                cache_key = prediction_cache_key(
+                    'predict', job_id, job, backend, content_hash(data))
+                cached_result = prediction_cache.get(cache_key)
+            timer.info['cache_hit'] = cached_result is not None
+            if cached_result is not None:
+                return timed_response(cached_result, timer, request)
+
+            # Decode the uploaded file in memory and preprocess it
+            melspec = feature_pool.extract(data, timer)
             melspec = melspec.reshape(1, 16, 8, 1)
 
-            # Predict using the endpoint
-            response = self.runtime_client.invoke_endpoint(
-                EndpointName=endpoint_name,
-                ContentType='application/json',
-                Body=json.dumps(melspec.tolist())
-            )
-
-            # Decode response
-            result = response['Body'].read().decode('utf-8')
-            prediction_data = json.loads(result)
+            # Predict using the job's inference backend, concurrent requests for the same model share a batch.
+            # A shared batch records its endpoint timings on the request that triggered it.
+            with timer.stage('inference'):
+                predictions = micro_batcher.predict(
+                    backend.identity(job), melspec, lambda batch: backend.predict(job, batch, timer))
+            timer.start_stage('postprocess')
+            prediction_data = {'predictions': predictions.tolist()}
             predicted_class = None
 
             # Obtain the index with the highest score for multiclass, or apply a threshold for binary
             if len(training_classes) == 2:
-                pre = prediction_data['predictions'][0][0]
                 threshold = float(threshold)
-                print('pre', pre)
-                print('threshold', threshold)
 
                 prediction = int(
                     prediction_data['predictions'][0][0] > float(threshold))
@@ -91,15 +216,15 @@ class PredictService:
                 predicted_class = training_classes[prediction] if prediction_data['predictions'][0][prediction] > float(
                     threshold) else 'unknown'
 
-            return jsonify({'status': 'success', 'prediction': predicted_class, 'prediction_data': prediction_data, 'training_classes': training_classes}), 200
+            result = {'status': 'success', 'prediction': predicted_class, 'prediction_data': prediction_data, 'training_classes': training_classes}
+            timer.end_stage('postprocess')
+            prediction_cache.set(cache_key, result)
+            return timed_response(result, timer, request)
 
         except ClientError as e:
             return jsonify({'status': 'fail', 'message': e.response['Error']['Message']}), 500
         except Exception as e:
             return jsonify({'status': 'fail', 'message': str(e)}), 500
-        finally:
-            if local_file_path and os.path.exists(local_file_path):
-                os.remove(local_file_path)
 
     def add_threshold(self, request):
         try:
@@ -149,6 +274,7 @@ class PredictService:
                 UpdateExpression='SET threshold = :threshold',
                 ExpressionAttributeValues={':threshold': {'N': str(threshold)}}
             )
+            invalidate_job(job_id)
 
             if res['ResponseMetadata']['HTTPStatusCode'] == 200:
                 return jsonify({'status': 'success', 'message': 'Threshold added successfully'}), 200
@@ -197,6 +323,7 @@ class PredictService:
                 Key={'job_id': {'S': job_id}},
                 UpdateExpression='REMOVE threshold'
             )
+            invalidate_job(job_id)
 
             if res['ResponseMetadata']['HTTPStatusCode'] == 200:
                 return jsonify({'status': 'success', 'message': 'Threshold removed successfully'}), 200
@@ -283,6 +410,7 @@ class PredictService:
                     ':approved': {'BOOL': True}
                 }
             )
+            invalidate_job(job_id)
 
             if res['ResponseMetadata']['HTTPStatusCode'] == 200:
                 return jsonify({'status': 'success', 'message': 'Job approved successfully'}), 200
@@ -330,6 +458,7 @@ class PredictService:
                 UpdateExpression='REMOVE threshold, approve_name, approve_date, display_names_for_training_classes SET approved = :approved',
                 ExpressionAttributeValues={':approved': {'BOOL': False}}
             )
+            invalidate_job(job_id)
 
             if res['ResponseMetadata']['HTTPStatusCode'] == 200:
                 return jsonify({'status': 'success', 'message': 'Job rejected successfully'}), 200
@@ -366,8 +495,57 @@ class PredictService:
         except Exception as e:
             return jsonify({'status': 'fail', 'message': str(e)}), 500
 
+    def set_inference_backend(self, request):
+        try:
+            job_id = request.json.get('job_id')
+            inference_backend = request.json.get('inference_backend')
+
+            if not job_id:
+                return jsonify({'status': 'fail', 'message': 'job_id is required'}), 400
+
+            if inference_backend not in INFERENCE_BACKENDS:
+                return jsonify({'status': 'fail', 'message': f'inference_backend must be one of {INFERENCE_BACKENDS}'}), 400
+
+            res = self.dynamodb_client.get_item(
+                TableName='jobs', Key={'job_id': {'S': job_id}}
+            )
+            if 'Item' not in res:
+                return jsonify({'status': 'fail', 'message': 'job_id does not exist'}), 404
+
+            job_name = res['Item'].get('job_name', {}).get('S')
+            if inference_backend == LOCAL_BACKEND and not job_name:
+                return jsonify({'status': 'fail', 'message': 'job_name not found'}), 404
+
+            res = self.dynamodb_client.update_item(
+                TableName='jobs',
+                Key={'job_id': {'S': job_id}},
+                UpdateExpression='SET inference_backend = :inference_backend',
+                ExpressionAttributeValues={
+                    ':inference_backend': {'S': inference_backend}}
+            )
+            invalidate_job(job_id)
+
+            # drop the in-memory model so switching back to local reloads the latest artifacts
+            if job_name:
+                local_model_cache.evict(model_key_for_job({'job_name': job_name}))
+
+            if res['ResponseMetadata']['HTTPStatusCode'] == 200:
+                return jsonify({'status': 'success', 'message': 'Inference backend updated successfully'}), 200
+            else:
+                return jsonify({'status': 'fail', 'message': 'Failed to update inference backend'}), 500
+
+        except ClientError as e:
+            return jsonify({'status': 'fail', 'message': e.response['Error']['Message']}), 500
+        except Exception as e:
+            return jsonify({'status': 'fail', 'message': str(e)}), 500
+
+    def get_cache_stats(self):
+        return jsonify({'status': 'success', 'job_cache': job_cache.stats(), 'prediction_cache': prediction_cache.stats()}), 200
+
+    def get_metrics(self):
+        return jsonify({'status': 'success', 'metrics': metrics.snapshot(), 'micro_batching': micro_batcher.stats(), 'hedging': hedger.stats(), 'prediction_log': prediction_logger.stats()}), 200
+
     def predict_with_display_names(self, request):
-        local_file_path = None  # Initialize local_file_path to None
         try:
             job_id = request.form.get('job_id')
             file_storage = request.files.get('file')
@@ -378,24 +556,24 @@ class PredictService:
                 return jsonify({'status': 'fail', 'message': 'File is required'}), 400
 
             # Check if job_id exists and retrieve class labels
-            res = self.dynamodb_client.get_item(
-                TableName='jobs', Key={'job_id': {'S': job_id}}
-            )
+            timer = StageTimer()
+            with timer.stage('job_lookup'):
+                job = get_job(self.dynamodb_client, job_id)
 
-            if 'Item' not in res:
+            if job is None:
                 return jsonify({'status': 'fail', 'message': 'job_id does not exist'}), 404
+            timer.attach(job_id)
 
-            item = res['Item']
-            endpoint_name = item.get('endpoint_name', {}).get('S')
-            training_classes = item.get('training_classes', {}).get('SS', [])
-            threshold = item.get('threshold', {}).get('N', 0.5)
-            display_names_for_training_classes = item.get(
-                'display_names_for_training_classes', {}).get('L', [])
+            training_classes = job['training_classes']
+            threshold = job['threshold']
+            display_names_for_training_classes = job['display_names_for_training_classes']
 
-            print('the threshold is', threshold)
+            timer.info['threshold'] = threshold
 
-            if not endpoint_name:
-                return jsonify({'status': 'fail', 'message': 'Endpoint name not found'}), 404
+            backend = self.get_backend(job)
+            backend_error = backend.check(job)
+            if backend_error:
+                return jsonify({'status': 'fail', 'message': backend_error}), 404
 
             if not training_classes:
                 return jsonify({'status': 'fail', 'message': 'Training classes not found'}), 400
@@ -403,117 +581,153 @@ class PredictService:
             if not display_names_for_training_classes:
                 return jsonify({'status': 'fail', 'message': 'Display names for training classes not found'}), 400
 
-            display_names_for_training_classes_formatted = [
-                {
-                    'class': dn.get('M', {}).get('class', {}).get('S', ''),
-                    'display_name': dn.get('M', {}).get('display_name', {}).get('S', ''),
-                    'icon': dn.get('M', {}).get('icon', {}).get('S', ''),
-                    'color': dn.get('M', {}).get('color', {}).get('S', '')
-                } for dn in display_names_for_training_classes
-            ]
-
-            print(display_names_for_training_classes_formatted)
-
-            UPLOAD_FOLDER = 'uploads'
-            # Save the uploaded file temporarily
-            local_file_path = os.path.join(
-                UPLOAD_FOLDER, file_storage.filename)
-            file_storage.save(local_file_path)
-
-            # Load the audio file and preprocess it
-            audio, sr = librosa.load(local_file_path)
-            melspec = np.mean(librosa.feature.melspectrogram(
-                y=audio, sr=sr).T, axis=0)
+            display_names_for_training_classes_formatted = format_display_names(
+                display_names_for_training_classes)
+
+            # Byte-identical uploads skip decode, feature extraction and the model call
+            with timer.stage('read_upload'):
+                data = read_upload(file_storage)
+            with timer.stage('cache_lookup'):
+                cache_key = prediction_cache_key(
+                    'predict_with_display_names', job_id, job, backend, content_hash(data))
+                cached_result = prediction_cache.get(cache_key)
+            timer.info['cache_hit'] = cached_result is not None
+            if cached_result is not None:
+                return timed_response(cached_result, timer, request)
+
+            # Decode the uploaded file in memory and preprocess it
+            melspec = feature_pool.extract(data, timer)
             melspec = melspec.reshape(1, 16, 8, 1)
 
-            # Predict using the endpoint
-            response = self.runtime_client.invoke_endpoint(
-                EndpointName=endpoint_name,
-                ContentType='application/json',
-                Body=json.dumps(melspec.tolist())
-            )
-
-            # Decode response
-            result = response['Body'].read().decode('utf-8')
-            prediction_data = json.loads(result)
-            predicted_class = None
-            probability = 0
+            # Predict using the job's inference backend, concurrent requests for the same model share a batch.
+            # A shared batch records its endpoint timings on the request that triggered it.
+            with timer.stage('inference'):
+                predictions = micro_batcher.predict(
+                    backend.identity(job), melspec, lambda batch: backend.predict(job, batch, timer))
+            timer.start_stage('postprocess')
+            prediction_data = {'predictions': predictions.tolist()}
 
             # Obtain the index with the highest score for multiclass, or apply a threshold for binary
-            if len(training_classes) == 2:
+            results = classify_with_display_names(
+                prediction_data['predictions'], training_classes, threshold, display_names_for_training_classes_formatted)
+            predicted_class = results[0]['prediction']
+            probability = results[0]['probability']
+            display_names_for_training_classes = results[0]['display']
 
-                prediction = int(
-                    prediction_data['predictions'][0][0] > float(threshold))
+            result = {'status': 'success', 'prediction': predicted_class, 'probability': probability, 'prediction_data': prediction_data, 'training_classes': training_classes, 'display': display_names_for_training_classes}
+            timer.end_stage('postprocess')
+            prediction_cache.set(cache_key, result)
+            return timed_response(result, timer, request)
 
-                predicted_class = training_classes[prediction]
+        except ClientError as e:
+            return jsonify({'status': 'fail', 'message': e.response['Error']['Message']}), 500
+        except Exception as e:
+            return jsonify({'status': 'fail', 'message': str(e)}), 500
 
-                display_names_for_training_classes = display_names_for_training_classes_formatted[
-                    prediction]
+    def predict_with_display_names_test(self, request):
+        try:
+            job_id = request.args.get('job_id')
+            file_storage = request.files.get('file')
 
-                if predicted_class == 'other':
-                    probability = prediction_data['predictions'][0][0]
-                else:
-                    probability = 1-prediction_data['predictions'][0][0]
+            if not job_id:
+                return jsonify({'status': 'fail', 'message': 'job_id is required'}), 400
+            if not file_storage:
+                return jsonify({'status': 'fail', 'message': 'File is required'}), 400
 
-            else:
-                # maximum prediction should be over the threshold, otherwise send unknown class
-                prediction = np.argmax(prediction_data['predictions'][0])
+            # Check if job_id exists and retrieve class labels
+            timer = StageTimer()
+            with timer.stage('job_lookup'):
+                job = get_job(self.dynamodb_client, job_id)
 
-                predicted_class = training_classes[prediction] if prediction_data['predictions'][0][prediction] > float(
-                    threshold) else 'other'
+            if job is None:
+                return jsonify({'status': 'fail', 'message': 'job_id does not exist'}), 404
+            timer.attach(job_id)
+
+            training_classes = job['training_classes']
+            threshold = job['threshold']
+            display_names_for_training_classes = job['display_names_for_training_classes']
+            timer.info['threshold'] = threshold
 
-                display_names_for_training_classes = display_names_for_training_classes_formatted[
-                    prediction]
+            backend = self.get_backend(job)
+            backend_error = backend.check(job)
+            if backend_error:
+                return jsonify({'status': 'fail', 'message': backend_error}), 404
 
-                # find the other class details from the display_names_for_training_classes
-                if predicted_class == 'other':
-                    for dn in display_names_for_training_classes_formatted:
-                        if dn['class'] == 'other':
-                            display_names_for_training_classes = dn
-                            break
+            if not training_classes:
+                return jsonify({'status': 'fail', 'message': 'Training classes not found'}), 400
+
+            if not display_names_for_training_classes:
+                return jsonify({'status': 'fail', 'message': 'Display names for training classes not found'}), 400
+
+            display_names_for_training_classes_formatted = format_display_names(
+                display_names_for_training_classes)
+
+            # Decode the uploaded file in memory and preprocess it
+            with timer.stage('read_upload'):
+                data = read_upload(file_storage)
+            melspec = feature_pool.extract(data, timer)
+            melspec = melspec.reshape(1, 16, 8, 1)
+
+            # Predict using the job's inference backend
+            with timer.stage('inference'):
+                predictions = backend.predict(job, melspec, timer)
+            timer.start_stage('postprocess')
+            prediction_data = {'predictions': predictions.tolist()}
+
+            # Obtain the index with the highest score for multiclass, or apply a threshold for binary
+            results = classify_with_display_names(
+                prediction_data['predictions'], training_classes, threshold, display_names_for_training_classes_formatted)
+            predicted_class = results[0]['prediction']
+            probability = results[0]['probability']
+            display_names_for_training_classes = results[0]['display']
 
-                probability = prediction_data['predictions'][0][prediction]
+            # 'status': 'success',
+            #     'prediction': predicted_class,
+            #     'prediction_data': prediction_data,
+            #     'training_classes': training_classes,
+            #     'display_names_for_training_classes': display_names_for_training_classes,
+            #     'probability': probability,
+            #     'threshold': threshold
 
-            return jsonify({'status': 'success', 'prediction': predicted_class, 'probability': probability, 'prediction_data': prediction_data, 'training_classes': training_classes, 'display': display_names_for_training_classes}), 200
+            result = {'status': 'success', 'prediction': predicted_class, 'probability': probability, 'prediction_data': prediction_data, 'training_classes': training_classes, 'display': display_names_for_training_classes}
+            timer.end_stage('postprocess')
+            return timed_response(result, timer, request)
 
         except ClientError as e:
             return jsonify({'status': 'fail', 'message': e.response['Error']['Message']}), 500
         except Exception as e:
             return jsonify({'status': 'fail', 'message': str(e)}), 500
-        finally:
-            if local_file_path and os.path.exists(local_file_path):
-                os.remove(local_file_path)
 
-    def predict_with_display_names_test(self, request):
-        local_file_path = None  # Initialize local_file_path to None
+    def predict_batch(self, request):
         try:
-            job_id = request.args.get('job_id')
-            file_storage = request.files.get('file')
+            job_id = request.form.get('job_id')
+            files = request.files.getlist('files')
 
             if not job_id:
                 return jsonify({'status': 'fail', 'message': 'job_id is required'}), 400
-            if not file_storage:
-                return jsonify({'status': 'fail', 'message': 'File is required'}), 400
+            if not files:
+                return jsonify({'status': 'fail', 'message': 'Files are required'}), 400
+            if len(files) > MAX_BATCH_SIZE:
+                return jsonify({'status': 'fail', 'message': f'A batch can contain at most {MAX_BATCH_SIZE} files'}), 400
 
             # Check if job_id exists and retrieve class labels
-            res = self.dynamodb_client.get_item(
-                TableName='jobs', Key={'job_id': {'S': job_id}}
-            )
+            timer = StageTimer()
+            with timer.stage('job_lookup'):
+                job = get_job(self.dynamodb_client, job_id)
 
-            if 'Item' not in res:
+            if job is None:
                 return jsonify({'status': 'fail', 'message': 'job_id does not exist'}), 404
+            timer.attach(job_id)
 
-            item = res['Item']
-            endpoint_name = item.get('endpoint_name', {}).get('S')
-            training_classes = item.get('training_classes', {}).get('SS', [])
-            threshold = item.get('threshold', {}).get('N', 0.5)
-            display_names_for_training_classes = item.get(
-                'display_names_for_training_classes', {}).get('L', [])
-
-            print('the threshold is', threshold)
+            training_classes = job['training_classes']
+            threshold = job['threshold']
+            display_names_for_training_classes = job['display_names_for_training_classes']
+            timer.info['threshold'] = threshold
 
-            if not endpoint_name:
-                return jsonify({'status': 'fail', 'message': 'Endpoint name not found'}), 404
+            backend = self.get_backend(job)
+            backend_error = backend.check(job)
+            if backend_error:
+                return jsonify({'status': 'fail', 'message': backend_error}), 404
 
             if not training_classes:
                 return jsonify({'status': 'fail', 'message': 'Training classes not found'}), 400
@@ -521,91 +735,380 @@ class PredictService:
             if not display_names_for_training_classes:
                 return jsonify({'status': 'fail', 'message': 'Display names for training classes not found'}), 400
 
-            display_names_for_training_classes_formatted = [
-                {
-                    'class': dn.get('M', {}).get('class', {}).get('S', ''),
-                    'display_name': dn.get('M', {}).get('display_name', {}).get('S', ''),
-                    'icon': dn.get('M', {}).get('icon', {}).get('S', ''),
-                    'color': dn.get('M', {}).get('color', {}).get('S', '')
-                } for dn in display_names_for_training_classes
-            ]
-
-            print(display_names_for_training_classes_formatted)
-
-            UPLOAD_FOLDER = 'uploads'
-            # Save the uploaded file temporarily
-            local_file_path = os.path.join(
-                UPLOAD_FOLDER, file_storage.filename)
-            file_storage.save(local_file_path)
-
-            # Load the audio file and preprocess it
-            audio, sr = librosa.load(local_file_path)
-            melspec = np.mean(librosa.feature.melspectrogram(
-                y=audio, sr=sr).T, axis=0)
-            melspec = melspec.reshape(1, 16, 8, 1)
+            display_names_for_training_classes_formatted = format_display_names(
+                display_names_for_training_classes)
+
+            # Extract the features of every file and stack them into one (N, 16, 8, 1) payload
+            with timer.stage('read_upload'):
+                datas = [read_upload(file_storage) for file_storage in files]
+            try:
+                with timer.stage('batch_features'):
+                    melspecs = np.stack(feature_pool.extract_many(datas))
+            except DecodeError as e:
+                return jsonify({'status': 'fail', 'message': f'Could not decode {files[e.index].filename}: {e}'}), 400
+            melspecs = melspecs.reshape(len(files), 16, 8, 1)
+            timer.info['batch_size'] = len(files)
+
+            # Predict the whole batch with a single backend call
+            with timer.stage('inference'):
+                predictions = backend.predict(job, melspecs, timer)
+            check_prediction_count(predictions, len(files))
+            timer.start_stage('postprocess')
+            prediction_data = {'predictions': predictions.tolist()}
+
+            results = classify_with_display_names(
+                prediction_data['predictions'], training_classes, threshold, display_names_for_training_classes_formatted)
+            for file_storage, file_result in zip(files, results):
+                file_result['file'] = file_storage.filename
+
+            result = {'status': 'success', 'results': results, 'prediction_data': prediction_data, 'training_classes': training_classes}
+            timer.end_stage('postprocess')
+            return timed_response(result, timer, request)
 
-            # Predict using the endpoint
-            response = self.runtime_client.invoke_endpoint(
-                EndpointName=endpoint_name,
-                ContentType='application/json',
-                Body=json.dumps(melspec.tolist())
-            )
+        except ClientError as e:
+            return jsonify({'status': 'fail', 'message': e.response['Error']['Message']}), 500
+        except Exception as e:
+            return jsonify({'status': 'fail', 'message': str(e)}), 500
 
-            # Decode response
-            result = response['Body'].read().decode('utf-8')
-            prediction_data = json.loads(result)
-            predicted_class = None
-            probability = 0
+    def predict_features(self, request):
+        # Predict from 128-bin mel vectors computed by the client, sent as a JSON body
+        # {'job_id', 'features'} or as an .npy body with the job_id in the query string
+        try:
+            if base_content_type(request.content_type) == NPY_CONTENT_TYPE:
+                job_id = request.args.get('job_id')
+                features = request.get_data()
+            else:
+                body = request.get_json(silent=True) or {}
+                job_id = body.get('job_id')
+                features = body.get('features')
 
-            # Obtain the index with the highest score for multiclass, or apply a threshold for binary
-            if len(training_classes) == 2:
+            if not job_id:
+                return jsonify({'status': 'fail', 'message': 'job_id is required'}), 400
+            if not features:
+                return jsonify({'status': 'fail', 'message': 'features are required'}), 400
 
-                prediction = int(
-                    prediction_data['predictions'][0][0] > float(threshold))
+            timer = StageTimer()
+            try:
+                with timer.stage('parse_features'):
+                    if isinstance(features, bytes):
+                        features = decode_npy(features)
+                    melspecs, single = as_feature_batch(features)
+            except ValueError as e:
+                return jsonify({'status': 'fail', 'message': str(e)}), 400
 
-                predicted_class = training_classes[prediction]
+            if len(melspecs) > MAX_BATCH_SIZE:
+                return jsonify({'status': 'fail', 'message': f'A batch can contain at most {MAX_BATCH_SIZE} feature vectors'}), 400
 
-                display_names_for_training_classes = display_names_for_training_classes_formatted[
-                    prediction]
+            # Check if job_id exists and retrieve class labels
+            with timer.stage('job_lookup'):
+                job = get_job(self.dynamodb_client, job_id)
 
-                if predicted_class == 'other':
-                    probability = prediction_data['predictions'][0][0]
+            if job is None:
+                return jsonify({'status': 'fail', 'message': 'job_id does not exist'}), 404
+            timer.attach(job_id)
+
+            training_classes = job['training_classes']
+            threshold = job['threshold']
+            display_names_for_training_classes = job['display_names_for_training_classes']
+            timer.info['threshold'] = threshold
+
+            backend = self.get_backend(job)
+            backend_error = backend.check(job)
+            if backend_error:
+                return jsonify({'status': 'fail', 'message': backend_error}), 404
+
+            if not training_classes:
+                return jsonify({'status': 'fail', 'message': 'Training classes not found'}), 400
+
+            if not display_names_for_training_classes:
+                return jsonify({'status': 'fail', 'message': 'Display names for training classes not found'}), 400
+
+            display_names_for_training_classes_formatted = format_display_names(
+                display_names_for_training_classes)
+
+            # No decode or feature stage, a single vector can share a micro-batch with other requests
+            with timer.stage('inference'):
+                if single:
+                    predictions = micro_batcher.predict(
+                        backend.identity(job), melspecs, lambda batch: backend.predict(job, batch, timer))
                 else:
-                    probability = 1-prediction_data['predictions'][0][0]
+                    predictions = backend.predict(job, melspecs, timer)
+            check_prediction_count(predictions, len(melspecs))
+            timer.start_stage('postprocess')
+            prediction_data = {'predictions': predictions.tolist()}
+
+            results = classify_with_display_names(
+                prediction_data['predictions'], training_classes, threshold, display_names_for_training_classes_formatted)
 
+            if single:
+                result = {'status': 'success', 'prediction': results[0]['prediction'], 'probability': results[0]['probability'], 'prediction_data': prediction_data, 'training_classes': training_classes, 'display': results[0]['display']}
             else:
-                # maximum prediction should be over the threshold, otherwise send unknown class
-                prediction = np.argmax(prediction_data['predictions'][0])
+                result = {'status': 'success', 'results': results, 'prediction_data': prediction_data, 'training_classes': training_classes}
+            timer.end_stage('postprocess')
+            return timed_response(result, timer, request)
 
-                predicted_class = training_classes[prediction] if prediction_data['predictions'][0][prediction] > float(
-                    threshold) else 'other'
+        except ClientError as e:
+            return jsonify({'status': 'fail', 'message': e.response['Error']['Message']}), 500
+        except Exception as e:
+            return jsonify({'status': 'fail', 'message': str(e)}), 500
 
-                display_names_for_training_classes = display_names_for_training_classes_formatted[
-                    prediction]
+    def predict_one_of_ensemble(self, job, melspec):
+        # Result of one approved model, failures are reported per model instead of failing the request
+        try:
+            backend = self.get_backend(job)
+            error = backend.check(job)
+            if not error and not job['training_classes']:
+                error = 'Training classes not found'
+            if not error and not job['display_names_for_training_classes']:
+                error = 'Display names for training classes not found'
+            if error:
+                return {'status': 'fail', 'job_id': job['job_id'], 'message': error}
+
+            predictions = micro_batcher.predict(
+                backend.identity(job), melspec, lambda batch: backend.predict(job, batch))
+            result = classify_with_display_names(
+                predictions, job['training_classes'], job['threshold'],
+                format_display_names(job['display_names_for_training_classes']))[0]
+            result.update({'status': 'success', 'job_id': job['job_id'], 'approve_name': job['approve_name'],
+                           'threshold': job['threshold'], 'predictions': predictions[0].tolist(),
+                           'training_classes': job['training_classes']})
+            return result
 
-                # find the other class details from the display_names_for_training_classes
-                if predicted_class == 'other':
-                    for dn in display_names_for_training_classes_formatted:
-                        if dn['class'] == 'other':
-                            display_names_for_training_classes = dn
-                            break
+        except ClientError as e:
+            return {'status': 'fail', 'job_id': job['job_id'], 'message': e.response['Error']['Message']}
+        except Exception as e:
+            return {'status': 'fail', 'job_id': job['job_id'], 'message': str(e)}
 
-                probability = prediction_data['predictions'][0][prediction]
+    def predict_ensemble(self, request):
+        # Score one upload with every approved model, or with the approved job_ids given
+        try:
+            file_storage = request.files.get('file')
+            job_ids = [job_id.strip() for job_id in request.form.get('job_ids', '').split(',') if job_id.strip()]
 
-            # 'status': 'success',
-            #     'prediction': predicted_class,
-            #     'prediction_data': prediction_data,
-            #     'training_classes': training_classes,
-            #     'display_names_for_training_classes': display_names_for_training_classes,
-            #     'probability': probability,
-            #     'threshold': threshold
+            if not file_storage:
+                return jsonify({'status': 'fail', 'message': 'File is required'}), 400
 
-            return jsonify({'status': 'success', 'prediction': predicted_class, 'probability': probability, 'prediction_data': prediction_data, 'training_classes': training_classes, 'display': display_names_for_training_classes}), 200
+            timer = StageTimer()
+            with timer.stage('job_lookup'):
+                jobs = get_approved_job_records(self.dynamodb_client)
+            if job_ids:
+                jobs = [job for job in jobs if job['job_id'] in job_ids]
+
+            if not jobs:
+                return jsonify({'status': 'fail', 'message': 'No approved jobs found'}), 404
+
+            # Features are extracted once and shared by every model
+            with timer.stage('read_upload'):
+                data = read_upload(file_storage)
+            try:
+                melspec = feature_pool.extract(data, timer).reshape(1, 16, 8, 1)
+            except DecodeError as e:
+                return jsonify({'status': 'fail', 'message': f'Could not decode {file_storage.filename}: {e}'}), 400
+
+            # The endpoint calls run concurrently, the request takes as long as the slowest model
+            with timer.stage('inference'), ThreadPoolExecutor(
+                    max_workers=min(len(jobs), ENSEMBLE_MAX_WORKERS), thread_name_prefix='ensemble') as executor:
+                results = list(executor.map(
+                    lambda job: self.predict_one_of_ensemble(job, melspec), jobs))
+
+            result = dict(aggregate_ensemble(results), status='success', models=results)
+            return timed_response(result, timer, request)
 
         except ClientError as e:
             return jsonify({'status': 'fail', 'message': e.response['Error']['Message']}), 500
         except Exception as e:
             return jsonify({'status': 'fail', 'message': str(e)}), 500
-        finally:
-            if local_file_path and os.path.exists(local_file_path):
-                os.remove(local_file_path)
+
+    def predict_windows(self, request):
+        try:
+            job_id = request.form.get('job_id')
+            file_storage = request.files.get('file')
+
+            if not job_id:
+                return jsonify({'status': 'fail', 'message': 'job_id is required'}), 400
+            if not file_storage:
+                return jsonify({'status': 'fail', 'message': 'File is required'}), 400
+
+            try:
+                window_seconds = float(request.form.get('window_seconds', 1.0))
+                hop_seconds = float(request.form.get('hop_seconds', window_seconds / 2))
+            except ValueError:
+                return jsonify({'status': 'fail', 'message': 'window_seconds and hop_seconds must be numbers'}), 400
+
+            if not 0 < window_seconds <= 60:
+                return jsonify({'status': 'fail', 'message': 'window_seconds must be between 0 and 60'}), 400
+            if not 0 < hop_seconds <= window_seconds:
+                return jsonify({'status': 'fail', 'message': 'hop_seconds must be between 0 and window_seconds'}), 400
+
+            # Check if job_id exists and retrieve class labels
+            timer = StageTimer()
+            with timer.stage('job_lookup'):
+                job = get_job(self.dynamodb_client, job_id)
+
+            if job is None:
+                return jsonify({'status': 'fail', 'message': 'job_id does not exist'}), 404
+            timer.attach(job_id)
+
+            training_classes = job['training_classes']
+            threshold = job['threshold']
+            display_names_for_training_classes = job['display_names_for_training_classes']
+            timer.info['threshold'] = threshold
+
+            backend = self.get_backend(job)
+            backend_error = backend.check(job)
+            if backend_error:
+                return jsonify({'status': 'fail', 'message': backend_error}), 404
+
+            if not training_classes:
+                return jsonify({'status': 'fail', 'message': 'Training classes not found'}), 400
+
+            if not display_names_for_training_classes:
+                return jsonify({'status': 'fail', 'message': 'Display names for training classes not found'}), 400
+
+            display_names_for_training_classes_formatted = format_display_names(
+                display_names_for_training_classes)
+
+            timeline = []
+            spans = []
+            melspecs = np.empty((WINDOW_BATCH_SIZE, 128), dtype=np.float32)
+
+            # Decoding and feature extraction interleave with the model calls, each is recorded
+            # once for the whole recording
+            elapsed = {'window_features': 0.0, 'inference': 0.0}
+
+            def predict_pending():
+                # Send the buffered windows to the model as one batch
+                start = time.perf_counter()
+                predictions = backend.predict(
+                    job, melspecs[:len(spans)].reshape(len(spans), 16, 8, 1), timer)
+                elapsed['inference'] += time.perf_counter() - start
+                check_prediction_count(predictions, len(spans))
+                results = classify_with_display_names(
+                    predictions, training_classes, threshold, display_names_for_training_classes_formatted)
+                for (start, end), row, result in zip(spans, predictions, results):
+                    result.update({'start': round(start, 3), 'end': round(end, 3),
+                                   'probabilities': row.tolist()})
+                    timeline.append(result)
+                spans.clear()
+
+            file_storage.stream.seek(0)
+            windows = iter_window_features(file_storage.stream, window_seconds, hop_seconds)
+            while True:
+                started = time.perf_counter()
+                try:
+                    window = next(windows, None)
+                except Exception as e:
+                    return jsonify({'status': 'fail', 'message': f'Could not decode {file_storage.filename}: {e}'}), 400
+                elapsed['window_features'] += time.perf_counter() - started
+                if window is None:
+                    break
+                start, end, melspec = window
+                melspecs[len(spans)] = melspec
+                spans.append((start, end))
+                if len(spans) == WINDOW_BATCH_SIZE:
+                    predict_pending()
+
+            if spans:
+                predict_pending()
+            for stage, seconds in elapsed.items():
+                timer.record(stage, seconds)
+
+            if not timeline:
+                return jsonify({'status': 'fail', 'message': 'The recording is empty'}), 400
+
+            timer.info['windows'] = len(timeline)
+            result = {'status': 'success', 'window_seconds': window_seconds, 'hop_seconds': hop_seconds, 'timeline': timeline, 'segments': merge_window_segments(timeline), 'training_classes': training_classes}
+            return timed_response(result, timer, request)
+
+        except ClientError as e:
+            return jsonify({'status': 'fail', 'message': e.response['Error']['Message']}), 500
+        except Exception as e:
+            return jsonify({'status': 'fail', 'message': str(e)}), 500
+
+    def stream_predict(self, ws, request):
+        # Raw mono PCM arrives as binary messages, a prediction is pushed back every hop.
+        # The job is resolved once when the connection opens.
+        def fail(message):
+            ws.send(json.dumps({'status': 'fail', 'message': message}))
+
+        try:
+            job_id = request.args.get('job_id')
+            sample_format = request.args.get('format', 'pcm_s16le')
+
+            if not job_id:
+                return fail('job_id is required')
+            if sample_format not in PCM_FORMATS:
+                return fail(f'format must be one of {list(PCM_FORMATS)}')
+
+            try:
+                sample_rate = int(request.args.get('sample_rate', 16000))
+                window_seconds = float(request.args.get('window_seconds', 1.0))
+                hop_seconds = float(request.args.get('hop_seconds', window_seconds / 2))
+            except ValueError:
+                return fail('sample_rate, window_seconds and hop_seconds must be numbers')
+
+            if not 8000 <= sample_rate <= 192000:
+                return fail('sample_rate must be between 8000 and 192000')
+            if not 0 < window_seconds <= 60:
+                return fail('window_seconds must be between 0 and 60')
+            if not 0 < hop_seconds <= window_seconds:
+                return fail('hop_seconds must be between 0 and window_seconds')
+
+            job = get_job(self.dynamodb_client, job_id)
+
+            if job is None:
+                return fail('job_id does not exist')
+
+            training_classes = job['training_classes']
+            threshold = job['threshold']
+            display_names_for_training_classes = job['display_names_for_training_classes']
+
+            backend = self.get_backend(job)
+            backend_error = backend.check(job)
+            if backend_error:
+                return fail(backend_error)
+
+            if not training_classes:
+                return fail('Training classes not found')
+
+            if not display_names_for_training_classes:
+                return fail('Display names for training classes not found')
+
+            display_names_for_training_classes_formatted = format_display_names(
+                display_names_for_training_classes)
+
+            stream = StreamingFeatures(sample_rate, sample_format, window_seconds, hop_seconds)
+            ws.send(json.dumps({'status': 'success', 'type': 'ready', 'window_seconds': window_seconds, 'hop_seconds': hop_seconds, 'training_classes': training_classes}))
+
+            while True:
+                message = ws.receive()
+                if message is None or message == 'end':
+                    break
+                if isinstance(message, str):
+                    continue
+
+                windows = stream.feed(message)
+                if not windows:
+                    continue
+
+                # Windows completed by the same message share one model call
+                start = time.perf_counter()
+                melspecs = np.stack([features for _, _, features in windows])
+                predictions = backend.predict(job, melspecs.reshape(len(windows), 16, 8, 1))
+                check_prediction_count(predictions, len(windows))
+
+                elapsed = time.perf_counter() - start
+                metrics.observe('stream_inference', elapsed, job_id)
+
+                results = classify_with_display_names(
+                    predictions, training_classes, threshold, display_names_for_training_classes_formatted)
+                prediction_logger.log(request.path, job_id, {'results': results, 'prediction_data': {'predictions': predictions.tolist()}}, elapsed * 1000)
+                for (window_start, window_end, _), result in zip(windows, results):
+                    result.update({'status': 'success', 'type': 'prediction',
+                                   'start': round(window_start, 3), 'end': round(window_end, 3)})
+                    ws.send(json.dumps(result))
+
+        except ClientError as e:
+            fail(e.response['Error']['Message'])
+        except Exception as e:
+            fail(str(e))
@@ -0,0 +1,20 @@
+import hashlib
+import json
+from .caching import TTLCache
+
+# Responses of repeated, byte-identical uploads. The key carries everything the result
+# depends on, so a threshold, endpoint or label change simply stops matching old entries.
+prediction_cache = TTLCache(maxsize=4096, ttl=3600)
+
+
+def content_hash(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def labels_fingerprint(job):
+    labels = [job['training_classes'], job['display_names_for_training_classes']]
+    return hashlib.blake2b(json.dumps(labels, sort_keys=True).encode(), digest_size=8).hexdigest()
+
+
+def prediction_cache_key(variant, job_id, job, backend, data_hash):
+    return (variant, job_id, backend.identity(job), str(job['threshold']), labels_fingerprint(job), data_hash)
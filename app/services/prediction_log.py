@@ -0,0 +1,234 @@
+import atexit
+import gzip
+import json
+import os
+import queue
+import signal
+import time
+from datetime import datetime, timezone
+from threading import Event, Lock, Thread, current_thread, main_thread
+
+_CLOSE = object()
+
+
+def prediction_records(entry):
+    # One NDJSON record per predicted row of a predict response. Runs on the logger thread,
+    # the request path only queues the response as it was returned.
+    route, job_id, result, latency_ms, cache_hit, logged_at = entry
+    base = {'timestamp': logged_at, 'route': route, 'latency_ms': latency_ms, 'cache_hit': cache_hit}
+
+    if 'timeline' in result:
+        # sliding windows, one record per window
+        return [dict(base, job_id=job_id, prediction=window['prediction'],
+                     probability=window['probability'], probabilities=window['probabilities'],
+                     start=window['start'], end=window['end'])
+                for window in result['timeline']]
+
+    if 'models' in result:
+        # ensemble, one record per model that answered
+        return [dict(base, job_id=model['job_id'], prediction=model['prediction'],
+                     probability=model['probability'], probabilities=model['predictions'])
+                for model in result['models'] if model['status'] == 'success']
+
+    rows = result.get('prediction_data', {}).get('predictions', [])
+    if 'results' in result:
+        return [dict(base, job_id=job_id, prediction=row_result['prediction'],
+                     probability=row_result['probability'], probabilities=row,
+                     file=row_result.get('file'))
+                for row_result, row in zip(result['results'], rows)]
+
+    return [dict(base, job_id=job_id, prediction=result.get('prediction'),
+                 probability=result.get('probability'), probabilities=rows[0] if rows else None)]
+
+
+class PredictionLogger:
+    # Records every prediction for drift monitoring without touching the request latency.
+    # Predict methods put their response on a bounded queue and return, a background thread
+    # turns them into records and writes gzip NDJSON batches to
+    # s3://<bucket>/<prefix>/date=YYYY-MM-DD/<time>-<pid>-<n>.ndjson.gz once batch_size records
+    # are buffered or flush_seconds have passed. A full queue drops the prediction and counts it.
+    # What is buffered is flushed at interpreter exit and on SIGTERM, which is how `flask run`
+    # is stopped in a container and does not run atexit handlers.
+    def __init__(self, queue_size=10000, batch_size=1000, flush_seconds=60, prefix='prediction_logs'):
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.prefix = prefix
+        self.s3_client = None
+        self.bucket_name = None
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._closing = Event()
+        self._atexit_registered = False
+        self._sigterm_registered = False
+        self._lock = Lock()
+        self._files = 0
+        self.queued = 0
+        self.dropped = 0
+        self.records = 0
+        self.batches = 0
+        self.failed_batches = 0
+        self.failed_records = 0
+
+    def configure(self, s3_client=None, bucket_name=None, queue_size=10000, batch_size=1000,
+                  flush_seconds=60, prefix='prediction_logs'):
+        self.close()
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.prefix = prefix
+        self._queue = queue.Queue(maxsize=max(queue_size, 0))
+        self._closing.clear()
+        if self.enabled:
+            self._register_sigterm()
+
+    def _register_sigterm(self):
+        # Signal handlers can only be set from the main thread, where create_app runs
+        if self._sigterm_registered or current_thread() is not main_thread():
+            return
+        previous = signal.getsignal(signal.SIGTERM)
+
+        def on_sigterm(signum, frame):
+            self.close()
+            if callable(previous):
+                previous(signum, frame)
+            elif previous != signal.SIG_IGN:
+                # terminate the way SIGTERM would have without the handler
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                os.kill(os.getpid(), signum)
+
+        signal.signal(signal.SIGTERM, on_sigterm)
+        self._sigterm_registered = True
+
+    @property
+    def enabled(self):
+        return self.queue_size > 0 and self.s3_client is not None and bool(self.bucket_name)
+
+    def log(self, route, job_id, result, latency_ms, cache_hit=False):
+        if not self.enabled:
+            return
+        queued = False
+        if not self._closing.is_set():
+            self._start()
+            try:
+                self._queue.put_nowait((route, job_id, result, latency_ms, cache_hit,
+                                        datetime.now(timezone.utc).isoformat()))
+                queued = True
+            except queue.Full:
+                pass
+        with self._lock:
+            if queued:
+                self.queued += 1
+            else:
+                self.dropped += 1
+
+    def _start(self):
+        # Started on first use, so app startup can still fork the feature pool workers
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = Thread(target=self._run, daemon=True, name='prediction-logger')
+                self._thread.start()
+                if not self._atexit_registered:
+                    atexit.register(self.close)
+                    self._atexit_registered = True
+
+    def _run(self):
+        batch = []
+        deadline = None
+        while True:
+            # once closing, the queue is drained without waiting and the logger stops when empty
+            closing = self._closing.is_set()
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                entry = self._queue.get(block=not closing, timeout=timeout)
+            except queue.Empty:
+                if closing:
+                    self._flush(batch)
+                    return
+                entry = None
+
+            if entry is _CLOSE:
+                # only wakes the logger up
+                entry = None
+            if entry is not None:
+                try:
+                    batch.extend(prediction_records(entry))
+                except Exception as e:
+                    with self._lock:
+                        self.failed_records += 1
+                    print(f'Prediction log: could not record a {entry[0]} response: {e!r}')
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_seconds
+
+            if len(batch) >= self.batch_size or (deadline is not None and time.monotonic() >= deadline):
+                self._flush(batch)
+                batch = []
+                deadline = None
+
+    def _flush(self, batch):
+        if not batch:
+            return
+        body = gzip.compress(
+            ''.join(json.dumps(record) + '\n' for record in batch).encode(), compresslevel=6)
+        now = datetime.now(timezone.utc)
+        self._files += 1
+        key = (f'{self.prefix}/date={now:%Y-%m-%d}/'
+               f'{now:%H%M%S%f}-{os.getpid()}-{self._files}.ndjson.gz')
+        try:
+            self.s3_client.put_object(Bucket=self.bucket_name, Key=key, Body=body,
+                                      ContentType='application/x-ndjson', ContentEncoding='gzip')
+            with self._lock:
+                self.records += len(batch)
+                self.batches += 1
+        except Exception as e:
+            with self._lock:
+                self.failed_batches += 1
+            print(f'Prediction log: could not write {len(batch)} records to {key}: {e!r}')
+
+    def close(self, timeout=10):
+        # Flushes what is buffered, called at interpreter exit and on SIGTERM. Predictions
+        # logged from now on are dropped, what the logger could not write within timeout
+        # is counted as dropped too.
+        thread = self._thread
+        if thread is None:
+            return
+        self._closing.set()
+        try:
+            self._queue.put_nowait(_CLOSE)
+        except queue.Full:
+            # the logger is busy and sees the flag after its current entry
+            pass
+        thread.join(timeout)
+        if thread.is_alive():
+            lost = 0
+            while True:
+                try:
+                    entry = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if entry is not _CLOSE:
+                    lost += 1
+            with self._lock:
+                self.dropped += lost
+            print(f'Prediction log: {lost} predictions were not written before shutdown')
+        self._thread = None
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'queued': self.queued,
+                'pending': self._queue.qsize(),
+                'dropped': self.dropped,
+                'records': self.records,
+                'batches': self.batches,
+                'failed_batches': self.failed_batches,
+                'failed_records': self.failed_records
+            }
+
+
+prediction_logger = PredictionLogger()
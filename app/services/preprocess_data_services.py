@@ -5,6 +5,7 @@ import time
 from botocore.exceptions import ClientError
 import random
 import string
+from .job_cache import invalidate_job
 
 instances = [
     "ml.r5d.large", "ml.r5d.xlarge", "ml.r5d.2xlarge", "ml.r5d.4xlarge", "ml.r5d.8xlarge", "ml.r5d.12xlarge", "ml.r5d.16xlarge", "ml.r5d.24xlarge",
@@ -730,6 +731,7 @@ class PreprocessingService:
                     TableName='jobs',
                     Key={'job_id': {'S': job_id}}
                 )
+                invalidate_job(job_id)
 
             return jsonify({'status': 'success', 'message': 'Job deleted successfully'}), 200
 
@@ -0,0 +1,71 @@
+import numpy as np
+import scipy.fft
+import soxr
+from .audio_features import feature_extractor, soxr_quality
+
+# Raw PCM layouts accepted from streaming clients, mono and little-endian
+PCM_FORMATS = {'pcm_s16le': ('<i2', 1 / 32768), 'pcm_f32le': ('<f4', 1.0)}
+
+
+class StreamingFeatures:
+    # Incremental version of the window features for a continuous PCM stream.
+    # Every STFT frame of the stream is transformed once, its power spectrum goes into a ring
+    # buffer holding one window of frames, and a window's feature vector is the mel projection
+    # of the ring's mean, like MelFeatureExtractor.extract() over the window's samples.
+    # Frames are not zero padded at the window edges, so the first and last frame of a window
+    # differ slightly from extract() on the cut-out clip.
+    def __init__(self, client_sample_rate, sample_format='pcm_s16le', window_seconds=1.0,
+                 hop_seconds=0.5, extractor=feature_extractor):
+        self.extractor = extractor
+        self.dtype, self.scale = PCM_FORMATS[sample_format]
+        self.sample_rate = extractor.sample_rate or client_sample_rate
+        self.resampler = None
+        if self.sample_rate != client_sample_rate:
+            self.resampler = soxr.ResampleStream(
+                client_sample_rate, self.sample_rate, 1, dtype='float32',
+                quality=soxr_quality(extractor.res_type))
+
+        self.window_seconds = window_seconds
+        self.frames_per_window = 1 + int(round(window_seconds * self.sample_rate)) // extractor.hop_length
+        self.hop_frames = max(1, int(round(hop_seconds * self.sample_rate / extractor.hop_length)))
+
+        self.spectra = np.zeros((self.frames_per_window, extractor.n_fft // 2 + 1), dtype=np.float64)
+        self.frames = 0  # STFT frames seen on this stream
+        self.since_emit = 0
+        self.pending = np.empty(0, dtype=np.float32)  # samples not consumed by a frame yet
+        self._carry = b''  # trailing bytes of a sample split across messages
+
+    def feed(self, data):
+        # Returns [(start, end, features)] for every window completed by this chunk of PCM
+        data = self._carry + data
+        itemsize = np.dtype(self.dtype).itemsize
+        usable = len(data) - len(data) % itemsize
+        self._carry = data[usable:]
+        audio = np.frombuffer(data[:usable], dtype=self.dtype).astype(np.float32) * self.scale
+        if self.resampler is not None:
+            audio = self.resampler.resample_chunk(audio)
+
+        n_fft, hop_length = self.extractor.n_fft, self.extractor.hop_length
+        self.pending = np.concatenate([self.pending, audio])
+        if len(self.pending) < n_fft:
+            return []
+
+        n_frames = 1 + (len(self.pending) - n_fft) // hop_length
+        frames = np.lib.stride_tricks.sliding_window_view(
+            self.pending, n_fft)[::hop_length][:n_frames]
+        spectrum = scipy.fft.rfft(frames * self.extractor.window(n_fft), axis=1)
+        power = spectrum.real ** 2 + spectrum.imag ** 2
+        self.pending = self.pending[n_frames * hop_length:]
+
+        windows = []
+        mel_basis = self.extractor.mel_basis(self.sample_rate, n_fft, self.extractor.n_mels)
+        for frame_power in power:
+            self.spectra[self.frames % self.frames_per_window] = frame_power
+            self.frames += 1
+            self.since_emit += 1
+            if self.frames >= self.frames_per_window and self.since_emit >= self.hop_frames:
+                self.since_emit = 0
+                end = ((self.frames - 1) * hop_length + n_fft) / self.sample_rate
+                features = mel_basis @ self.spectra.mean(axis=0).astype(np.float32)
+                windows.append((max(0.0, end - self.window_seconds), end, features))
+        return windows
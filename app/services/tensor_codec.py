@@ -0,0 +1,72 @@
+import io
+import json
+import numpy as np
+
+JSON_CONTENT_TYPE = 'application/json'
+NPY_CONTENT_TYPE = 'application/x-npy'
+CONTENT_TYPES = [JSON_CONTENT_TYPE, NPY_CONTENT_TYPE]
+
+# One model input row, the 128-bin time-averaged mel vector
+FEATURE_SIZE = 128
+FEATURE_SHAPE = (16, 8, 1)
+
+
+def base_content_type(content_type):
+    # 'application/json; charset=utf-8' -> 'application/json'
+    return (content_type or '').split(';')[0].strip().lower()
+
+
+def encode_tensor(array, content_type=JSON_CONTENT_TYPE):
+    if base_content_type(content_type) == NPY_CONTENT_TYPE:
+        # little-endian float32 with the .npy shape header, no float-to-text conversion
+        buffer = io.BytesIO()
+        np.save(buffer, np.ascontiguousarray(array, dtype='<f4'))
+        return buffer.getvalue()
+    return json.dumps(array.tolist())
+
+
+def decode_npy(body):
+    # Parse the .npy header and wrap the payload without copying it
+    stream = io.BytesIO(body)
+    version = np.lib.format.read_magic(stream)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(stream)
+    else:
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(stream)
+
+    count = int(np.prod(shape))
+    array = np.frombuffer(body, dtype=dtype, count=count, offset=stream.tell())
+    return array.reshape(shape, order='F' if fortran_order else 'C')
+
+
+def decode_predictions(body, content_type=JSON_CONTENT_TYPE):
+    # Returns the (N, classes) prediction matrix of an endpoint response
+    if base_content_type(content_type) == NPY_CONTENT_TYPE:
+        return decode_npy(body)
+
+    result = json.loads(body)
+    if isinstance(result, dict):
+        result = result['predictions']
+    return np.asarray(result, dtype=np.float64)
+
+
+def as_feature_batch(features):
+    # Accepts one vector as (128,) or (16, 8, 1), or a batch as (N, 128) or (N, 16, 8, 1).
+    # Returns the float32 (N, 16, 8, 1) model input and whether a single vector was sent.
+    array = np.asarray(features)
+    if array.dtype.kind not in 'fiu':
+        raise ValueError('features must be numbers')
+
+    if array.shape in ((FEATURE_SIZE,), FEATURE_SHAPE):
+        single = True
+        array = array.reshape(1, *FEATURE_SHAPE)
+    elif len(array.shape) > 1 and array.shape[0] and array.shape[1:] in ((FEATURE_SIZE,), FEATURE_SHAPE):
+        single = False
+    else:
+        raise ValueError(
+            f'features must have shape (128,), (16, 8, 1), (N, 128) or (N, 16, 8, 1), got {array.shape}')
+
+    array = array.astype(np.float32, copy=False).reshape(len(array), *FEATURE_SHAPE)
+    if not np.isfinite(array).all():
+        raise ValueError('features must be finite')
+    return array, single
@@ -5,6 +5,7 @@ import time
 from botocore.exceptions import ClientError
 import random
 import string
+from .job_cache import invalidate_job
 
 instances = [
     "ml.r5d.large", "ml.r5d.xlarge", "ml.r5d.2xlarge", "ml.r5d.4xlarge", "ml.r5d.8xlarge", "ml.r5d.12xlarge", "ml.r5d.16xlarge", "ml.r5d.24xlarge",
@@ -300,6 +301,7 @@ class TrainingService:
                 Key={'job_id': {'S': job_id}},
                 UpdateExpression="REMOVE sagemaker_train_job_name, train_architecture_type, train_instance_type, train_instance_count, train_date, training_classes, classification_report, accuracy, hyperparameters"
             )
+            invalidate_job(job_id)
 
             return jsonify({'status': 'success', 'message': 'Training job deleted successfully'}), 200
 
@@ -5,13 +5,24 @@ from concurrent.futures import ThreadPoolExecutor
 from threading import Lock
 from botocore.config import Config as BotoConfig
 import io
+import math
 import random
+import uuid
+from contextlib import ExitStack
+from botocore.exceptions import ClientError
+from .hash_index import ClassHashIndex, ClassBusyError, class_lock_or_busy, delete_class_index
+from .ingest_jobs import IngestJob, ingest_jobs
+from .zip_ingest import (zip_ingester, spool, audio_members, archive_error, class_name_error, staging_key,
+                         is_staging_key, part_size_for, uploaded_parts, open_s3_object, MAX_PARTS)
 
 
 class DataService:
-    def __init__(self, s3_client, bucket_name):
+    def __init__(self, s3_client, bucket_name, part_size=64 * 1024 * 1024, url_expires=3600):
         self.s3_client = s3_client
         self.bucket_name = bucket_name
+        # direct-to-S3 uploads of sounds.zip
+        self.part_size = part_size
+        self.url_expires = url_expires
 
     # def upload_zip_slow(self, request):
     #     # zip file
@@ -71,6 +82,8 @@ class DataService:
         class_name = request.form.get("class_name")
         if not class_name:
             return jsonify({"status": "fail", "message": "There are no class_name key in the request body"}), 400
+        if class_name_error(class_name):
+            return jsonify({"status": "fail", "message": class_name_error(class_name)}), 400
 
         try:
             if file and zipfile.is_zipfile(file):
@@ -78,71 +91,265 @@ class DataService:
                 if file.filename != "sounds.zip":
                     return jsonify({"status": "fail", "message": "The uploaded file name should be sounds.zip"}), 400
 
-                # Load zipfile contents in the main thread
-                z = zipfile.ZipFile(file)
-
-                if len(z.namelist()) == 1:
-                    return jsonify({"status": "fail", "message": "No files in the zip file"}), 400
-
-                for index, filename in enumerate(z.namelist()):
-                    if len(filename.split("/")) != 2:
-                        return jsonify({"status": "fail", "message": f"Invalid file structure: {filename}"}), 400
-                    if not filename.endswith(".wav") and index != 0:
-                        return jsonify({"status": "fail", "message": f"Invalid file type in zip: {filename}"}), 400
-
-                # Use ThreadPoolExecutor to upload files concurrently
-                upload_count = 0
-
-                def upload_file_to_s3(s3_client, bucket_name, class_name, zip_file_bytes, filename):
-                    nonlocal upload_count
-                    try:
-                        key_file_name = filename.split("/")[1]
-                        s3_key = f"zip_data/{class_name}/{key_file_name}"
-
-                        with zipfile.ZipFile(io.BytesIO(zip_file_bytes)) as z:
-                            with z.open(filename) as extracted_file:
-                                s3_client.upload_fileobj(
-                                    extracted_file, bucket_name, s3_key)
-                                # Increment count on successful upload
-                                upload_count += 1
-                                print(upload_count)
-                    except Exception as e:
-                        print(f"Error uploading {filename}: {e}")
-
-                # Read the zip file into a bytes object
-                file.seek(0)  # Reset file pointer to the beginning
-                zip_file_bytes = file.read()
-
-                with ThreadPoolExecutor(max_workers=5) as executor:
-                    futures = []
-
-                    for filename in z.namelist():
-                        if len(filename.split("/")) == 2 and filename.split("/")[1] != "":
-                            futures.append(executor.submit(
-                                upload_file_to_s3, self.s3_client, self.bucket_name, class_name, zip_file_bytes, filename))
-
-                    # Wait for all uploads to complete
-                    [future.result() for future in futures]
-
-                # Fetch the total count of audio files for the class
-                response = self.s3_client.list_objects_v2(
-                    Bucket=self.bucket_name, Prefix=f'zip_data/{class_name}/')
-
-                total_count = sum(1 for obj in response.get(
-                    'Contents', []) if obj['Key'].endswith('.wav'))
-
-                return jsonify({
-                    "status": "success",
-                    "message": f"All files uploaded successfully. {upload_count} files were uploaded.",
-                    'uploaded_count': upload_count,
-                    'total_count': total_count  # Add the total count of audio files for the class
-                }), 201
+                # Parse the central directory once, from the spooled upload rather than a copy in memory.
+                # The ingest owns the spooled file from here, the end of the request must not close
+                # it under a background job.
+                stream = file.stream
+                archive = spool(stream)
+                file.stream = io.BytesIO()
+                z = zipfile.ZipFile(archive)
+
+                def cleanup():
+                    # archive may be the file inside stream, which closes it when collected
+                    archive.close()
+                    stream.close()
+
+                error = archive_error(z)
+                if error:
+                    z.close()
+                    cleanup()
+                    return jsonify({"status": "fail", "message": error}), 400
+
+                return self.ingest_archive(z, class_name, cleanup)
             else:
                 return jsonify({"status": "fail", "message": "The uploaded file is not a zip file"}), 400
         except Exception as e:
             print(e)
             return str(e), 500
 
+    def ingest_archive(self, z, class_name, cleanup=None, on_success=None):
+        # Archives below the background threshold are ingested in the request, bigger ones by
+        # a background job the client polls with get_ingest_job. cleanup runs however the
+        # ingest ends, on_success only when every member was ingested.
+        members = audio_members(z)
+        job = IngestJob(class_name, len(members))
+
+        def run(job):
+            try:
+                # Each member is extracted once and uploaded by the ingest workers
+                zip_ingester.ingest(self.s3_client, self.bucket_name, class_name, z, members, job)
+                job.total_count = self.count_class_audios(class_name)
+                if on_success is not None and not job.failed:
+                    on_success()
+            finally:
+                z.close()
+                if cleanup is not None:
+                    cleanup()
+
+        if ingest_jobs.in_background(len(members)):
+            ingest_jobs.submit(job, run)
+            return jsonify({
+                'status': 'success',
+                'message': f'Uploading {len(members)} files in the background.',
+                'job_id': job.job_id,
+                'total_members': len(members)
+            }), 202
+
+        job.start()
+        run(job)
+        job.finish()
+        return jsonify(dict(
+            job.snapshot(),
+            status='success',
+            message=f'All files uploaded successfully. {job.uploaded} files were uploaded'
+                    + (f', {job.deduplicated} duplicates were skipped' if job.deduplicated else '')
+                    + (f', {len(job.rejected)} invalid files were rejected' if job.rejected else '') + '.')), 201
+
+    def count_class_audios(self, class_name):
+        # Fetch the total count of audio files for the class
+        response = self.s3_client.list_objects_v2(
+            Bucket=self.bucket_name, Prefix=f'zip_data/{class_name}/')
+        return sum(1 for obj in response.get('Contents', []) if obj['Key'].endswith('.wav'))
+
+    def get_ingest_job(self, job_id):
+        job = ingest_jobs.get(job_id)
+        if job is None:
+            return jsonify({'status': 'fail', 'message': 'Ingest job not found'}), 404
+        return jsonify({'status': 'success', 'job': job.snapshot()}), 200
+
+    def list_ingest_jobs(self):
+        return jsonify({'status': 'success', 'jobs': ingest_jobs.list()}), 200
+
+    def presigned_part_urls(self, key, upload_id, part_numbers):
+        return [{
+            'part_number': part_number,
+            'url': self.s3_client.generate_presigned_url(
+                'upload_part',
+                Params={'Bucket': self.bucket_name, 'Key': key,
+                        'UploadId': upload_id, 'PartNumber': part_number},
+                ExpiresIn=self.url_expires)
+        } for part_number in part_numbers]
+
+    def start_direct_upload(self, request):
+        # Phase one of a direct upload: the client PUTs sounds.zip to the returned part URLs,
+        # straight to a staging key, then calls finalize_direct_upload
+        try:
+            class_name = request.json.get('class_name')
+            size = request.json.get('size')
+        except Exception as e:
+            return jsonify({'status': 'fail', 'message': 'class name is required'}), 400
+
+        if not class_name or not isinstance(class_name, str):
+            return jsonify({'status': 'fail', 'message': 'class name is required'}), 400
+        if class_name_error(class_name):
+            return jsonify({'status': 'fail', 'message': class_name_error(class_name)}), 400
+        if size is not None and (not isinstance(size, int) or size <= 0):
+            return jsonify({'status': 'fail', 'message': 'size must be a positive number of bytes'}), 400
+
+        try:
+            key = staging_key(uuid.uuid4().hex)
+            # the class travels with the staged archive, finalize reads it back
+            response = self.s3_client.create_multipart_upload(
+                Bucket=self.bucket_name, Key=key, ContentType='application/zip',
+                Metadata={'class_name': class_name})
+            upload_id = response['UploadId']
+
+            part_size = part_size_for(size, self.part_size)
+            part_count = math.ceil(size / part_size) if size else 0
+            return jsonify({
+                'status': 'success',
+                'key': key,
+                'upload_id': upload_id,
+                'part_size': part_size,
+                'parts': self.presigned_part_urls(key, upload_id, range(1, part_count + 1))
+            }), 201
+        except Exception as e:
+            return jsonify({'status': 'fail', 'message': str(e)}), 500
+
+    def get_direct_upload_parts(self, request):
+        # Resuming an interrupted upload: the parts S3 already has, and fresh URLs for the
+        # missing ones out of part_count
+        try:
+            key = request.json.get('key')
+            upload_id = request.json.get('upload_id')
+            part_count = request.json.get('part_count', 0)
+        except Exception as e:
+            return jsonify({'status': 'fail', 'message': 'key and upload_id are required'}), 400
+
+        if not upload_id or not is_staging_key(key):
+            return jsonify({'status': 'fail', 'message': 'key and upload_id are required'}), 400
+        if not isinstance(part_count, int) or not 0 <= part_count <= MAX_PARTS:
+            return jsonify({'status': 'fail', 'message': f'part_count must be between 0 and {MAX_PARTS}'}), 400
+
+        try:
+            parts = uploaded_parts(self.s3_client, self.bucket_name, key, upload_id)
+            done = {part['part_number'] for part in parts}
+            missing = [number for number in range(1, part_count + 1) if number not in done]
+            return jsonify({
+                'status': 'success',
+                'uploaded_parts': parts,
+                'parts': self.presigned_part_urls(key, upload_id, missing)
+            }), 200
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'NoSuchUpload':
+                return jsonify({'status': 'fail', 'message': 'Upload not found'}), 404
+            return jsonify({'status': 'fail', 'message': str(e)}), 500
+        except Exception as e:
+            return jsonify({'status': 'fail', 'message': str(e)}), 500
+
+    def finalize_direct_upload(self, request):
+        # Phase two: completes the multipart upload once all part_count parts, size bytes in
+        # total, are there and extracts the staged archive into zip_data/<class_name>/ through
+        # ranged reads. The staged archive is dropped after a complete ingest only, so a failed
+        # finalize can be retried without uploading it again.
+        try:
+            key = request.json.get('key')
+            upload_id = request.json.get('upload_id')
+            part_count = request.json.get('part_count')
+            size = request.json.get('size')
+        except Exception as e:
+            return jsonify({'status': 'fail', 'message': 'key, upload_id, part_count and size are required'}), 400
+
+        if not upload_id or not is_staging_key(key):
+            return jsonify({'status': 'fail', 'message': 'key, upload_id, part_count and size are required'}), 400
+        if not isinstance(part_count, int) or not 1 <= part_count <= MAX_PARTS:
+            return jsonify({'status': 'fail', 'message': f'part_count must be between 1 and {MAX_PARTS}'}), 400
+        if not isinstance(size, int) or size <= 0:
+            return jsonify({'status': 'fail', 'message': 'size must be a positive number of bytes'}), 400
+
+        try:
+            try:
+                parts = uploaded_parts(self.s3_client, self.bucket_name, key, upload_id)
+                done = {part['part_number']: part for part in parts}
+                missing = [number for number in range(1, part_count + 1) if number not in done]
+                if missing:
+                    # S3 would complete a truncated archive, the client uploads these first
+                    return jsonify({
+                        'status': 'fail',
+                        'message': f'{len(missing)} of {part_count} parts are missing',
+                        'missing_parts': missing,
+                        'parts': self.presigned_part_urls(key, upload_id, missing)
+                    }), 409
+                parts = [done[number] for number in range(1, part_count + 1)]
+                uploaded = sum(part['size'] for part in parts)
+                if uploaded != size:
+                    return jsonify({'status': 'fail', 'message': f'The parts hold {uploaded} bytes, expected {size}'}), 400
+                self.s3_client.complete_multipart_upload(
+                    Bucket=self.bucket_name, Key=key, UploadId=upload_id,
+                    MultipartUpload={'Parts': [{'PartNumber': part['part_number'], 'ETag': part['etag']}
+                                               for part in parts]})
+            except ClientError as e:
+                # a retried finalize finds the upload already completed
+                if e.response['Error']['Code'] != 'NoSuchUpload':
+                    raise
+
+            try:
+                archive = open_s3_object(self.s3_client, self.bucket_name, key)
+            except ClientError as e:
+                if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                    return jsonify({'status': 'fail', 'message': 'Upload not found'}), 404
+                raise
+
+            if archive.raw.size != size:
+                archive.close()
+                return jsonify({'status': 'fail', 'message': f'The staged archive holds {archive.raw.size} bytes, expected {size}'}), 400
+
+            def delete_staged():
+                self.s3_client.delete_object(Bucket=self.bucket_name, Key=key)
+
+            # checked again, the staged object's metadata is not trusted
+            class_name = archive.raw.metadata.get('class_name')
+            error = class_name_error(class_name) if class_name else 'The upload has no class name'
+            if error:
+                archive.close()
+                return jsonify({'status': 'fail', 'message': error}), 400
+            try:
+                z = zipfile.ZipFile(archive)
+            except zipfile.BadZipFile:
+                archive.close()
+                return jsonify({"status": "fail", "message": "The uploaded file is not a zip file"}), 400
+
+            error = archive_error(z)
+            if error:
+                z.close()
+                archive.close()
+                return jsonify({"status": "fail", "message": error}), 400
+            return self.ingest_archive(z, class_name, archive.close, delete_staged)
+        except Exception as e:
+            return jsonify({'status': 'fail', 'message': str(e)}), 500
+
+    def abort_direct_upload(self, request):
+        try:
+            key = request.json.get('key')
+            upload_id = request.json.get('upload_id')
+        except Exception as e:
+            return jsonify({'status': 'fail', 'message': 'key and upload_id are required'}), 400
+
+        if not upload_id or not is_staging_key(key):
+            return jsonify({'status': 'fail', 'message': 'key and upload_id are required'}), 400
+
+        try:
+            try:
+                self.s3_client.abort_multipart_upload(Bucket=self.bucket_name, Key=key, UploadId=upload_id)
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'NoSuchUpload':
+                    raise
+                # completed by a finalize that failed, the staged archive was kept
+                self.s3_client.delete_object(Bucket=self.bucket_name, Key=key)
+            return jsonify({'status': 'success', 'message': 'Upload aborted'}), 200
+        except Exception as e:
+            return jsonify({'status': 'fail', 'message': str(e)}), 500
+
     def get_class_count(self, request):
         try:
             class_name = request.json.get('class_name')
@@ -186,6 +393,7 @@ class DataService:
     def get_all_audios(self, request):
         try:
             class_name = request.json.get('class_name')
+            include_metadata = bool(request.json.get('include_metadata', False))
         except Exception as e:
             return jsonify({'status': 'fail', 'message': 'class name is required'}), 400
 
@@ -216,6 +424,17 @@ class DataService:
             if not audio_files:
                 return jsonify({'status': 'fail', 'message': 'No audio files found for the specified class_name'}), 404
 
+            if include_metadata:
+                # The WAV header probed at ingest (channels, sample-rate, frames, duration-seconds,
+                # subtype, sha256), read with HEAD requests instead of downloading the audio
+                def head(audio_file):
+                    return self.s3_client.head_object(
+                        Bucket=self.bucket_name, Key=f"zip_data/{class_name}/{audio_file['name']}").get('Metadata', {})
+
+                with ThreadPoolExecutor(max_workers=16) as executor:
+                    for audio_file, metadata in zip(audio_files, executor.map(head, audio_files)):
+                        audio_file['metadata'] = metadata
+
             return jsonify({'status': 'success', 'audio_files': audio_files}), 200
 
         except Exception as e:
@@ -266,32 +485,42 @@ class DataService:
 
             if not class_names or not isinstance(class_names, list):
                 return jsonify({'status': 'fail', 'message': 'A list of class names is required'}), 400
+            # a repeated class would fail its own lock
+            class_names = list(dict.fromkeys(class_names))
 
             deleted_classes = []
             not_found_classes = []
 
-            for class_name in class_names:
-                # List all objects in the specified class
-                response = self.s3_client.list_objects_v2(
-                    Bucket=self.bucket_name, Prefix=f'zip_data/{class_name}/')
+            with ExitStack() as locks:
+                # Nothing is deleted while any of the classes is being ingested
+                for class_name in class_names:
+                    locks.enter_context(class_lock_or_busy(class_name))
 
-                keys_to_delete = [{'Key': obj['Key']}
-                                  for obj in response.get('Contents', [])]
+                for class_name in class_names:
+                    # List all objects in the specified class
+                    response = self.s3_client.list_objects_v2(
+                        Bucket=self.bucket_name, Prefix=f'zip_data/{class_name}/')
 
-                if not keys_to_delete:
-                    not_found_classes.append(class_name)
-                    continue
+                    keys_to_delete = [{'Key': obj['Key']}
+                                      for obj in response.get('Contents', [])]
 
-                # Delete objects in batches of 1000 (maximum allowed by S3 in a single delete request)
-                while keys_to_delete:
-                    batch = keys_to_delete[:1000]
-                    self.s3_client.delete_objects(
-                        Bucket=self.bucket_name,
-                        Delete={'Objects': batch}
-                    )
-                    keys_to_delete = keys_to_delete[1000:]
+                    if not keys_to_delete:
+                        not_found_classes.append(class_name)
+                        continue
 
-                deleted_classes.append(class_name)
+                    # Delete objects in batches of 1000 (maximum allowed by S3 in a single delete request)
+                    while keys_to_delete:
+                        batch = keys_to_delete[:1000]
+                        self.s3_client.delete_objects(
+                            Bucket=self.bucket_name,
+                            Delete={'Objects': batch}
+                        )
+                        keys_to_delete = keys_to_delete[1000:]
+
+                    # Nothing of the class is left to deduplicate against
+                    delete_class_index(self.s3_client, self.bucket_name, class_name)
+
+                    deleted_classes.append(class_name)
 
             if not deleted_classes and not not_found_classes:
                 return jsonify({'status': 'fail', 'message': 'No classes found to delete'}), 404
@@ -302,6 +531,8 @@ class DataService:
                 'not_found_classes': not_found_classes
             }), 200
 
+        except ClassBusyError as e:
+            return jsonify({'status': 'fail', 'message': str(e)}), 409
         except Exception as e:
             return jsonify({'status': 'fail', 'message': str(e)}), 500
 
@@ -315,27 +546,33 @@ class DataService:
         if not class_name:
             return jsonify({'status': 'fail', 'message': 'class name is required'}), 400
         try:
-            # List all objects in the specified class
-            response = self.s3_client.list_objects_v2(
-                Bucket=self.bucket_name, Prefix=f'zip_data/{class_name}/')
+            with class_lock_or_busy(class_name):
+                # List all objects in the specified class
+                response = self.s3_client.list_objects_v2(
+                    Bucket=self.bucket_name, Prefix=f'zip_data/{class_name}/')
 
-            keys_to_delete = [{'Key': obj['Key']}
-                              for obj in response.get('Contents', [])]
+                keys_to_delete = [{'Key': obj['Key']}
+                                  for obj in response.get('Contents', [])]
 
-            if not keys_to_delete:
-                return jsonify({'status': 'fail', 'message': 'No files found for the specified class_name'}), 404
+                if not keys_to_delete:
+                    return jsonify({'status': 'fail', 'message': 'No files found for the specified class_name'}), 404
 
-            # Delete objects in batches of 1000 (maximum allowed by S3 in a single delete request)
-            while keys_to_delete:
-                batch = keys_to_delete[:1000]
-                self.s3_client.delete_objects(
-                    Bucket=self.bucket_name,
-                    Delete={'Objects': batch}
-                )
-                keys_to_delete = keys_to_delete[1000:]
+                # Delete objects in batches of 1000 (maximum allowed by S3 in a single delete request)
+                while keys_to_delete:
+                    batch = keys_to_delete[:1000]
+                    self.s3_client.delete_objects(
+                        Bucket=self.bucket_name,
+                        Delete={'Objects': batch}
+                    )
+                    keys_to_delete = keys_to_delete[1000:]
+
+                # Nothing of the class is left to deduplicate against
+                delete_class_index(self.s3_client, self.bucket_name, class_name)
 
             return jsonify({'status': 'success', 'message': f'All files in class {class_name} deleted successfully'}), 200
 
+        except ClassBusyError as e:
+            return jsonify({'status': 'fail', 'message': str(e)}), 409
         except Exception as e:
             return jsonify({'status': 'fail', 'message': str(e)}), 500
 
@@ -350,35 +587,43 @@ class DataService:
             return jsonify({'status': 'fail', 'message': 'class name and valid percentage are required'}), 400
 
         try:
-            # List all objects in the specified class
-            response = self.s3_client.list_objects_v2(
-                Bucket=self.bucket_name, Prefix=f'zip_data/{class_name}/')
+            with class_lock_or_busy(class_name):
+                # List all objects in the specified class
+                response = self.s3_client.list_objects_v2(
+                    Bucket=self.bucket_name, Prefix=f'zip_data/{class_name}/')
 
-            audio_files = [obj['Key'] for obj in response.get(
-                'Contents', []) if obj['Key'].endswith('.wav')]
+                audio_files = [obj['Key'] for obj in response.get(
+                    'Contents', []) if obj['Key'].endswith('.wav')]
 
-            if not audio_files:
-                return jsonify({'status': 'fail', 'message': 'No audio files found for the specified class_name'}), 404
+                if not audio_files:
+                    return jsonify({'status': 'fail', 'message': 'No audio files found for the specified class_name'}), 404
 
-            total_files = len(audio_files)
-            num_files_to_delete = int((percentage / 100.0) * total_files)
+                total_files = len(audio_files)
+                num_files_to_delete = int((percentage / 100.0) * total_files)
 
-            if num_files_to_delete <= 0:
-                return jsonify({'status': 'fail', 'message': 'Percentage too low, no files to delete'}), 400
+                if num_files_to_delete <= 0:
+                    return jsonify({'status': 'fail', 'message': 'Percentage too low, no files to delete'}), 400
 
-            selected_files = random.sample(audio_files, num_files_to_delete)
-            keys_to_delete = [{'Key': file_key} for file_key in selected_files]
+                selected_files = random.sample(audio_files, num_files_to_delete)
+                keys_to_delete = [{'Key': file_key} for file_key in selected_files]
 
-            # Delete objects in batches of 1000 (maximum allowed by S3 in a single delete request)
-            while keys_to_delete:
-                batch = keys_to_delete[:1000]
-                self.s3_client.delete_objects(
-                    Bucket=self.bucket_name,
-                    Delete={'Objects': batch}
-                )
-                keys_to_delete = keys_to_delete[1000:]
+                # Delete objects in batches of 1000 (maximum allowed by S3 in a single delete request)
+                while keys_to_delete:
+                    batch = keys_to_delete[:1000]
+                    self.s3_client.delete_objects(
+                        Bucket=self.bucket_name,
+                        Delete={'Objects': batch}
+                    )
+                    keys_to_delete = keys_to_delete[1000:]
+
+                # Their content may be uploaded again
+                index = ClassHashIndex.load(self.s3_client, self.bucket_name, class_name)
+                index.remove_keys(selected_files)
+                index.save()
 
             return jsonify({'status': 'success', 'message': f'{num_files_to_delete} files in class {class_name} deleted successfully'}), 200
 
+        except ClassBusyError as e:
+            return jsonify({'status': 'fail', 'message': str(e)}), 409
         except Exception as e:
             return jsonify({'status': 'fail', 'message': str(e)}), 500
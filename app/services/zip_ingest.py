@@ -0,0 +1,470 @@
+import hashlib
+import io
+import math
+import queue
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore, Condition, Event
+import soundfile as sf
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+from .hash_index import ClassHashIndex, class_lock
+from .ingest_jobs import IngestJob
+
+_DONE = object()
+
+# Copy size when an upload stream has to be spooled to disk
+SPOOL_CHUNK = 1024 * 1024
+
+# sounds.zip members are small WAV clips, one PutObject on the worker's own thread each.
+# s3transfer's default starts a thread pool per upload_fileobj call and goes multipart at 8 MB.
+WAV_TRANSFER_CONFIG = TransferConfig(multipart_threshold=64 * 1024 * 1024,
+                                     multipart_chunksize=16 * 1024 * 1024,
+                                     use_threads=False)
+
+# S3 error codes that mean back off
+THROTTLE_CODES = {'SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded',
+                  'TooManyRequests', 'ServiceUnavailable', '503'}
+
+# Relative throughput change the adaptive limit reacts to
+RAMP_GAIN = 0.05
+
+# Members that fail the WAV probe go to <QUARANTINE_PREFIX>/<class_name>/<name>, outside zip_data/
+QUARANTINE_PREFIX = 'zip_quarantine'
+
+# libsndfile major formats accepted as WAV
+WAV_FORMATS = {'WAV', 'WAVEX', 'RF64'}
+
+# Archives uploaded straight to S3 are staged at <STAGING_PREFIX>/<id>/sounds.zip
+STAGING_PREFIX = 'zip_staging'
+
+# S3 multipart limits
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PARTS = 10000
+
+# Read-ahead of the ranged GETs a staged archive is extracted through. Members are read in
+# archive order, so one GET covers many small WAVs.
+RANGE_READ_BUFFER = 8 * 1024 * 1024
+
+
+def spool(stream):
+    # A seekable file for zipfile to read the central directory from. Werkzeug already spools
+    # multipart uploads to a SpooledTemporaryFile, anything not seekable is copied to a
+    # temporary file rather than read into memory.
+    if isinstance(stream, tempfile.SpooledTemporaryFile):
+        # no seekable() before Python 3.11, its BytesIO or rolled over TemporaryFile has
+        stream = stream._file
+    try:
+        stream.seek(0)
+        stream.tell()
+        return stream
+    except (AttributeError, OSError, ValueError):
+        pass
+    spooled = tempfile.TemporaryFile()
+    shutil.copyfileobj(stream, spooled, SPOOL_CHUNK)
+    spooled.seek(0)
+    return spooled
+
+
+def audio_members(z):
+    # The `<folder>/<name>.wav` entries of a validated sounds.zip, without the folder entry
+    return [info for info in z.infolist()
+            if len(info.filename.split('/')) == 2 and info.filename.split('/')[1] != '']
+
+
+def archive_error(z):
+    # Why an opened archive is not a valid sounds.zip, None if it is
+    names = z.namelist()
+    if len(names) == 1:
+        return "No files in the zip file"
+    for index, filename in enumerate(names):
+        if len(filename.split("/")) != 2:
+            return f"Invalid file structure: {filename}"
+        if not filename.endswith(".wav") and index != 0:
+            return f"Invalid file type in zip: {filename}"
+    return None
+
+
+def member_key(class_name, filename):
+    return f'zip_data/{class_name}/{filename.split("/")[1]}'
+
+
+def class_name_error(class_name):
+    # Why a class name cannot name a zip_data/<class_name>/ prefix, None if it can
+    if '/' in class_name or class_name in ('.', '..') or any(ord(c) < 32 for c in class_name):
+        return f'Invalid class name: {class_name!r}'
+    return None
+
+
+def quarantine_key(class_name, filename):
+    return f'{QUARANTINE_PREFIX}/{class_name}/{filename.split("/")[1]}'
+
+
+def probe_wav(data):
+    # Channels, sample rate and length from the WAV header, nothing is decoded. Raises for
+    # anything libsndfile cannot open.
+    if not data:
+        raise ValueError('Empty file')
+    with sf.SoundFile(io.BytesIO(data)) as f:
+        return {
+            'format': f.format,
+            'subtype': f.subtype,
+            'channels': f.channels,
+            'sample_rate': f.samplerate,
+            'frames': f.frames,
+            'duration_seconds': f.frames / f.samplerate if f.samplerate else 0.0
+        }
+
+
+def probe_metadata(probe):
+    # S3 user metadata of an ingested member, values have to be strings
+    return {
+        'channels': str(probe['channels']),
+        'sample-rate': str(probe['sample_rate']),
+        'frames': str(probe['frames']),
+        'duration-seconds': f"{probe['duration_seconds']:.6f}",
+        'subtype': probe['subtype']
+    }
+
+
+def throttled(e):
+    # upload_fileobj raises the ClientError itself, S3UploadFailedError only carries its message
+    if isinstance(e, ClientError):
+        error = e.response.get('Error', {})
+        return error.get('Code') in THROTTLE_CODES or \
+            e.response.get('ResponseMetadata', {}).get('HTTPStatusCode') == 503
+    return any(code in str(e) for code in ('SlowDown', 'Throttling', 'RequestLimitExceeded'))
+
+
+def staging_key(staging_id):
+    return f'{STAGING_PREFIX}/{staging_id}/sounds.zip'
+
+
+def is_staging_key(key):
+    parts = key.split('/') if isinstance(key, str) else []
+    return len(parts) == 3 and parts[0] == STAGING_PREFIX and parts[1] != '' and parts[2] == 'sounds.zip'
+
+
+def part_size_for(size, part_size):
+    # At least S3's 5 MB minimum and large enough for the archive to fit in 10,000 parts
+    part_size = max(part_size, MIN_PART_SIZE)
+    if size:
+        part_size = max(part_size, math.ceil(size / MAX_PARTS))
+    return part_size
+
+
+def uploaded_parts(s3_client, bucket_name, key, upload_id):
+    # Parts S3 already has for a multipart upload, what a resumed upload can skip
+    parts = []
+    marker = 0
+    while True:
+        response = s3_client.list_parts(Bucket=bucket_name, Key=key, UploadId=upload_id,
+                                        PartNumberMarker=marker)
+        parts.extend({'part_number': part['PartNumber'], 'size': part['Size'], 'etag': part['ETag']}
+                     for part in response.get('Parts', []))
+        if not response.get('IsTruncated'):
+            return parts
+        marker = response['NextPartNumberMarker']
+
+
+class S3RangeReader(io.RawIOBase):
+    # Seekable read-only view of an S3 object, every read is a ranged GetObject. Wrapped in a
+    # BufferedReader (open_s3_object) so zipfile can extract a staged archive without
+    # downloading it first.
+    def __init__(self, s3_client, bucket_name, key):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.key = key
+        head = s3_client.head_object(Bucket=bucket_name, Key=key)
+        self.size = head['ContentLength']
+        self.metadata = head.get('Metadata', {})
+        self.position = 0
+        self.requests = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        elif whence == io.SEEK_END:
+            self.position = self.size + offset
+        else:
+            raise ValueError(f'Invalid whence: {whence}')
+        return self.position
+
+    def readinto(self, buffer):
+        if self.position >= self.size or len(buffer) == 0:
+            return 0
+        end = min(self.position + len(buffer), self.size) - 1
+        response = self.s3_client.get_object(Bucket=self.bucket_name, Key=self.key,
+                                             Range=f'bytes={self.position}-{end}')
+        data = response['Body'].read()
+        self.requests += 1
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+
+def open_s3_object(s3_client, bucket_name, key, buffer_size=RANGE_READ_BUFFER):
+    return io.BufferedReader(S3RangeReader(s3_client, bucket_name, key), buffer_size=buffer_size)
+
+
+class ConcurrencyLimit:
+    # How many uploads may run at once. Fixed when maximum <= initial, otherwise a hill climb:
+    # every window_seconds the completed uploads per second are compared with the previous
+    # window, the limit grows by half while throughput keeps rising, steps back when the last
+    # increase made it worse, and halves on S3 throttling.
+    def __init__(self, initial, maximum=0, window_seconds=1.0):
+        self.limit = max(initial, 1)
+        self.initial = self.limit
+        self.maximum = max(maximum, self.limit)
+        self.window_seconds = window_seconds
+        self.peak = self.limit
+        self.throttled = 0
+        self._active = 0
+        self._condition = Condition()
+        self._window_start = time.monotonic()
+        self._window_count = 0
+        self._previous = None  # (limit, objects per second) of the last window
+        self._backoff_at = float('-inf')
+
+    @property
+    def adaptive(self):
+        return self.maximum > self.initial
+
+    def acquire(self):
+        with self._condition:
+            while self._active >= self.limit:
+                self._condition.wait()
+            self._active += 1
+
+    def release(self, completed=False, throttle=False):
+        with self._condition:
+            self._active -= 1
+            if throttle:
+                self.throttled += 1
+                # a burst of throttled calls halves the limit once per window
+                if self.adaptive and time.monotonic() - self._backoff_at >= self.window_seconds:
+                    self._backoff_at = time.monotonic()
+                    self.limit = max(1, self.limit // 2)
+                    # the next window only measures the new limit
+                    self._restart_window((self.limit, float('inf')))
+            elif completed:
+                self._window_count += 1
+                if self.adaptive:
+                    self._adjust()
+            self._condition.notify_all()
+
+    def _restart_window(self, previous):
+        self._previous = previous
+        self._window_start = time.monotonic()
+        self._window_count = 0
+
+    def _adjust(self):
+        elapsed = time.monotonic() - self._window_start
+        if elapsed < self.window_seconds:
+            return
+        rate = self._window_count / elapsed
+        limit = self.limit
+        if self._previous is None or rate > self._previous[1] * (1 + RAMP_GAIN):
+            self.limit = min(self.maximum, limit + max(1, limit // 2))
+        elif rate < self._previous[1] * (1 - RAMP_GAIN) and limit > self._previous[0]:
+            self.limit = self._previous[0]
+        self.peak = max(self.peak, self.limit)
+        self._restart_window((limit, rate))
+
+    def stats(self):
+        with self._condition:
+            return {'adaptive': self.adaptive, 'initial': self.initial, 'final': self.limit,
+                    'peak': self.peak, 'maximum': self.maximum, 'throttled': self.throttled}
+
+
+class ZipIngester:
+    # Uploads the members of an opened sounds.zip to zip_data/<class_name>/.
+    # The central directory is parsed once by the caller. A reader decompresses every member
+    # exactly once, in archive order, and hands its bytes to the upload workers through a
+    # bounded queue, so at most queue_size + max_workers members are in memory whatever the
+    # archive size. With max_workers above workers the upload concurrency adapts to S3
+    # (ConcurrencyLimit), a throttled member is retried up to retries times. Counters and
+    # per-file failures go to an IngestJob, safe to read while the ingest runs.
+    # Every uploaded member is recorded in the class's ClassHashIndex, with deduplicate
+    # members whose sha256 is in it already are skipped.
+    # Workers probe each member's WAV header first. Empty or unreadable files, other formats,
+    # files without frames and sample rates outside min_sample_rate..max_sample_rate (0 for no
+    # bound) are rejected, and with quarantine uploaded to zip_quarantine/<class_name>/ instead.
+    # Accepted members carry the probe as object metadata.
+    # Ingests run side by side (requests and background jobs) and share one S3 client, so
+    # the S3 calls of all of them together are capped at pool_size.
+    def __init__(self, **settings):
+        self.configure(**settings)
+
+    def configure(self, workers=5, queue_size=16, max_workers=0, retries=3, window_seconds=1.0,
+                  deduplicate=True, min_sample_rate=8000, max_sample_rate=192000, quarantine=True):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.max_workers = max_workers
+        self.retries = retries
+        self.window_seconds = window_seconds
+        self.deduplicate = deduplicate
+        self.min_sample_rate = min_sample_rate
+        self.max_sample_rate = max_sample_rate
+        self.quarantine = quarantine
+        self._connections = BoundedSemaphore(self.pool_size)
+
+    def probe_error(self, data):
+        # (probe, None) for a member to ingest, (probe or None, reason) for one to reject
+        try:
+            probe = probe_wav(data)
+        except Exception as e:
+            return None, f'Unreadable WAV header: {e}'
+        if probe['format'] not in WAV_FORMATS:
+            return probe, f"Not a WAV file: {probe['format']}"
+        if probe['frames'] <= 0:
+            return probe, 'No audio frames'
+        sample_rate = probe['sample_rate']
+        if (self.min_sample_rate and sample_rate < self.min_sample_rate) or \
+                (self.max_sample_rate and sample_rate > self.max_sample_rate):
+            return probe, f'Sample rate {sample_rate} Hz is outside {self.min_sample_rate}-{self.max_sample_rate} Hz'
+        return probe, None
+
+    @property
+    def pool_size(self):
+        # Most uploads in flight across every running ingest, the S3 client's connection pool
+        # should fit it
+        return max(self.workers, self.max_workers, 1)
+
+    def ingest(self, s3_client, bucket_name, class_name, z, members, job=None):
+        # Progress goes to job, an IngestJob the caller may be polling, which is returned
+        job = job or IngestJob(class_name, len(members))
+        with class_lock(class_name):
+            index = ClassHashIndex.load(s3_client, bucket_name, class_name)
+            try:
+                return self._ingest(s3_client, bucket_name, class_name, z, members, job, index)
+            finally:
+                # what did get uploaded is recorded even when the ingest fails part way, without
+                # hiding the ingest's own error
+                try:
+                    index.save()
+                except Exception as e:
+                    print(f'Saving the hash index of {class_name} failed: {e}')
+
+    def _ingest(self, s3_client, bucket_name, class_name, z, members, job, index):
+        members_queue = queue.Queue(maxsize=max(self.queue_size, 1))
+        limit = ConcurrencyLimit(self.workers, self.max_workers, self.window_seconds)
+
+        def put(key, data, metadata):
+            # The upload error once retries are spent, None when the object is stored
+            for attempt in range(self.retries + 1):
+                limit.acquire()
+                try:
+                    with self._connections:
+                        s3_client.upload_fileobj(io.BytesIO(data), bucket_name, key,
+                                                 ExtraArgs={'Metadata': metadata},
+                                                 Config=WAV_TRANSFER_CONFIG)
+                except Exception as e:
+                    throttle = throttled(e)
+                    limit.release(throttle=throttle)
+                    if not throttle or attempt == self.retries:
+                        return e
+                    job.add_retried()
+                    time.sleep(min(0.1 * 2 ** attempt, 2.0))
+                    continue
+                limit.release(completed=True)
+                return None
+
+        def upload(filename, data):
+            probe, reason = self.probe_error(data)
+            if reason is not None:
+                key = None
+                if self.quarantine:
+                    key = quarantine_key(class_name, filename)
+                    if put(key, data, {'reason': reason[:512].encode('ascii', 'replace').decode()}):
+                        key = None
+                job.add_rejected(filename, reason, key)
+                return
+
+            key = member_key(class_name, filename)
+            # hashed on the worker, hashlib releases the GIL for buffers this size
+            digest = hashlib.sha256(data).hexdigest()
+            if self.deduplicate:
+                try:
+                    claimed = index.claim(digest, self._connections)
+                except Exception as e:
+                    # the indexed copy could not be checked
+                    job.add_failed(filename, e)
+                    return
+                if not claimed:
+                    job.add_deduplicated()
+                    return
+            error = put(key, data, dict(probe_metadata(probe), sha256=digest))
+            if error is not None:
+                if self.deduplicate:
+                    index.release(digest)
+                job.add_failed(filename, error)
+                return
+            index.commit(digest, key)
+            job.add_uploaded(len(data))
+
+        worker_failed = Event()
+
+        def upload_worker():
+            try:
+                while True:
+                    item = members_queue.get()
+                    if item is _DONE:
+                        return
+                    upload(*item)
+            except BaseException:
+                worker_failed.set()
+                raise
+
+        def hand_over(item, give_up):
+            # Blocks while the queue is full, False once give_up() says no worker will take it
+            while True:
+                try:
+                    members_queue.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    if give_up():
+                        return False
+
+        workers = self.pool_size
+        try:
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='zip-ingest') as executor:
+                futures = [executor.submit(upload_worker) for _ in range(workers)]
+                try:
+                    for info in members:
+                        if worker_failed.is_set():
+                            break
+                        try:
+                            data = z.read(info)
+                        except Exception as e:
+                            # a corrupt member fails on its own, the rest of the archive still goes up
+                            job.add_failed(info.filename, e)
+                            continue
+                        # a failed worker stops the ingest, its error is raised below
+                        if not hand_over((info.filename, data), worker_failed.is_set):
+                            break
+                finally:
+                    for _ in futures:
+                        if not hand_over(_DONE, lambda: all(future.done() for future in futures)):
+                            break
+                for future in futures:
+                    future.result()
+        finally:
+            job.set_concurrency(limit.stats())
+        return job
+
+
+zip_ingester = ZipIngester()
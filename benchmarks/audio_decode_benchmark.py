@@ -0,0 +1,130 @@
+"""Decode time per clip of compressed predict uploads.
+
+Compares the old path (save to a temp file, librosa.load, which falls back to audioread for
+what libsndfile cannot open) with app.services.audio_decoding reading from memory, for WAV,
+MP3, OGG Vorbis, OGG Opus, M4A and ADTS AAC clips. Times include resampling to 22050 Hz.
+
+    python -m benchmarks.audio_decode_benchmark --clips 20 --duration 5
+"""
+import argparse
+import io
+import os
+import tempfile
+import time
+import warnings
+import numpy as np
+import soundfile as sf
+import librosa
+import av
+
+# importing the app package creates boto3 clients, which need a region
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+from app.services.audio_decoding import read_with_soundfile, read_with_av, soundfile_decodes, detect_container  # noqa: E402
+from app.services.audio_features import MelFeatureExtractor, TARGET_SAMPLE_RATE  # noqa: E402
+
+
+def make_audio(duration, sample_rate, seed):
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(duration * sample_rate)) / sample_rate
+    audio = 0.3 * np.sin(2 * np.pi * rng.uniform(100, 4000) * t) + \
+        0.05 * rng.standard_normal(len(t))
+    return audio.astype(np.float32)
+
+
+def encode_with_av(audio, sample_rate, container_format, codec):
+    buffer = io.BytesIO()
+    with av.open(buffer, 'w', format=container_format) as container:
+        stream = container.add_stream(codec, rate=sample_rate)
+        stream.layout = 'mono'
+        for start in range(0, len(audio), 1024):
+            frame = av.AudioFrame.from_ndarray(
+                audio[np.newaxis, start:start + 1024], format='flt', layout='mono')
+            frame.sample_rate = sample_rate
+            for packet in stream.encode(frame):
+                container.mux(packet)
+        for packet in stream.encode(None):
+            container.mux(packet)
+    return buffer.getvalue()
+
+
+def encode_with_soundfile(audio, sample_rate, file_format, subtype):
+    buffer = io.BytesIO()
+    sf.write(buffer, audio, sample_rate, format=file_format, subtype=subtype)
+    return buffer.getvalue()
+
+
+ENCODERS = {
+    'wav': lambda audio, sr: encode_with_soundfile(audio, sr, 'WAV', 'PCM_16'),
+    'mp3': lambda audio, sr: encode_with_av(audio, sr, 'mp3', 'libmp3lame'),
+    'ogg vorbis': lambda audio, sr: encode_with_soundfile(audio, sr, 'OGG', 'VORBIS'),
+    # Opus only runs at 48 kHz
+    'ogg opus': lambda audio, sr: encode_with_av(
+        librosa.resample(audio, orig_sr=sr, target_sr=48000, res_type='soxr_hq'), 48000, 'ogg', 'libopus'),
+    'm4a aac': lambda audio, sr: encode_with_av(audio, sr, 'ipod', 'aac'),
+    'adts aac': lambda audio, sr: encode_with_av(audio, sr, 'adts', 'aac'),
+}
+
+
+def librosa_load(data):
+    with tempfile.NamedTemporaryFile(delete=False) as f:
+        f.write(data)
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            return librosa.load(f.name)[0]
+    finally:
+        os.remove(f.name)
+
+
+def resampled(reader):
+    def decode(data):
+        audio, native_sr, _ = reader(data)
+        return librosa.resample(audio, orig_sr=native_sr, target_sr=TARGET_SAMPLE_RATE, res_type='soxr_hq')
+    return decode
+
+
+def measure(fn, clips):
+    try:
+        fn(clips[0])
+    except Exception as e:
+        return None, type(e).__name__
+    start = time.perf_counter()
+    for clip in clips:
+        fn(clip)
+    return (time.perf_counter() - start) / len(clips) * 1000, None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clips', type=int, default=20)
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--sample-rate', type=int, default=44100)
+    args = parser.parse_args()
+
+    reference = MelFeatureExtractor()
+    print(f'{args.clips} clips, {args.duration}s @ {args.sample_rate} Hz, ms per clip')
+    print(f'{"format":<12}{"container":>10}{"librosa.load":>14}{"soundfile":>12}{"av":>10}{"feature err":>13}')
+    for name, encode in ENCODERS.items():
+        audios = [make_audio(args.duration, args.sample_rate, seed) for seed in range(args.clips)]
+        clips = [encode(audio, args.sample_rate) for audio in audios]
+        container = detect_container(clips[0])
+
+        columns = []
+        for fn in [librosa_load, resampled(read_with_soundfile), resampled(read_with_av)]:
+            ms, error = measure(fn, clips)
+            columns.append(f'{ms:.2f}' if error is None else error[:10])
+
+        # how far the decoded clip's features are from the features of the original samples
+        features = reference.extract_from_bytes(clips[0])
+        expected = reference.extract(librosa.resample(
+            audios[0], orig_sr=args.sample_rate, target_sr=TARGET_SAMPLE_RATE, res_type='soxr_hq'),
+            TARGET_SAMPLE_RATE)
+        error = np.abs(features - expected).sum() / np.abs(expected).sum()
+        route = 'soundfile' if soundfile_decodes(container) else 'av'
+        print(f'{name:<12}{str(container):>10}{columns[0]:>14}{columns[1]:>12}{columns[2]:>10}'
+              f'{error:>13.2e}  -> {route}')
+
+
+if __name__ == '__main__':
+    main()
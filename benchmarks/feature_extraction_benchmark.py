@@ -0,0 +1,114 @@
+"""Per-clip CPU time of the predict feature extraction.
+
+Compares the old path (save to disk, librosa.load, librosa.feature.melspectrogram)
+with app.services.audio_features.
+
+    python -m benchmarks.feature_extraction_benchmark --clips 50 --duration 5 --sample-rate 44100
+
+The last table pads every clip with --silence seconds of silence on both sides and compares
+the default extractor with silence trimming and a decode budget: CPU per clip and how far the
+features of the padded clip are from those of the clip without padding.
+"""
+import argparse
+import io
+import os
+import tempfile
+import time
+import numpy as np
+import soundfile as sf
+import librosa
+
+# importing the app package creates boto3 clients, which need a region
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+from app.services.audio_features import MelFeatureExtractor  # noqa: E402
+
+
+def make_clip(duration, sample_rate, seed):
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(duration * sample_rate)) / sample_rate
+    audio = 0.3 * np.sin(2 * np.pi * rng.uniform(100, 4000) * t) + \
+        0.05 * rng.standard_normal(len(t))
+    buffer = io.BytesIO()
+    sf.write(buffer, audio.astype(np.float32), sample_rate, format='WAV')
+    return buffer.getvalue()
+
+
+def pad_with_silence(data, seconds):
+    audio, sample_rate = sf.read(io.BytesIO(data), dtype='float32')
+    silence = np.zeros(int(seconds * sample_rate), dtype=np.float32)
+    buffer = io.BytesIO()
+    sf.write(buffer, np.concatenate([silence, audio, silence]), sample_rate, format='WAV')
+    return buffer.getvalue()
+
+
+def librosa_features(data):
+    with tempfile.NamedTemporaryFile(suffix='.wav', delete=False) as f:
+        f.write(data)
+    try:
+        audio, sr = librosa.load(f.name)
+        return np.mean(librosa.feature.melspectrogram(y=audio, sr=sr).T, axis=0)
+    finally:
+        os.remove(f.name)
+
+
+def measure(fn, clips):
+    results = []
+    start_cpu, start_wall = time.process_time(), time.perf_counter()
+    for clip in clips:
+        results.append(fn(clip))
+    cpu, wall = time.process_time() - start_cpu, time.perf_counter() - start_wall
+    return np.array(results), cpu / len(clips) * 1000, wall / len(clips) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clips', type=int, default=50)
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--sample-rate', type=int, default=44100)
+    parser.add_argument('--res-types', default='soxr_hq,soxr_mq,soxr_lq')
+    parser.add_argument('--silence', type=float, default=3.0)
+    parser.add_argument('--trim-top-db', type=float, default=60)
+    args = parser.parse_args()
+
+    clips = [make_clip(args.duration, args.sample_rate, seed)
+             for seed in range(args.clips)]
+
+    # warm up numba / filterbank caches so both sides are measured steady state
+    librosa_features(clips[0])
+
+    baseline, cpu, wall = measure(librosa_features, clips)
+    print(f'{args.clips} clips, {args.duration}s @ {args.sample_rate} Hz')
+    print(f'{"path":<28}{"cpu ms/clip":>12}{"wall ms/clip":>14}{"max rel err":>14}')
+    print(f'{"librosa.load + melspec":<28}{cpu:>12.2f}{wall:>14.2f}{"-":>14}')
+
+    for res_type in args.res_types.split(','):
+        extractor = MelFeatureExtractor(res_type=res_type)
+        extractor.extract_from_bytes(clips[0])
+        features, cpu, wall = measure(extractor.extract_from_bytes, clips)
+        error = np.max(np.abs(features - baseline) / (np.abs(baseline) + 1e-10))
+        print(f'{"extractor " + res_type:<28}{cpu:>12.2f}{wall:>14.2f}{error:>14.2e}')
+
+    extractor = MelFeatureExtractor(sample_rate=None)
+    extractor.extract_from_bytes(clips[0])
+    _, cpu, wall = measure(extractor.extract_from_bytes, clips)
+    print(f'{"extractor native rate":<28}{cpu:>12.2f}{wall:>14.2f}{"n/a":>14}')
+
+    # silence trimming and decode budget on padded clips
+    reference = MelFeatureExtractor().extract_from_bytes
+    clean = np.array([reference(clip) for clip in clips])
+    padded = [pad_with_silence(clip, args.silence) for clip in clips]
+    print(f'\n{args.silence}s of silence before and after every clip')
+    print(f'{"path":<28}{"cpu ms/clip":>12}{"wall ms/clip":>14}{"mean rel err":>14}')
+    for label, extractor in [
+            ('no trimming', MelFeatureExtractor()),
+            (f'trim {args.trim_top_db:g} dB', MelFeatureExtractor(trim_top_db=args.trim_top_db)),
+            (f'trim + max {args.silence + args.duration:g}s', MelFeatureExtractor(
+                trim_top_db=args.trim_top_db, max_duration=args.silence + args.duration))]:
+        features, cpu, wall = measure(extractor.extract_from_bytes, padded)
+        error = np.mean(np.abs(features - clean).sum(axis=1) / np.abs(clean).sum(axis=1))
+        print(f'{label:<28}{cpu:>12.2f}{wall:>14.2f}{error:>14.2e}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,290 @@
+"""Load test of the /api/predict routes against a stand-in SageMaker runtime.
+
+Starts the app from create_app with an in-memory `jobs` table and a fake runtime.sagemaker
+client with a configurable latency, drives it with synthetic WAV clips over HTTP from a
+separate load generator process and reports latency percentiles, requests per second and the
+peak RSS of the server process and its children (the feature pool workers).
+
+    python -m benchmarks.predict_load_benchmark --requests 500 --concurrency 16 --latency-ms 40
+
+App settings (MICRO_BATCH_MAX_WAIT_MS, FEATURE_POOL_WORKERS, ...) are read from the
+environment as usual, e.g. MICRO_BATCH_MAX_WAIT_MS=5 python -m benchmarks.predict_load_benchmark
+"""
+import argparse
+import io
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import threading
+import time
+import urllib.request
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
+import soundfile as sf
+
+# importing the app package creates boto3 clients, which need a region
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+from werkzeug.serving import make_server  # noqa: E402
+from app import create_app  # noqa: E402
+from app.routes import predict_routes  # noqa: E402
+from app.services.metrics import metrics  # noqa: E402
+from app.services.hedging import hedger  # noqa: E402
+from app.services.prediction_log import prediction_logger  # noqa: E402
+from app.services.prediction_cache import prediction_cache  # noqa: E402
+from app.services.tensor_codec import encode_tensor, decode_predictions, JSON_CONTENT_TYPE  # noqa: E402
+
+JOB_ID = 'load-test-job'
+CLASSES = ['dog', 'cat', 'bird', 'other']
+ENDPOINTS = ['predict', 'predict-with-display-names', 'predict-batch']
+
+
+class FakeDynamoDB:
+    # The subset of the DynamoDB client the predict routes use, backed by a dict per table
+    def __init__(self, tables):
+        self.tables = tables
+
+    def get_item(self, TableName, Key):
+        item = self.tables.get(TableName, {}).get(Key['job_id']['S'])
+        return {'Item': item} if item is not None else {}
+
+
+class FakeRuntime:
+    # Stands in for runtime.sagemaker, answers every row with random class scores
+    def __init__(self, latency_ms, jitter_ms, classes, stall_rate=0.0, stall_ms=0.0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.stall_rate = stall_rate
+        self.stall_ms = stall_ms
+        self.classes = classes
+        self.calls = 0
+        self.rows = 0
+        self._lock = threading.Lock()
+
+    def invoke_endpoint(self, EndpointName, Body, ContentType=JSON_CONTENT_TYPE, Accept=JSON_CONTENT_TYPE):
+        features = decode_predictions(Body if isinstance(Body, bytes) else Body.encode(), ContentType)
+        with self._lock:
+            self.calls += 1
+            self.rows += len(features)
+
+        latency_ms = max(0.0, random.gauss(self.latency_ms, self.jitter_ms))
+        if random.random() < self.stall_rate:
+            latency_ms += self.stall_ms
+        time.sleep(latency_ms / 1000)
+        scores = np.random.default_rng().dirichlet(np.ones(self.classes), size=len(features))
+        body = encode_tensor(scores, Accept)
+        return {'Body': io.BytesIO(body if isinstance(body, bytes) else body.encode()), 'ContentType': Accept}
+
+
+class FakeS3:
+    # Accepts the prediction log uploads and keeps their sizes
+    def __init__(self):
+        self.objects = {}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.objects[Key] = len(Body)
+
+
+def make_job_item(classes):
+    return {
+        'job_id': {'S': JOB_ID},
+        'job_name': {'S': JOB_ID},
+        'endpoint_name': {'S': 'load-test-endpoint'},
+        'training_classes': {'SS': classes},
+        'threshold': {'N': '0.5'},
+        'display_names_for_training_classes': {'L': [
+            {'M': {'class': {'S': c}, 'display_name': {'S': c.title()}, 'icon': {'S': ''}, 'color': {'S': ''}}}
+            for c in classes
+        ]}
+    }
+
+
+def make_clip(duration, sample_rate, seed):
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(duration * sample_rate)) / sample_rate
+    audio = 0.3 * np.sin(2 * np.pi * rng.uniform(100, 4000) * t) + \
+        0.05 * rng.standard_normal(len(t))
+    buffer = io.BytesIO()
+    sf.write(buffer, audio.astype(np.float32), sample_rate, format='WAV')
+    return buffer.getvalue()
+
+
+def encode_multipart(fields, files):
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, filename, data in files:
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                     f'Content-Type: audio/wav\r\n\r\n'.encode() + data + b'\r\n')
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+
+def send(url, endpoint, clips, batch_size):
+    if endpoint == 'predict-batch':
+        files = [('files', f'clip{i}.wav', random.choice(clips)) for i in range(batch_size)]
+    else:
+        files = [('file', 'clip.wav', random.choice(clips))]
+    body, content_type = encode_multipart({'job_id': JOB_ID}, files)
+    req = urllib.request.Request(f'{url}/api/predict/{endpoint}', data=body,
+                                 headers={'Content-Type': content_type})
+
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req) as response:
+            ok = json.loads(response.read())['status'] == 'success'
+    except Exception:
+        ok = False
+    return time.perf_counter() - start, ok
+
+
+_clips = []
+
+
+def make_clips(count, duration, sample_rate):
+    # Load generator process initializer, the clips are kept out of the server's memory
+    _clips.extend(make_clip(duration, sample_rate, seed) for seed in range(count))
+
+
+def run_phase(url, endpoint, batch_size, concurrency, count):
+    # Runs in the load generator process
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        start = time.perf_counter()
+        results = list(executor.map(lambda _: send(url, endpoint, _clips, batch_size), range(count)))
+        elapsed = time.perf_counter() - start
+    return os.getpid(), results, elapsed
+
+
+def child_pids(pid):
+    children = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # the command name may contain spaces, the parent pid is the second field after it
+        if int(stat.rsplit(')', 1)[1].split()[1]) == pid:
+            children.append(int(entry))
+    return children
+
+
+def vm_hwm_mb(pid):
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0.0
+
+
+def server_peak_rss_mb(exclude):
+    # Sum of the peak RSS of this process and its children other than the load generator.
+    # Pages the forked workers share with the server count once per process. Without /proc
+    # only this process is measured, ru_maxrss is in kilobytes on Linux and bytes on macOS.
+    if not os.path.isdir('/proc'):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return (peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024), 1
+    pids = [os.getpid()] + [pid for pid in child_pids(os.getpid()) if pid not in exclude]
+    return sum(vm_hwm_mb(pid) for pid in pids), len(pids)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--endpoint', choices=ENDPOINTS, default='predict')
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--latency-ms', type=float, default=40.0)
+    parser.add_argument('--jitter-ms', type=float, default=10.0)
+    parser.add_argument('--stall-rate', type=float, default=0.0,
+                        help='fraction of endpoint calls that stall')
+    parser.add_argument('--stall-ms', type=float, default=2000.0)
+    parser.add_argument('--clips', type=int, default=64,
+                        help='distinct synthetic clips, repeats hit the prediction cache')
+    parser.add_argument('--duration', type=float, default=2.0)
+    parser.add_argument('--sample-rate', type=int, default=44100)
+    parser.add_argument('--batch-size', type=int, default=8,
+                        help='files per request for predict-batch')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='disable the prediction result cache')
+    parser.add_argument('--prediction-log', action='store_true',
+                        help='log every prediction to an in-memory S3 stand-in')
+    args = parser.parse_args()
+
+    app = create_app()
+    runtime = FakeRuntime(args.latency_ms, args.jitter_ms, len(CLASSES),
+                          args.stall_rate, args.stall_ms)
+    predict_routes.dynamodb_client = FakeDynamoDB({'jobs': {JOB_ID: make_job_item(CLASSES)}})
+    predict_routes.runtime_client = runtime
+    if args.no_cache:
+        prediction_cache.configure(maxsize=0)
+    s3 = FakeS3()
+    prediction_logger.configure(s3_client=s3 if args.prediction_log else None,
+                                bucket_name='load-test', batch_size=100, flush_seconds=1)
+
+    # one access log line per request would dominate the output
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}'
+
+    # Spawned rather than forked, the server threads are already running
+    generator = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'),
+                                    initializer=make_clips,
+                                    initargs=(args.clips, args.duration, args.sample_rate))
+    try:
+        phase = (url, args.endpoint, args.batch_size, args.concurrency)
+        generator.submit(run_phase, *phase, args.warmup).result()
+        metrics.reset()
+        hedger.reset()
+        calls_before = runtime.calls
+
+        generator_pid, results, elapsed = generator.submit(run_phase, *phase, args.requests).result()
+        rss_mb, processes = server_peak_rss_mb(exclude={generator_pid})
+    finally:
+        generator.shutdown()
+        server.shutdown()
+        prediction_logger.close()
+
+    latencies = np.array([latency for latency, _ in results]) * 1000
+    errors = sum(1 for _, ok in results if not ok)
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+
+    print(f'{args.requests} x /api/predict/{args.endpoint}, concurrency {args.concurrency}, '
+          f'endpoint latency {args.latency_ms:.0f}±{args.jitter_ms:.0f} ms')
+    print(f'{"requests/s":<24}{args.requests / elapsed:>10.1f}')
+    print(f'{"p50 ms":<24}{p50:>10.1f}')
+    print(f'{"p95 ms":<24}{p95:>10.1f}')
+    print(f'{"p99 ms":<24}{p99:>10.1f}')
+    print(f'{"errors":<24}{errors:>10}')
+    print(f'{"invoke_endpoint calls":<24}{runtime.calls - calls_before:>10}')
+    print(f'{"server peak RSS MB":<24}{rss_mb:>10.1f}')
+    print(f'{"server processes":<24}{processes:>10}')
+    if args.prediction_log:
+        log_stats = prediction_logger.stats()
+        print(f'{"logged predictions":<24}{log_stats["records"]:>10}')
+        print(f'{"dropped predictions":<24}{log_stats["dropped"]:>10}')
+        print(f'{"log objects":<24}{len(s3.objects):>10}')
+    for endpoint, stats in hedger.stats()['endpoints'].items():
+        print(f'{"hedge rate":<24}{stats["hedge_rate"]:>10.3f}')
+        print(f'{"hedge win rate":<24}{stats["win_rate"]:>10.3f}')
+
+    print(f'\n{"stage":<24}{"count":>8}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}')
+    for stage, histogram in sorted(metrics.snapshot()['stages'].items()):
+        print(f'{stage:<24}{histogram["count"]:>8}{histogram["p50_ms"]:>10.2f}'
+              f'{histogram["p95_ms"]:>10.2f}{histogram["p99_ms"]:>10.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+"""Time and peak Python memory of a sounds.zip ingest against a fake S3.
+
+The old upload_zip_fast read the whole upload into bytes and every worker re-opened it with
+zipfile.ZipFile(io.BytesIO(...)) to extract one member. app.services.zip_ingest parses the
+archive once from the spooled file and feeds the upload workers through a bounded queue.
+The last rows compare a fixed worker count with adaptive concurrency against a fake S3 that
+answers SlowDown above --capacity uploads in flight.
+
+    python -m benchmarks.zip_ingest_benchmark --members 1000 --member-kb 64
+    python -m benchmarks.zip_ingest_benchmark --members 2000 --latency-ms 30 --capacity 24
+"""
+import argparse
+import io
+import os
+import tempfile
+import time
+import tracemalloc
+import zipfile
+import numpy as np
+import soundfile as sf
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from botocore.exceptions import ClientError
+
+# importing the app package creates boto3 clients, which need a region
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+from app.services.ingest_jobs import IngestJob  # noqa: E402
+from app.services.zip_ingest import ZipIngester, audio_members  # noqa: E402
+
+
+class FakeS3:
+    def __init__(self, latency, capacity=0):
+        self.latency = latency
+        self.capacity = capacity
+        self.in_flight = 0
+        self.lock = Lock()
+
+    def get_object(self, Bucket, Key):
+        # no class hash index yet
+        raise ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+
+    def put_object(self, **kwargs):
+        pass
+
+    def upload_fileobj(self, fileobj, bucket_name, key, ExtraArgs=None, Config=None):
+        with self.lock:
+            self.in_flight += 1
+            over = self.capacity and self.in_flight > self.capacity
+        try:
+            while fileobj.read(256 * 1024):
+                pass
+            time.sleep(self.latency)
+            if over:
+                raise ClientError({'Error': {'Code': 'SlowDown'}}, 'PutObject')
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+
+def write_archive(path, members, member_kb):
+    # 16-bit mono WAVs of member_kb, their last sample differs so none is deduplicated
+    buffer = io.BytesIO()
+    sf.write(buffer, np.random.default_rng(0).uniform(-0.5, 0.5, member_kb * 512), 16000,
+             format='WAV', subtype='PCM_16')
+    data = buffer.getvalue()[:-4]
+    with zipfile.ZipFile(path, 'w') as z:
+        z.writestr('sounds/', b'')
+        for i in range(members):
+            z.writestr(f'sounds/{i}.wav', data + i.to_bytes(4, 'little'))
+
+
+def reparse_per_member(s3_client, path, workers):
+    # upload_zip_fast before the ingest engine
+    with open(path, 'rb') as f:
+        z = zipfile.ZipFile(f)
+        names = [name for name in z.namelist() if name.split('/')[1] != '']
+        f.seek(0)
+        zip_file_bytes = f.read()
+
+    def upload(filename):
+        with zipfile.ZipFile(io.BytesIO(zip_file_bytes)) as z:
+            with z.open(filename) as extracted_file:
+                s3_client.upload_fileobj(extracted_file, 'bucket', f'zip_data/bench/{filename}')
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(upload, names))
+
+
+def single_pass(s3_client, path, workers, max_workers=0):
+    with open(path, 'rb') as f, zipfile.ZipFile(f) as z:
+        job = IngestJob('bench')
+        job.start()
+        ZipIngester(workers=workers, max_workers=max_workers).ingest(
+            s3_client, 'bucket', 'bench', z, audio_members(z), job)
+        job.finish()
+        return job.snapshot()
+
+
+def measure(fn, *args):
+    # timed without tracemalloc, which slows the allocation-heavy old path several times over
+    start = time.perf_counter()
+    fn(*args)
+    seconds = time.perf_counter() - start
+    tracemalloc.start()
+    fn(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return seconds, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--members', type=int, default=1000)
+    parser.add_argument('--member-kb', type=int, default=64)
+    parser.add_argument('--workers', type=int, default=5)
+    parser.add_argument('--max-workers', type=int, default=64)
+    parser.add_argument('--latency-ms', type=float, default=0.0)
+    parser.add_argument('--capacity', type=int, default=0,
+                        help='uploads in flight before the fake S3 answers SlowDown, 0 never')
+    args = parser.parse_args()
+
+    s3_client = FakeS3(args.latency_ms / 1000)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'sounds.zip')
+        write_archive(path, args.members, args.member_kb)
+        size_mb = os.path.getsize(path) / 1e6
+        print(f'{args.members} members of {args.member_kb} KB ({size_mb:.0f} MB), '
+              f'{args.workers} workers, {args.latency_ms} ms per upload')
+        print(f'{"ingest":<22}{"seconds":>10}{"objects/s":>12}{"peak MB":>10}')
+        for name, fn in [('reparse per member', reparse_per_member), ('single pass', single_pass)]:
+            seconds, peak = measure(fn, s3_client, path, args.workers)
+            print(f'{name:<22}{seconds:>10.2f}{args.members / seconds:>12.0f}{peak / 1e6:>10.1f}')
+
+        if not args.latency_ms:
+            return
+        print(f'\nupload concurrency, {args.capacity or "unlimited"} uploads in flight before SlowDown')
+        print(f'{"workers":<22}{"seconds":>10}{"objects/s":>12}{"peak":>6}{"final":>7}{"throttled":>11}{"failed":>8}')
+        for name, max_workers in [(f'fixed {args.workers}', 0),
+                                  (f'adaptive {args.workers}..{args.max_workers}', args.max_workers)]:
+            result = single_pass(FakeS3(args.latency_ms / 1000, args.capacity), path, args.workers, max_workers)
+            concurrency = result['concurrency']
+            print(f'{name:<22}{result["seconds"]:>10.2f}{result["objects_per_second"]:>12.0f}'
+                  f'{concurrency["peak"]:>6}{concurrency["final"]:>7}{concurrency["throttled"]:>11}'
+                  f'{result["failed_count"]:>8}')
+
+
+if __name__ == '__main__':
+    main()
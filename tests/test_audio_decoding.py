@@ -0,0 +1,72 @@
+import io
+import unittest
+import numpy as np
+import soundfile as sf
+import av
+from app.services.audio_decoding import detect_container, read_audio
+
+
+def encode_with_av(audio, sample_rate, container_format, codec):
+    buffer = io.BytesIO()
+    with av.open(buffer, 'w', format=container_format) as container:
+        stream = container.add_stream(codec, rate=sample_rate)
+        stream.layout = 'mono'
+        for start in range(0, len(audio), 1024):
+            frame = av.AudioFrame.from_ndarray(
+                audio[np.newaxis, start:start + 1024], format='flt', layout='mono')
+            frame.sample_rate = sample_rate
+            for packet in stream.encode(frame):
+                container.mux(packet)
+        for packet in stream.encode(None):
+            container.mux(packet)
+    return buffer.getvalue()
+
+
+class TestAudioDecoding(unittest.TestCase):
+
+    def setUp(self):
+        t = np.arange(44100) / 44100
+        self.audio = (0.3 * np.sin(2 * np.pi * 440 * t)).astype(np.float32)
+
+    def test_detect_container(self):
+        buffer = io.BytesIO()
+        sf.write(buffer, self.audio, 44100, format='WAV')
+        self.assertEqual(detect_container(buffer.getvalue()), 'wav')
+        self.assertEqual(detect_container(b'fLaC' + bytes(8)), 'flac')
+        self.assertEqual(detect_container(b'ID3' + bytes(9)), 'mp3')
+        self.assertEqual(detect_container(b'\xff\xfb' + bytes(10)), 'mp3')
+        self.assertEqual(detect_container(b'\xff\xf1' + bytes(10)), 'aac')
+        self.assertEqual(detect_container(bytes(4) + b'ftypM4A '), 'mp4')
+        self.assertIsNone(detect_container(b'not audio at all'))
+
+    def test_m4a_is_decoded_in_memory(self):
+        data = encode_with_av(self.audio, 44100, 'ipod', 'aac')
+        self.assertEqual(detect_container(data), 'mp4')
+
+        audio, native_sr, total = read_audio(data)
+        self.assertEqual(native_sr, 44100)
+        self.assertEqual(audio.dtype, np.float32)
+        # the AAC encoder adds priming samples, the tone itself survives
+        self.assertAlmostEqual(len(audio) / native_sr, 1.0, delta=0.1)
+        self.assertAlmostEqual(float(np.abs(audio).max()), 0.3, delta=0.05)
+        self.assertGreaterEqual(total, len(audio))
+
+    def test_max_duration_stops_decoding(self):
+        data = encode_with_av(self.audio, 44100, 'adts', 'aac')
+        self.assertEqual(detect_container(data), 'aac')
+
+        audio, native_sr, total = read_audio(data, max_duration=0.25)
+        self.assertEqual(len(audio), int(0.25 * native_sr))
+        self.assertGreater(total, len(audio))
+
+    def test_wav_goes_through_soundfile(self):
+        buffer = io.BytesIO()
+        sf.write(buffer, self.audio, 22050, format='WAV', subtype='FLOAT')
+        audio, native_sr, total = read_audio(buffer.getvalue(), max_duration=0.5)
+        self.assertEqual(native_sr, 22050)
+        self.assertEqual(total, len(self.audio))
+        np.testing.assert_array_equal(audio, self.audio[:11025])
+
+
+if __name__ == '__main__':
+    unittest.main()
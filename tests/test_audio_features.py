@@ -0,0 +1,123 @@
+import unittest
+import numpy as np
+import soundfile as sf
+import librosa
+import tempfile
+import io
+import os
+from unittest.mock import patch
+from app.services.audio_features import load_audio, extract_features, energy_trim_bounds, MelFeatureExtractor
+
+
+class TestAudioFeatures(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        sr = 16000
+        t = np.linspace(0, 1.0, sr, endpoint=False)
+        cls.audio = (0.5 * np.sin(2 * np.pi * 440 * t)).astype(np.float32)
+        buffer = io.BytesIO()
+        sf.write(buffer, np.stack([cls.audio, cls.audio], axis=1), sr, format='WAV')
+        cls.wav_bytes = buffer.getvalue()
+
+    def test_load_audio_matches_librosa_load(self):
+        with tempfile.NamedTemporaryFile(suffix='.wav', delete=False) as f:
+            f.write(self.wav_bytes)
+        try:
+            expected, expected_sr = librosa.load(f.name)
+        finally:
+            os.remove(f.name)
+
+        audio, sr = load_audio(self.wav_bytes)
+        self.assertEqual(sr, expected_sr)
+        self.assertEqual(audio.dtype, np.float32)
+        np.testing.assert_allclose(audio, expected, atol=1e-6)
+
+    def test_extract_features_shape(self):
+        audio, sr = load_audio(self.wav_bytes)
+        self.assertEqual(extract_features(audio, sr).shape, (128,))
+
+    def test_extract_features_matches_librosa(self):
+        audio, sr = load_audio(self.wav_bytes)
+        expected = np.mean(librosa.feature.melspectrogram(y=audio, sr=sr).T, axis=0)
+        np.testing.assert_allclose(extract_features(audio, sr), expected, rtol=1e-4)
+
+    def test_mel_basis_is_cached(self):
+        extractor = MelFeatureExtractor()
+        self.assertIs(extractor.mel_basis(22050, 2048, 128),
+                      extractor.mel_basis(22050, 2048, 128))
+
+    def test_native_rate_skips_resampling(self):
+        extractor = MelFeatureExtractor(sample_rate=None)
+        audio, sr = load_audio(self.wav_bytes, sr=None)
+        self.assertEqual(sr, 16000)
+        np.testing.assert_allclose(extractor.extract_from_bytes(self.wav_bytes),
+                                   extractor.extract(audio, sr))
+
+    def test_iter_window_features_streams_windows(self):
+        sr = 16000
+        buffer = io.BytesIO()
+        sf.write(buffer, np.tile(self.audio, 3), sr, format='WAV')
+        extractor = MelFeatureExtractor()
+
+        buffer.seek(0)
+        windows = list(extractor.iter_window_features(buffer, 1.0, 0.5))
+        buffer.seek(0)
+        small_blocks = list(extractor.iter_window_features(buffer, 1.0, 0.5, block_seconds=0.3))
+
+        self.assertEqual([start for start, _, _ in windows], [0.0, 0.5, 1.0, 1.5, 2.0])
+        self.assertEqual(len(small_blocks), len(windows))
+        self.assertEqual(windows[0][2].shape, (128,))
+        np.testing.assert_allclose(small_blocks[2][2], windows[2][2], rtol=1e-3)
+
+    def test_iter_window_features_short_recording(self):
+        buffer = io.BytesIO(self.wav_bytes)
+        windows = list(MelFeatureExtractor().iter_window_features(buffer, 5.0, 1.0))
+        self.assertEqual(len(windows), 1)
+        self.assertAlmostEqual(windows[0][1], 1.0, places=2)
+
+    def test_iter_window_features_decodes_other_containers_whole(self):
+        buffer = io.BytesIO()
+        sf.write(buffer, np.tile(self.audio, 3), 16000, format='WAV')
+        extractor = MelFeatureExtractor()
+        buffer.seek(0)
+        streamed = list(extractor.iter_window_features(buffer, 1.0, 0.5))
+
+        # as for a container libsndfile cannot read
+        buffer.seek(0)
+        with patch('app.services.audio_features.soundfile_decodes', return_value=False):
+            decoded = list(extractor.iter_window_features(buffer, 1.0, 0.5))
+        self.assertEqual([start for start, _, _ in decoded], [start for start, _, _ in streamed])
+        np.testing.assert_allclose(decoded[2][2], streamed[2][2], rtol=1e-3)
+
+
+    def test_energy_trim_drops_leading_and_trailing_silence(self):
+        audio = np.concatenate([np.zeros(8000, dtype=np.float32), self.audio, np.zeros(20000, dtype=np.float32)])
+        start, end = energy_trim_bounds(audio, top_db=60, frame_length=2048)
+        self.assertLessEqual(start, 8000)
+        self.assertGreater(start, 8000 - 2048)
+        self.assertGreaterEqual(end, 24000)
+        self.assertLess(end, 24000 + 2048)
+        self.assertEqual(energy_trim_bounds(np.zeros(5000, dtype=np.float32)), (0, 5000))
+
+    def test_decode_budget_and_trim_report_saved_work(self):
+        padded = np.concatenate([np.zeros(16000, dtype=np.float32), self.audio, np.zeros(48000, dtype=np.float32)])
+        buffer = io.BytesIO()
+        sf.write(buffer, padded, 16000, format='WAV')
+
+        extractor = MelFeatureExtractor(max_duration=2.5, trim_top_db=60)
+        info = {}
+        features = extractor.extract_from_bytes(buffer.getvalue(), info=info)
+        self.assertEqual(info['audio']['duration_seconds'], 5.0)
+        self.assertEqual(info['audio']['decoded_seconds'], 2.5)
+        self.assertLess(info['audio']['kept_seconds'], 1.3)
+        self.assertGreater(info['audio']['estimated_saved_ms'], 0)
+
+        # trimming removes the dilution of the mel mean by silent frames
+        expected = MelFeatureExtractor().extract_from_bytes(self.wav_bytes)
+        untrimmed = MelFeatureExtractor().extract_from_bytes(buffer.getvalue())
+        np.testing.assert_allclose(features, expected, rtol=0.2, atol=1e-3 * expected.max())
+        self.assertLess(np.abs(features - expected).sum(), 0.2 * np.abs(untrimmed - expected).sum())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import unittest
+import io
+import os
+import numpy as np
+import soundfile as sf
+from app.services.audio_features import audio_to_features
+from app.services.feature_pool import FeaturePool, DecodeError
+
+
+def make_wav_bytes(frequency, sr=16000):
+    t = np.linspace(0, 1.0, sr, endpoint=False)
+    buffer = io.BytesIO()
+    sf.write(buffer, 0.5 * np.sin(2 * np.pi * frequency * t), sr, format='WAV')
+    return buffer.getvalue()
+
+
+class TestFeaturePool(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.pool = FeaturePool()
+        cls.pool.configure(workers=2)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.pool.shutdown()
+
+    def test_workers_match_in_thread_extraction(self):
+        clips = [make_wav_bytes(frequency) for frequency in (220, 440, 880)]
+        features = self.pool.extract_many(clips)
+        for clip, feature in zip(clips, features):
+            np.testing.assert_allclose(feature, audio_to_features(clip), rtol=1e-6)
+
+    def test_decode_error_reports_upload_index(self):
+        with self.assertRaises(DecodeError) as context:
+            self.pool.extract_many([make_wav_bytes(440), b'not audio'])
+        self.assertEqual(context.exception.index, 1)
+
+    def test_broken_pool_is_rebuilt(self):
+        pool = FeaturePool()
+        pool.configure(workers=1)
+        try:
+            # a worker killed mid-request, e.g. for running out of memory
+            with self.assertRaises(Exception):
+                pool._executor.submit(os._exit, 1).result()
+            clip = make_wav_bytes(440)
+            np.testing.assert_allclose(pool.extract(clip), audio_to_features(clip), rtol=1e-6)
+            self.assertEqual(pool.rebuilds, 1)
+        finally:
+            pool.shutdown()
+
+    def test_disabled_pool_runs_in_thread(self):
+        pool = FeaturePool()
+        pool.configure(workers=0)
+        self.assertFalse(pool.enabled)
+        self.assertEqual(pool.extract(make_wav_bytes(440)).shape, (128,))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+import io
+import json
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock
+from botocore.exceptions import ClientError
+from app.services.hash_index import ClassHashIndex, ClassBusyError, class_lock, class_lock_or_busy, index_key
+
+
+class TestClassHashIndex(unittest.TestCase):
+
+    def test_missing_index_is_empty(self):
+        s3_client = MagicMock()
+        s3_client.get_object.side_effect = ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+        index = ClassHashIndex.load(s3_client, 'bucket', 'dog')
+        self.assertEqual(len(index), 0)
+
+        # nothing changed, nothing is written
+        index.save()
+        s3_client.put_object.assert_not_called()
+
+    def test_claim_commit_and_release(self):
+        index = ClassHashIndex(MagicMock(), 'bucket', 'dog')
+        self.assertTrue(index.claim('h1'))
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            # claimed by an upload still in flight, which may fail yet
+            second = executor.submit(index.claim, 'h1')
+            time.sleep(0.05)
+            self.assertFalse(second.done())
+            index.release('h1')
+            self.assertTrue(second.result(5))
+            third = executor.submit(index.claim, 'h1')
+            index.commit('h1', 'zip_data/dog/a.wav')
+            self.assertFalse(third.result(5))
+
+    def test_replaced_object_drops_its_old_hash(self):
+        index = ClassHashIndex(MagicMock(), 'bucket', 'dog', {'h1': 'zip_data/dog/a.wav'})
+        index.claim('h2')
+        index.commit('h2', 'zip_data/dog/a.wav')
+        self.assertEqual(index.hashes, {'h2': 'zip_data/dog/a.wav'})
+        self.assertTrue(index.claim('h1'))
+
+    def test_claim_drops_entries_of_missing_objects(self):
+        s3_client = MagicMock()
+        s3_client.head_object.side_effect = ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+        index = ClassHashIndex(s3_client, 'bucket', 'dog', {'h1': 'zip_data/dog/a.wav'})
+        self.assertTrue(index.claim('h1'))
+        s3_client.head_object.assert_called_once_with(Bucket='bucket', Key='zip_data/dog/a.wav')
+        self.assertEqual(index.hashes, {})
+        self.assertTrue(index.dirty)
+
+        # any other error is not taken as a missing object
+        s3_client.head_object.side_effect = ClientError({'Error': {'Code': '403'}}, 'HeadObject')
+        index.commit('h1', 'zip_data/dog/b.wav')
+        with self.assertRaises(ClientError):
+            index.claim('h1')
+
+    def test_move(self):
+        index = ClassHashIndex(MagicMock(), 'bucket', 'dog', {'h1': 'zip_data/dog/a.wav'})
+        index.move('zip_data/dog/a.wav', 'zip_data/dog/a_1.wav')
+        index.move('zip_data/dog/missing.wav', 'zip_data/dog/other.wav')
+        self.assertEqual(index.hashes, {'h1': 'zip_data/dog/a_1.wav'})
+        self.assertEqual(index.keys, {'zip_data/dog/a_1.wav': 'h1'})
+
+    def test_class_lock_or_busy(self):
+        with class_lock('dog'):
+            with self.assertRaises(ClassBusyError):
+                with class_lock_or_busy('dog'):
+                    pass
+        with class_lock_or_busy('dog'):
+            self.assertTrue(class_lock('dog').locked())
+        self.assertFalse(class_lock('dog').locked())
+
+    def test_remove_keys_and_save(self):
+        s3_client = MagicMock()
+        s3_client.get_object.return_value = {'Body': io.BytesIO(json.dumps({'version': 1, 'hashes': {
+            'h1': 'zip_data/dog/a.wav', 'h2': 'zip_data/dog/b.wav'}}).encode())}
+        index = ClassHashIndex.load(s3_client, 'bucket', 'dog')
+        index.remove_keys(['zip_data/dog/a.wav', 'zip_data/dog/missing.wav'])
+        index.save()
+
+        kwargs = s3_client.put_object.call_args.kwargs
+        self.assertEqual(kwargs['Key'], index_key('dog'))
+        self.assertEqual(json.loads(kwargs['Body'])['hashes'], {'h2': 'zip_data/dog/b.wav'})
+
+
+if __name__ == '__main__':
+    unittest.main()
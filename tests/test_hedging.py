@@ -0,0 +1,89 @@
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock
+from app.services.hedging import Hedger
+
+
+def warm_up(hedger, key, latency=0.0):
+    for _ in range(hedger.min_samples):
+        hedger.call(key, lambda: time.sleep(latency))
+
+
+class TestHedger(unittest.TestCase):
+
+    def test_disabled_runs_call_inline(self):
+        hedger = Hedger(max_ratio=0)
+        call = MagicMock(return_value='result')
+        self.assertEqual(hedger.call('endpoint', call), 'result')
+        call.assert_called_once()
+        self.assertEqual(hedger.stats()['endpoints'], {})
+
+    def test_stalled_call_is_hedged_and_hedge_wins(self):
+        hedger = Hedger(max_ratio=1, min_delay_ms=10, min_samples=5)
+        warm_up(hedger, 'endpoint')
+        calls = []
+
+        def call():
+            calls.append(None)
+            if len(calls) == 1:
+                time.sleep(1)
+                return 'stalled'
+            return 'hedge'
+
+        start = time.perf_counter()
+        self.assertEqual(hedger.call('endpoint', call), 'hedge')
+        self.assertLess(time.perf_counter() - start, 0.5)
+        stats = hedger.stats()['endpoints']['endpoint']
+        self.assertEqual(stats['hedges'], 1)
+        self.assertEqual(stats['hedge_wins'], 1)
+
+    def test_budget_caps_hedges(self):
+        hedger = Hedger(max_ratio=0.01, min_delay_ms=1, min_samples=5)
+        warm_up(hedger, 'endpoint')
+        self.assertEqual(hedger.call('endpoint', lambda: time.sleep(0.05) or 'slow'), 'slow')
+        stats = hedger.stats()['endpoints']['endpoint']
+        self.assertEqual(stats['hedges'], 0)
+        self.assertEqual(stats['skipped_over_budget'], 1)
+
+    def test_failed_first_answer_waits_for_the_other(self):
+        hedger = Hedger(max_ratio=1, min_delay_ms=10, min_samples=5)
+        warm_up(hedger, 'endpoint')
+        calls = []
+
+        def call():
+            calls.append(None)
+            if len(calls) == 1:
+                time.sleep(0.1)
+                return 'primary'
+            raise RuntimeError('throttled')
+
+        self.assertEqual(hedger.call('endpoint', call), 'primary')
+
+    def test_more_callers_than_workers_do_not_queue(self):
+        hedger = Hedger(max_ratio=1, min_delay_ms=200, min_samples=5, workers=2)
+        warm_up(hedger, 'endpoint')
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            results = list(executor.map(
+                lambda _: hedger.call('endpoint', lambda: time.sleep(0.05) or 'ok'), range(16)))
+        # two workers would take eight rounds of 50 ms
+        self.assertLess(time.perf_counter() - start, 0.15)
+        self.assertEqual(results, ['ok'] * 16)
+        stats = hedger.stats()['endpoints']['endpoint']
+        self.assertEqual((stats['hedges'], stats['skipped_over_budget']), (0, 0))
+
+    def test_hedges_beyond_the_workers_are_skipped(self):
+        hedger = Hedger(max_ratio=1, min_delay_ms=10, min_samples=5, workers=1)
+        warm_up(hedger, 'endpoint')
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            list(executor.map(lambda _: hedger.call('endpoint', lambda: time.sleep(0.1)), range(4)))
+        stats = hedger.stats()['endpoints']['endpoint']
+        self.assertEqual(stats['hedges'] + stats['skipped_busy'], 4)
+        self.assertGreater(stats['skipped_busy'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+import unittest
+from unittest.mock import MagicMock, patch
+import io
+import json
+import os
+import tarfile
+import time
+import numpy as np
+from app.services.inference_backends import SageMakerBackend, LocalModelBackend, LocalModelCache
+from app.services.tensor_codec import encode_tensor, NPY_CONTENT_TYPE
+
+
+JOB = {'job_name': 'job-one', 'endpoint_name': 'endpoint-123'}
+
+
+class TestInferenceBackends(unittest.TestCase):
+
+    def test_sagemaker_backend_decodes_predictions(self):
+        runtime_client = MagicMock()
+        runtime_client.invoke_endpoint.return_value = {
+            'Body': io.BytesIO(json.dumps({'predictions': [[0.2, 0.8]]}).encode())
+        }
+        predictions = SageMakerBackend(runtime_client).predict(
+            JOB, np.zeros((1, 16, 8, 1), dtype=np.float32))
+        self.assertEqual(predictions.shape, (1, 2))
+        self.assertEqual(
+            runtime_client.invoke_endpoint.call_args.kwargs['EndpointName'], 'endpoint-123')
+
+    def test_sagemaker_backend_binary_payloads(self):
+        runtime_client = MagicMock()
+        runtime_client.invoke_endpoint.return_value = {
+            'ContentType': NPY_CONTENT_TYPE,
+            'Body': io.BytesIO(encode_tensor(np.array([[0.2, 0.8]]), NPY_CONTENT_TYPE))
+        }
+        SageMakerBackend.configure(NPY_CONTENT_TYPE, NPY_CONTENT_TYPE)
+        try:
+            predictions = SageMakerBackend(runtime_client).predict(
+                JOB, np.zeros((1, 16, 8, 1), dtype=np.float32))
+        finally:
+            SageMakerBackend.configure()
+        kwargs = runtime_client.invoke_endpoint.call_args.kwargs
+        self.assertEqual(kwargs['ContentType'], NPY_CONTENT_TYPE)
+        self.assertIsInstance(kwargs['Body'], bytes)
+        np.testing.assert_allclose(predictions, [[0.2, 0.8]])
+
+    def test_sagemaker_backend_requires_endpoint(self):
+        backend = SageMakerBackend(MagicMock())
+        self.assertEqual(backend.check({'endpoint_name': None}), 'Endpoint name not found')
+
+    def test_local_backend_loads_model_once(self):
+        models = LocalModelCache()
+        s3_client = MagicMock()
+        s3_client.head_object.return_value = {'ETag': '"v1"'}
+        backend = LocalModelBackend(s3_client, 'test-bucket', models=models)
+        loader = MagicMock(return_value=('"v1"', lambda features: np.ones((len(features), 3))))
+        backend._load = loader
+
+        for _ in range(3):
+            predictions = backend.predict(JOB, np.zeros((2, 16, 8, 1), dtype=np.float32))
+
+        self.assertEqual(predictions.shape, (2, 3))
+        loader.assert_called_once_with('jobs/job-one/train_artifacts/model.tar.gz')
+        s3_client.head_object.assert_called_once()
+
+    def test_local_backend_reloads_a_retrained_model(self):
+        models = LocalModelCache(version_ttl=0.05)
+        s3_client = MagicMock()
+        s3_client.head_object.return_value = {'ETag': '"v1"'}
+        backend = LocalModelBackend(s3_client, 'test-bucket', models=models)
+        backend._load = MagicMock(return_value=('"v1"', lambda features: np.zeros((len(features), 2))))
+        features = np.zeros((1, 16, 8, 1), dtype=np.float32)
+        backend.predict(JOB, features)
+        identity = backend.identity(JOB)
+
+        # the retrain overwrote model.tar.gz, seen once the ETag is looked up again
+        s3_client.head_object.return_value = {'ETag': '"v2"'}
+        backend._load = MagicMock(return_value=('"v2"', lambda features: np.ones((len(features), 2))))
+        np.testing.assert_array_equal(backend.predict(JOB, features), [[0, 0]])
+        time.sleep(0.1)
+        np.testing.assert_array_equal(backend.predict(JOB, features), [[1, 1]])
+        self.assertNotEqual(backend.identity(JOB), identity)
+
+    def test_local_backend_removes_extracted_model(self):
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode='w:gz') as tar:
+            info = tarfile.TarInfo('model/saved_model.pb')
+            info.size = 4
+            tar.addfile(info, io.BytesIO(b'test'))
+        s3_client = MagicMock()
+        s3_client.get_object.return_value = {'Body': io.BytesIO(buffer.getvalue()), 'ETag': '"v1"'}
+        model_dirs = []
+
+        def load(model_dir):
+            model_dirs.append(model_dir)
+            self.assertTrue(os.path.exists(os.path.join(model_dir, 'model', 'saved_model.pb')))
+            return lambda features: features
+
+        with patch('app.services.inference_backends.load_tensorflow_model', side_effect=load):
+            etag, _ = LocalModelBackend(s3_client, 'test-bucket')._load('jobs/job-one/train_artifacts/model.tar.gz')
+        self.assertEqual(etag, '"v1"')
+        self.assertFalse(os.path.exists(model_dirs[0]))
+
+
+if __name__ == '__main__':
+    unittest.main()
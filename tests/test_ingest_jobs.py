@@ -0,0 +1,68 @@
+import time
+import unittest
+from threading import Event
+from app.services.ingest_jobs import IngestJob, IngestJobs
+
+
+def wait_done(job, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not job.done and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+class TestIngestJobs(unittest.TestCase):
+
+    def test_job_runs_in_the_background(self):
+        jobs = IngestJobs(min_members=10, workers=1)
+        self.assertFalse(jobs.in_background(9))
+        self.assertTrue(jobs.in_background(10))
+
+        release = Event()
+
+        def run(job):
+            job.add_uploaded(100)
+            release.wait(5)
+            job.add_failed('sounds/b.wav', Exception('SlowDown'))
+
+        job = jobs.submit(IngestJob('dog', 2), run)
+        self.assertIs(jobs.get(job.job_id), job)
+        time.sleep(0.05)
+        snapshot = job.snapshot()
+        self.assertEqual(snapshot['state'], 'running')
+        self.assertEqual(snapshot['uploaded_count'], 1)
+
+        release.set()
+        wait_done(job)
+        snapshot = job.snapshot()
+        self.assertEqual(snapshot['state'], 'succeeded')
+        self.assertEqual(snapshot['bytes'], 100)
+        self.assertEqual(snapshot['failed_files'], [{'file': 'sounds/b.wav', 'error': 'SlowDown'}])
+        self.assertIsNotNone(snapshot['finished_at'])
+
+    def test_failed_run_fails_the_job(self):
+        jobs = IngestJobs(workers=1)
+
+        def run(job):
+            raise Exception('archive is truncated')
+
+        job = jobs.submit(IngestJob('dog'), run)
+        wait_done(job)
+        self.assertEqual(job.snapshot()['state'], 'failed')
+        self.assertEqual(job.snapshot()['error'], 'archive is truncated')
+
+    def test_zero_min_members_never_runs_in_the_background(self):
+        self.assertFalse(IngestJobs(min_members=0).in_background(10 ** 6))
+
+    def test_keeps_the_last_finished_jobs(self):
+        jobs = IngestJobs(workers=1, keep=2)
+        submitted = [jobs.submit(IngestJob('dog'), lambda job: None) for _ in range(4)]
+        for job in submitted:
+            wait_done(job)
+        jobs.submit(IngestJob('dog'), lambda job: None)
+        self.assertIsNone(jobs.get(submitted[0].job_id))
+        self.assertEqual(len(jobs.list()), 2)
+        self.assertNotIn('failed_files', jobs.list()[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,9 @@
+import io
+import json
 import unittest
 from unittest.mock import MagicMock, patch
 from flask import Flask, request
+from app.services.hash_index import class_lock, index_key
 from app.services.input_data_services import DataService
 
 
@@ -60,6 +63,8 @@ class TestDataService(unittest.TestCase):
         ]
         self.mock_s3_client.copy_object.return_value = {}
         self.mock_s3_client.delete_object.return_value = {}
+        self.mock_s3_client.get_object.return_value = {'Body': io.BytesIO(json.dumps({'version': 1, 'hashes': {
+            'h1': 'zip_data/class1/file1.wav', 'h2': 'zip_data/class1/file2.wav'}}).encode())}
 
         with self.app.test_request_context('/rename', method='POST', json={'zip_class_name': 'class1', 'input_class_name': 'class2'}):
             with self.app.app_context():
@@ -68,6 +73,25 @@ class TestDataService(unittest.TestCase):
                 self.assertEqual(response.get_json()['status'], 'success')
                 self.assertIn('renamed_files', response.get_json())
 
+        # the content hash index follows the renamed object
+        new_key = response.get_json()['renamed_files'][0]['new_filename']
+        kwargs = self.mock_s3_client.put_object.call_args.kwargs
+        self.assertEqual(kwargs['Key'], index_key('class1'))
+        self.assertEqual(json.loads(kwargs['Body'])['hashes'],
+                         {'h1': 'zip_data/class1/file1.wav', 'h2': new_key})
+
+    def test_rename_class_being_ingested(self):
+        self.mock_s3_client.list_objects_v2.side_effect = [
+            {'Contents': [{'Key': 'zip_data/class1/file2.wav'}]},
+            {'Contents': [{'Key': 'input_data/class2/file2.wav'}]}
+        ]
+        self.mock_s3_client.copy_object.reset_mock()
+        with class_lock('class1'):
+            with self.app.test_request_context('/rename', method='POST', json={'zip_class_name': 'class1', 'input_class_name': 'class2'}):
+                response, status_code = self.data_service.rename(request)
+        self.assertEqual(status_code, 409)
+        self.mock_s3_client.copy_object.assert_not_called()
+
     # Test cases for `get_class_count`
     def test_get_class_count_missing_class_name(self):
         with self.app.test_request_context('/class-count', method='POST', json={}):
@@ -0,0 +1,50 @@
+import unittest
+from app.services.metrics import Histogram, MetricsRegistry, StageTimer
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_histogram_quantiles_use_bucket_bounds(self):
+        histogram = Histogram(buckets=[0.01, 0.1, 1.0, float('inf')])
+        for value in [0.005] * 90 + [0.05] * 9 + [0.5]:
+            histogram.observe(value)
+        snapshot = histogram.snapshot()
+        self.assertEqual(snapshot['count'], 100)
+        self.assertEqual(snapshot['p50_ms'], 10.0)
+        self.assertEqual(snapshot['p95_ms'], 100.0)
+        self.assertEqual(snapshot['p99_ms'], 100.0)
+        self.assertEqual(snapshot['max_ms'], 500.0)
+
+    def test_stage_timer_records_per_stage_and_per_job(self):
+        registry = MetricsRegistry()
+        timer = StageTimer('job-1', registry=registry)
+        with timer.stage('decode'):
+            pass
+        timer.record('invoke_endpoint', 0.2)
+        timer.info['threshold'] = '0.5'
+        timer.finish()
+
+        snapshot = registry.snapshot()
+        self.assertEqual(set(snapshot['stages']), {'decode', 'invoke_endpoint', 'total'})
+        self.assertEqual(snapshot['jobs']['job-1']['invoke_endpoint']['count'], 1)
+        report = timer.report()
+        self.assertEqual(report['threshold'], '0.5')
+        self.assertEqual(report['stages_ms']['invoke_endpoint'], 200.0)
+
+    def test_stage_timer_attaches_job_after_lookup(self):
+        registry = MetricsRegistry()
+        timer = StageTimer(registry=registry)
+        timer.record('job_lookup', 0.01)
+        # an unknown job_id is never attached
+        StageTimer(registry=registry).record('job_lookup', 0.01)
+        timer.attach('job-1')
+        timer.record('inference', 0.1)
+
+        snapshot = registry.snapshot()
+        self.assertEqual(snapshot['stages']['job_lookup']['count'], 2)
+        self.assertEqual(list(snapshot['jobs']), ['job-1'])
+        self.assertEqual(set(snapshot['jobs']['job-1']), {'job_lookup', 'inference'})
+
+
+if __name__ == '__main__':
+    unittest.main()
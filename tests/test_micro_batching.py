@@ -0,0 +1,95 @@
+import unittest
+from unittest.mock import MagicMock
+from concurrent.futures import ThreadPoolExecutor
+from threading import Barrier, Event, enumerate as threads
+import time
+import numpy as np
+from app.services.micro_batching import MicroBatcher
+
+
+class TestMicroBatcher(unittest.TestCase):
+
+    def test_disabled_calls_backend_directly(self):
+        batcher = MicroBatcher(max_wait_ms=0)
+        predict_fn = MagicMock(return_value=np.array([[0.3, 0.7]]))
+        predictions = batcher.predict('endpoint', np.zeros((1, 16, 8, 1)), predict_fn)
+        np.testing.assert_array_equal(predictions, [[0.3, 0.7]])
+        self.assertEqual(batcher.stats()['batches'], 0)
+
+    def test_concurrent_requests_share_one_call(self):
+        batcher = MicroBatcher(max_batch_size=4, max_wait_ms=500)
+        predict_fn = MagicMock(side_effect=lambda batch: batch.reshape(len(batch), -1)[:, :2])
+        barrier = Barrier(4)
+
+        def submit(value):
+            barrier.wait()
+            features = np.full((1, 16, 8, 1), value, dtype=np.float32)
+            return batcher.predict('endpoint', features, predict_fn)
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(submit, range(4)))
+
+        predict_fn.assert_called_once()
+        self.assertEqual(predict_fn.call_args[0][0].shape, (4, 16, 8, 1))
+        for value, predictions in enumerate(results):
+            np.testing.assert_array_equal(predictions, [[value, value]])
+
+    def test_backend_errors_reach_every_request(self):
+        batcher = MicroBatcher(max_batch_size=2, max_wait_ms=1)
+        predict_fn = MagicMock(side_effect=RuntimeError('endpoint down'))
+        with self.assertRaises(RuntimeError):
+            batcher.predict('endpoint', np.zeros((1, 16, 8, 1)), predict_fn)
+
+    def test_next_batch_is_sent_while_one_is_in_flight(self):
+        batcher = MicroBatcher(max_batch_size=2, max_wait_ms=1, max_in_flight=2)
+        first_started, release = Event(), Event()
+
+        def predict_fn(batch):
+            if not first_started.is_set():
+                first_started.set()
+                release.wait(5)
+            return batch.reshape(len(batch), -1)[:, :2]
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            blocked = executor.submit(batcher.predict, 'endpoint', np.zeros((1, 16, 8, 1)), predict_fn)
+            self.assertTrue(first_started.wait(5))
+            # the first batch is still waiting on the endpoint
+            second = batcher.predict('endpoint', np.ones((1, 16, 8, 1)), predict_fn)
+            np.testing.assert_array_equal(second, [[1, 1]])
+            release.set()
+            np.testing.assert_array_equal(blocked.result(5), [[0, 0]])
+
+    def test_short_response_fails_unmatched_rows(self):
+        batcher = MicroBatcher(max_batch_size=2, max_wait_ms=500)
+        predict_fn = MagicMock(return_value=np.array([[0.3, 0.7]]))
+        barrier = Barrier(2)
+
+        def submit(_):
+            barrier.wait()
+            try:
+                return batcher.predict('endpoint', np.zeros((1, 16, 8, 1)), predict_fn)
+            except ValueError as e:
+                return e
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            results = list(executor.map(submit, range(2)))
+
+        predict_fn.assert_called_once()
+        self.assertEqual(sum(isinstance(result, ValueError) for result in results), 1)
+
+    def test_idle_keys_stop_their_thread(self):
+        batcher = MicroBatcher(max_batch_size=2, max_wait_ms=1, idle_seconds=0.05)
+        predict_fn = MagicMock(return_value=np.array([[0.3, 0.7]]))
+        batcher.predict('local:model@etag-1', np.zeros((1, 16, 8, 1)), predict_fn)
+        self.assertEqual(batcher.stats()['models'], 1)
+        time.sleep(0.3)
+        self.assertEqual(batcher.stats()['models'], 0)
+        self.assertNotIn('micro-batcher-local:model@etag-1', [thread.name for thread in threads()])
+
+        # the key starts again on its next prediction
+        np.testing.assert_array_equal(
+            batcher.predict('local:model@etag-1', np.zeros((1, 16, 8, 1)), predict_fn), [[0.3, 0.7]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,6 +2,35 @@ import unittest
 from unittest.mock import MagicMock, patch
 from flask import Flask, request
 from app.services.predict_services import PredictService
+from app.services.job_cache import job_cache, get_approved_job_records, invalidate_job
+from app.services.prediction_cache import prediction_cache
+from app.services.inference_backends import local_model_cache
+from app.services.metrics import metrics
+import numpy as np
+import soundfile as sf
+import json
+import time
+import io
+from concurrent.futures import ThreadPoolExecutor
+
+
+def make_wav_bytes(duration=1.0, sr=16000):
+    t = np.linspace(0, duration, int(sr * duration), endpoint=False)
+    audio = 0.5 * np.sin(2 * np.pi * 440 * t)
+    buffer = io.BytesIO()
+    sf.write(buffer, audio, sr, format='WAV')
+    return buffer.getvalue()
+
+
+JOB_ITEM = {
+    'endpoint_name': {'S': 'endpoint-123'},
+    'training_classes': {'SS': ['dog', 'cat', 'other']},
+    'threshold': {'N': '0.5'},
+    'display_names_for_training_classes': {'L': [
+        {'M': {'class': {'S': c}, 'display_name': {'S': c.title()}, 'icon': {'S': 'icon'}, 'color': {'S': 'red'}}}
+        for c in ['dog', 'cat', 'other']
+    ]}
+}
 
 
 class TestPredictService(unittest.TestCase):
@@ -19,6 +48,10 @@ class TestPredictService(unittest.TestCase):
         cls.predict_service = PredictService(
             cls.mock_s3_client, cls.mock_sagemaker_client, cls.mock_dynamodb_client, cls.bucket_name, cls.role_arn)
 
+    def setUp(self):
+        job_cache.clear()
+        prediction_cache.clear()
+
     # 1. Test cases for `add_threshold`
     def test_add_threshold_missing_job_id(self):
         with self.app.test_request_context('/add-threshold', method='POST', json={'threshold': 0.5}):
@@ -100,6 +133,347 @@ class TestPredictService(unittest.TestCase):
             self.assertIn('job_id does not exist',
                           response.get_json()['message'])
 
+    def test_predict_with_display_names_decodes_in_memory(self):
+        self.mock_dynamodb_client.get_item.return_value = {'Item': JOB_ITEM}
+        self.predict_service.runtime_client = MagicMock()
+        self.predict_service.runtime_client.invoke_endpoint.return_value = {
+            'Body': io.BytesIO(json.dumps({'predictions': [[0.1, 0.8, 0.1]]}).encode())
+        }
+        with patch('app.services.audio_decoding.sf.SoundFile', wraps=sf.SoundFile) as mock_read:
+            with self.app.test_request_context('/predict-with-display-names', method='POST', data={'job_id': 'job-1234', 'file': (io.BytesIO(make_wav_bytes()), 'test.wav')}):
+                response, status_code = self.predict_service.predict_with_display_names(
+                    request)
+            self.assertEqual(status_code, 200)
+            self.assertEqual(response.get_json()['prediction'], 'cat')
+            self.assertIsInstance(mock_read.call_args[0][0], io.BytesIO)
+
+    # 7. Test cases for `predict_batch`
+    def test_predict_batch_single_endpoint_call(self):
+        self.mock_dynamodb_client.get_item.return_value = {'Item': JOB_ITEM}
+        self.predict_service.runtime_client = MagicMock()
+        self.predict_service.runtime_client.invoke_endpoint.return_value = {
+            'Body': io.BytesIO(json.dumps({'predictions': [[0.9, 0.05, 0.05], [0.1, 0.8, 0.1], [0.4, 0.3, 0.3]]}).encode())
+        }
+        files = [(io.BytesIO(make_wav_bytes()), f'clip{i}.wav') for i in range(3)]
+        with self.app.test_request_context('/predict-batch', method='POST', data={'job_id': 'job-1234', 'files': files}):
+            response, status_code = self.predict_service.predict_batch(request)
+        self.assertEqual(status_code, 200)
+        self.predict_service.runtime_client.invoke_endpoint.assert_called_once()
+        body = json.loads(
+            self.predict_service.runtime_client.invoke_endpoint.call_args.kwargs['Body'])
+        self.assertEqual(np.array(body).shape, (3, 16, 8, 1))
+        results = response.get_json()['results']
+        self.assertEqual([r['prediction'] for r in results], ['dog', 'cat', 'other'])
+        self.assertEqual(results[2]['display']['display_name'], 'Other')
+        self.assertEqual(results[1]['file'], 'clip1.wav')
+
+    def test_predict_batch_short_endpoint_response(self):
+        self.mock_dynamodb_client.get_item.return_value = {'Item': JOB_ITEM}
+        self.predict_service.runtime_client = MagicMock()
+        self.predict_service.runtime_client.invoke_endpoint.return_value = {
+            'Body': io.BytesIO(json.dumps({'predictions': [[0.9, 0.05, 0.05], [0.1, 0.8, 0.1]]}).encode())
+        }
+        files = [(io.BytesIO(make_wav_bytes()), f'clip{i}.wav') for i in range(3)]
+        with self.app.test_request_context('/predict-batch', method='POST', data={'job_id': 'job-1234', 'files': files}):
+            response, status_code = self.predict_service.predict_batch(request)
+        self.assertEqual(status_code, 500)
+        self.assertIn('2 predictions for a batch of 3 rows', response.get_json()['message'])
+
+    def test_predict_batch_missing_files(self):
+        with self.app.test_request_context('/predict-batch', method='POST', data={'job_id': 'job-1234'}):
+            response, status_code = self.predict_service.predict_batch(request)
+            self.assertEqual(status_code, 400)
+            self.assertIn('Files are required', response.get_json()['message'])
+
+    # 8. Test cases for the job metadata cache
+    def test_predict_reuses_cached_job(self):
+        self.mock_dynamodb_client.get_item.reset_mock()
+        self.mock_dynamodb_client.get_item.return_value = {'Item': JOB_ITEM}
+        self.predict_service.runtime_client = MagicMock()
+        self.predict_service.runtime_client.invoke_endpoint.side_effect = lambda **kwargs: {
+            'Body': io.BytesIO(json.dumps({'predictions': [[0.1, 0.8, 0.1]]}).encode())
+        }
+        for _ in range(2):
+            with self.app.test_request_context('/predict-with-display-names', method='POST', data={'job_id': 'job-1234', 'file': (io.BytesIO(make_wav_bytes()), 'test.wav')}):
+                response, status_code = self.predict_service.predict_with_display_names(
+                    request)
+            self.assertEqual(status_code, 200)
+        self.assertEqual(self.mock_dynamodb_client.get_item.call_count, 1)
+
+    def test_add_threshold_invalidates_cached_job(self):
+        job_cache.set('job-1234', {'endpoint_name': 'endpoint-123'})
+        self.mock_dynamodb_client.get_item.return_value = {'Item': JOB_ITEM}
+        self.mock_sagemaker_client.describe_endpoint.return_value = {
+            'EndpointStatus': 'InService'
+        }
+        self.mock_dynamodb_client.update_item.return_value = {
+            'ResponseMetadata': {'HTTPStatusCode': 200}}
+        with self.app.test_request_context('/add-threshold', method='POST', json={'job_id': 'job-1234', 'threshold': 0.7}):
+            response, status_code = self.predict_service.add_threshold(request)
+        self.assertEqual(status_code, 200)
+        self.assertIsNone(job_cache.get('job-1234'))
+
+    # 9. Test cases for the inference backends
+    def test_predict_with_display_names_local_backend(self):
+        item = dict(JOB_ITEM, job_name={'S': 'job-one'}, inference_backend={'S': 'local'})
+        del item['endpoint_name']
+        self.mock_dynamodb_client.get_item.return_value = {'Item': item}
+        self.predict_service.runtime_client = MagicMock()
+        local_model_cache.register('jobs/job-one/train_artifacts/model.tar.gz',
+                                   lambda features: np.tile([0.1, 0.1, 0.8], (len(features), 1)))
+        try:
+            with self.app.test_request_context('/predict-with-display-names', method='POST', data={'job_id': 'job-1234', 'file': (io.BytesIO(make_wav_bytes()), 'test.wav')}):
+                response, status_code = self.predict_service.predict_with_display_names(
+                    request)
+        finally:
+            local_model_cache.clear()
+        self.assertEqual(status_code, 200)
+        self.assertEqual(response.get_json()['prediction'], 'other')
+        self.predict_service.runtime_client.invoke_endpoint.assert_not_called()
+
+    def test_set_inference_backend_invalid_backend(self):
+        with self.app.test_request_context('/set-inference-backend', method='POST', json={'job_id': 'job-1234', 'inference_backend': 'gpu'}):
+            response, status_code = self.predict_service.set_inference_backend(
+                request)
+            self.assertEqual(status_code, 400)
+            self.assertIn('inference_backend must be one of',
+                          response.get_json()['message'])
+
+    # 10. Test cases for `predict_windows`
+    def test_predict_windows_timeline_and_segments(self):
+        self.mock_dynamodb_client.get_item.return_value = {'Item': JOB_ITEM}
+        self.predict_service.runtime_client = MagicMock()
+        self.predict_service.runtime_client.invoke_endpoint.return_value = {
+            'Body': io.BytesIO(json.dumps({'predictions': [[0.9, 0.05, 0.05]] * 3 + [[0.1, 0.1, 0.8]] * 2}).encode())
+        }
+        data = {'job_id': 'job-1234', 'window_seconds': '1', 'hop_seconds': '0.5',
+                'file': (io.BytesIO(make_wav_bytes(duration=3.0)), 'long.wav')}
+        with self.app.test_request_context('/predict-windows', method='POST', data=data):
+            response, status_code = self.predict_service.predict_windows(request)
+        self.assertEqual(status_code, 200)
+        self.predict_service.runtime_client.invoke_endpoint.assert_called_once()
+        body = response.get_json()
+        self.assertEqual(len(body['timeline']), 5)
+        self.assertEqual(body['segments'], [{
+            'prediction': 'dog', 'display': body['timeline'][0]['display'],
+            'start': 0.0, 'end': 2.0, 'probability': 0.9, 'max_probability': 0.9}])
+
+    def test_predict_windows_invalid_hop(self):
+        data = {'job_id': 'job-1234', 'window_seconds': '1', 'hop_seconds': '2',
+                'file': (io.BytesIO(make_wav_bytes()), 'long.wav')}
+        with self.app.test_request_context('/predict-windows', method='POST', data=data):
+            response, status_code = self.predict_service.predict_windows(request)
+        self.assertEqual(status_code, 400)
+
+    def test_predict_windows_undecodable_upload(self):
+        self.mock_dynamodb_client.get_item.return_value = {'Item': JOB_ITEM}
+        data = {'job_id': 'job-1234', 'file': (io.BytesIO(b'RIFF\x00\x00\x00\x00WAVEnot audio'), 'broken.wav')}
+        with self.app.test_request_context('/predict-windows', method='POST', data=data):
+            response, status_code = self.predict_service.predict_windows(request)
+        self.assertEqual(status_code, 400)
+        self.assertIn('Could not decode broken.wav', response.get_json()['message'])
+
+    # 11. Test cases for the prediction result cache
+    def test_repeated_upload_served_from_prediction_cache(self):
+        self.predict_service.runtime_client = MagicMock()
+        self.predict_service.runtime_client.invoke_endpoint.side_effect = lambda **kwargs: {
+            'Body': io.BytesIO(json.dumps({'predictions': [[0.1, 0.8, 0.1]]}).encode())
+        }
+        wav = make_wav_bytes()
+        for threshold in ['0.5', '0.5', '0.6']:
+            job_cache.clear()
+            item = dict(JOB_ITEM, threshold={'N': threshold})
+            self.mock_dynamodb_client.get_item.return_value = {'Item': item}
+            with self.app.test_request_context('/predict-with-display-names', method='POST', data={'job_id': 'job-1234', 'file': (io.BytesIO(wav), 'test.wav')}):
+                response, status_code = self.predict_service.predict_with_display_names(
+                    request)
+            self.assertEqual(status_code, 200)
+            self.assertEqual(response.get_json()['prediction'], 'cat')
+        # the second upload is a cache hit, the threshold change misses again
+        self.assertEqual(
+            self.predict_service.runtime_client.invoke_endpoint.call_count, 2)
+
+    # 12. Test cases for the per-stage timings
+    def test_debug_header_returns_stage_timings(self):
+        self.mock_dynamodb_client.get_item.return_value = {'Item': JOB_ITEM}
+        self.predict_service.runtime_client = MagicMock()
+        self.predict_service.runtime_client.invoke_endpoint.side_effect = lambda **kwargs: {
+            'Body': io.BytesIO(json.dumps({'predictions': [[0.1, 0.8, 0.1]]}).encode())
+        }
+        wav = make_wav_bytes()
+        for headers in [{}, {'X-Debug-Timings': '1'}]:
+            with self.app.test_request_context('/predict', method='POST', headers=headers, data={'job_id': 'job-1234', 'file': (io.BytesIO(wav), 'test.wav')}):
+                response, status_code = self.predict_service.predict(request)
+            self.assertEqual(status_code, 200)
+
+        timings = response.get_json()['timings']
+        self.assertEqual(timings['threshold'], '0.5')
+        self.assertTrue(timings['cache_hit'])
+        self.assertIn('job_lookup', timings['stages_ms'])
+        self.assertIn('total', timings['stages_ms'])
+
+        with self.app.app_context():
+            response, status_code = self.predict_service.get_metrics()
+        stages = response.get_json()['metrics']['stages']
+        for stage in ['decode', 'features', 'invoke_endpoint', 'decode_response', 'postprocess']:
+            self.assertGreaterEqual(stages[stage]['count'], 1)
+
+    def test_unknown_job_ids_do_not_add_job_metrics(self):
+        metrics.reset()
+        self.mock_dynamodb_client.get_item.return_value = {}
+        for i in range(5):
+            job_cache.clear()
+            with self.app.test_request_context('/predict', method='POST', data={'job_id': f'bogus-{i}', 'file': (io.BytesIO(b'x'), 'test.wav')}):
+                response, status_code = self.predict_service.predict(request)
+            self.assertEqual(status_code, 404)
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['jobs'], {})
+        self.assertEqual(snapshot['stages']['job_lookup']['count'], 5)
+
+    def test_batch_and_window_routes_are_timed(self):
+        metrics.reset()
+        self.mock_dynamodb_client.get_item.return_value = {'Item': JOB_ITEM}
+        self.predict_service.runtime_client = MagicMock()
+        self.predict_service.runtime_client.invoke_endpoint.side_effect = lambda **kwargs: {
+            'Body': io.BytesIO(json.dumps({'predictions': [[0.9, 0.05, 0.05]] * len(json.loads(kwargs['Body']))}).encode())
+        }
+        files = [(io.BytesIO(make_wav_bytes()), f'clip{i}.wav') for i in range(2)]
+        with self.app.test_request_context('/predict-batch', method='POST', headers={'X-Debug-Timings': '1'}, data={'job_id': 'job-1234', 'files': files}):
+            response, status_code = self.predict_service.predict_batch(request)
+        self.assertEqual(status_code, 200)
+        self.assertIn('batch_features', response.get_json()['timings']['stages_ms'])
+
+        data = {'job_id': 'job-1234', 'window_seconds': '1', 'file': (io.BytesIO(make_wav_bytes(duration=2.0)), 'long.wav')}
+        with self.app.test_request_context('/predict-windows', method='POST', data=data):
+            response, status_code = self.predict_service.predict_windows(request)
+        self.assertEqual(status_code, 200)
+
+        stages = metrics.snapshot()['jobs']['job-1234']
+        self.assertEqual(stages['total']['count'], 2)
+        self.assertEqual(stages['window_features']['count'], 1)
+        self.assertEqual(stages['inference']['count'], 2)
+
+    # 13. Test cases for `stream_predict`
+    def test_stream_predict_pushes_predictions_per_hop(self):
+        self.mock_dynamodb_client.get_item.reset_mock()
+        self.mock_dynamodb_client.get_item.return_value = {'Item': JOB_ITEM}
+        self.predict_service.runtime_client = MagicMock()
+        self.predict_service.runtime_client.invoke_endpoint.side_effect = lambda **kwargs: {
+            'Body': io.BytesIO(json.dumps({'predictions': [[0.9, 0.05, 0.05]] * len(json.loads(kwargs['Body']))}).encode())
+        }
+        t = np.arange(16000 * 2) / 16000
+        pcm = (0.3 * np.sin(2 * np.pi * 440 * t) * 32767).astype('<i2').tobytes()
+        ws = MagicMock()
+        ws.receive.side_effect = [pcm[i:i + 3200] for i in range(0, len(pcm), 3200)] + ['end']
+        with self.app.test_request_context('/stream?job_id=job-1234&sample_rate=16000&hop_seconds=0.5'):
+            self.predict_service.stream_predict(ws, request)
+
+        messages = [json.loads(call.args[0]) for call in ws.send.call_args_list]
+        self.assertEqual(messages[0]['type'], 'ready')
+        self.assertEqual(len(messages), 3)
+        self.assertEqual(messages[1]['prediction'], 'dog')
+        self.assertEqual(messages[1]['display']['display_name'], 'Dog')
+        self.mock_dynamodb_client.get_item.assert_called_once()
+
+    def test_stream_predict_rejects_unknown_format(self):
+        ws = MagicMock()
+        with self.app.test_request_context('/stream?job_id=job-1234&format=mp3'):
+            self.predict_service.stream_predict(ws, request)
+        self.assertEqual(json.loads(ws.send.call_args[0][0])['status'], 'fail')
+        ws.receive.assert_not_called()
+
+    # 14. Test cases for `predict_features`
+    def test_predict_features_json_vector(self):
+        self.mock_dynamodb_client.get_item.return_value = {'Item': JOB_ITEM}
+        self.predict_service.runtime_client = MagicMock()
+        self.predict_service.runtime_client.invoke_endpoint.return_value = {
+            'Body': io.BytesIO(json.dumps({'predictions': [[0.1, 0.8, 0.1]]}).encode())
+        }
+        with self.app.test_request_context('/predict-features', method='POST', json={'job_id': 'job-1234', 'features': [0.5] * 128}):
+            response, status_code = self.predict_service.predict_features(request)
+        self.assertEqual(status_code, 200)
+        self.assertEqual(response.get_json()['prediction'], 'cat')
+        self.assertEqual(response.get_json()['display']['display_name'], 'Cat')
+        sent = json.loads(self.predict_service.runtime_client.invoke_endpoint.call_args.kwargs['Body'])
+        self.assertEqual(np.asarray(sent).shape, (1, 16, 8, 1))
+
+    def test_predict_features_npy_batch(self):
+        self.mock_dynamodb_client.get_item.return_value = {'Item': JOB_ITEM}
+        self.predict_service.runtime_client = MagicMock()
+        self.predict_service.runtime_client.invoke_endpoint.return_value = {
+            'Body': io.BytesIO(json.dumps({'predictions': [[0.9, 0.05, 0.05], [0.2, 0.2, 0.6]]}).encode())
+        }
+        buffer = io.BytesIO()
+        np.save(buffer, np.ones((2, 128), dtype=np.float32))
+        with self.app.test_request_context('/predict-features?job_id=job-1234', method='POST', data=buffer.getvalue(), content_type='application/x-npy'):
+            response, status_code = self.predict_service.predict_features(request)
+        self.assertEqual(status_code, 200)
+        self.assertEqual([r['prediction'] for r in response.get_json()['results']], ['dog', 'other'])
+
+    def test_predict_features_wrong_shape(self):
+        with self.app.test_request_context('/predict-features', method='POST', json={'job_id': 'job-1234', 'features': [0.5] * 100}):
+            response, status_code = self.predict_service.predict_features(request)
+        self.assertEqual(status_code, 400)
+        self.assertIn('(16, 8, 1)', response.get_json()['message'])
+
+    # 15. Test cases for `predict_ensemble`
+    def test_predict_ensemble_fans_out_concurrently(self):
+        items = [dict(JOB_ITEM, job_id={'S': f'job-{i}'}, endpoint_name={'S': f'endpoint-{i}'}) for i in range(3)]
+        items.append(dict(JOB_ITEM, job_id={'S': 'job-no-endpoint'}, endpoint_name={'S': ''}))
+        self.mock_dynamodb_client.scan.return_value = {'Items': items}
+        scores = {'endpoint-0': [0.9, 0.05, 0.05], 'endpoint-1': [0.2, 0.7, 0.1], 'endpoint-2': [0.8, 0.1, 0.1]}
+
+        def invoke_endpoint(**kwargs):
+            time.sleep(0.2)
+            return {'Body': io.BytesIO(json.dumps({'predictions': [scores[kwargs['EndpointName']]]}).encode())}
+
+        self.predict_service.runtime_client = MagicMock()
+        self.predict_service.runtime_client.invoke_endpoint.side_effect = invoke_endpoint
+        start = time.perf_counter()
+        with self.app.test_request_context('/predict-ensemble', method='POST', data={'file': (io.BytesIO(make_wav_bytes()), 'test.wav')}):
+            response, status_code = self.predict_service.predict_ensemble(request)
+        self.assertLess(time.perf_counter() - start, 0.5)
+
+        self.assertEqual(status_code, 200)
+        body = response.get_json()
+        self.assertEqual(body['prediction'], 'dog')
+        self.assertEqual(body['votes'], 2)
+        self.assertAlmostEqual(body['probability'], 0.85)
+        self.assertEqual([model['status'] for model in body['models']], ['success'] * 3 + ['fail'])
+
+    def test_concurrent_ensemble_requests_do_not_share_workers(self):
+        items = [dict(JOB_ITEM, job_id={'S': f'job-{i}'}, endpoint_name={'S': f'endpoint-{i}'}) for i in range(3)]
+        self.mock_dynamodb_client.scan.return_value = {'Items': items}
+
+        def invoke_endpoint(**kwargs):
+            time.sleep(0.3)
+            return {'Body': io.BytesIO(json.dumps({'predictions': [[0.9, 0.05, 0.05]]}).encode())}
+
+        self.predict_service.runtime_client = MagicMock()
+        self.predict_service.runtime_client.invoke_endpoint.side_effect = invoke_endpoint
+
+        def ensemble(_):
+            with self.app.test_request_context('/predict-ensemble', method='POST', data={'file': (io.BytesIO(make_wav_bytes()), 'test.wav')}):
+                return self.predict_service.predict_ensemble(request)[1]
+
+        start = time.perf_counter()
+        with patch('app.services.predict_services.ENSEMBLE_MAX_WORKERS', 3), ThreadPoolExecutor(max_workers=2) as executor:
+            status_codes = list(executor.map(ensemble, range(2)))
+        # one shared pool of 3 threads would need two rounds of endpoint calls
+        self.assertLess(time.perf_counter() - start, 0.55)
+        self.assertEqual(status_codes, [200, 200])
+
+    def test_approved_jobs_cached_until_a_job_changes(self):
+        self.mock_dynamodb_client.scan.reset_mock()
+        self.mock_dynamodb_client.scan.side_effect = [
+            {'Items': [JOB_ITEM], 'LastEvaluatedKey': {'job_id': {'S': 'a'}}}, {'Items': [JOB_ITEM]},
+            {'Items': []}]
+        self.assertEqual(len(get_approved_job_records(self.mock_dynamodb_client)), 2)
+        self.assertEqual(len(get_approved_job_records(self.mock_dynamodb_client)), 2)
+        invalidate_job('job-1234')
+        self.assertEqual(get_approved_job_records(self.mock_dynamodb_client), [])
+        self.assertEqual(self.mock_dynamodb_client.scan.call_count, 3)
+        self.mock_dynamodb_client.scan.side_effect = None
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,141 @@
+import gzip
+import json
+import signal
+import time
+import unittest
+from unittest.mock import MagicMock
+from app.services.prediction_log import PredictionLogger, prediction_records
+
+RESULT = {'status': 'success', 'prediction': 'cat', 'probability': 0.8,
+          'prediction_data': {'predictions': [[0.1, 0.8, 0.1]]}}
+
+
+def written_records(s3_client):
+    records = []
+    for call in s3_client.put_object.call_args_list:
+        body = gzip.decompress(call.kwargs['Body']).decode()
+        records.extend(json.loads(line) for line in body.splitlines())
+    return records
+
+
+class TestPredictionLogger(unittest.TestCase):
+
+    def test_disabled_without_bucket(self):
+        logger = PredictionLogger()
+        logger.log('/predict', 'job-1', RESULT, 12.0)
+        self.assertFalse(logger.stats()['enabled'])
+        self.assertIsNone(logger._thread)
+
+    def test_flushes_full_batches_and_on_close(self):
+        s3_client = MagicMock()
+        logger = PredictionLogger()
+        logger.configure(s3_client, 'bucket', batch_size=2, flush_seconds=60)
+        for _ in range(3):
+            logger.log('/predict', 'job-1', RESULT, 12.0)
+        logger.close()
+
+        self.assertEqual(s3_client.put_object.call_count, 2)
+        self.assertTrue(s3_client.put_object.call_args.kwargs['Key'].startswith('prediction_logs/date='))
+        records = written_records(s3_client)
+        self.assertEqual(len(records), 3)
+        self.assertEqual(records[0]['job_id'], 'job-1')
+        self.assertEqual(records[0]['probabilities'], [0.1, 0.8, 0.1])
+        self.assertEqual(logger.stats()['records'], 3)
+
+    def test_flushes_after_flush_seconds(self):
+        s3_client = MagicMock()
+        logger = PredictionLogger()
+        logger.configure(s3_client, 'bucket', batch_size=100, flush_seconds=0.05)
+        logger.log('/predict', 'job-1', RESULT, 12.0)
+        time.sleep(0.3)
+        self.assertEqual(s3_client.put_object.call_count, 1)
+        logger.close()
+
+    def test_full_queue_drops_and_counts(self):
+        s3_client = MagicMock()
+        s3_client.put_object.side_effect = lambda **kwargs: time.sleep(0.2)
+        logger = PredictionLogger()
+        logger.configure(s3_client, 'bucket', queue_size=2, batch_size=1)
+        for _ in range(10):
+            logger.log('/predict', 'job-1', RESULT, 12.0)
+        self.assertGreater(logger.stats()['dropped'], 0)
+        logger.close()
+
+    def test_close_drains_a_full_queue(self):
+        s3_client = MagicMock()
+        s3_client.put_object.side_effect = lambda **kwargs: time.sleep(0.05)
+        logger = PredictionLogger()
+        logger.configure(s3_client, 'bucket', queue_size=3, batch_size=1)
+        for _ in range(10):
+            logger.log('/predict', 'job-1', RESULT, 12.0)
+        logger.close()
+
+        stats = logger.stats()
+        self.assertGreater(stats['dropped'], 0)
+        self.assertEqual(stats['records'], stats['queued'])
+        self.assertEqual(stats['pending'], 0)
+
+        # nothing is queued once closing
+        logger.log('/predict', 'job-1', RESULT, 12.0)
+        self.assertEqual(logger.stats()['dropped'], stats['dropped'] + 1)
+
+    def test_close_counts_what_it_could_not_write(self):
+        s3_client = MagicMock()
+        s3_client.put_object.side_effect = lambda **kwargs: time.sleep(0.3)
+        logger = PredictionLogger()
+        logger.configure(s3_client, 'bucket', queue_size=5, batch_size=1)
+        for _ in range(5):
+            logger.log('/predict', 'job-1', RESULT, 12.0)
+        logger.close(timeout=0.1)
+        stats = logger.stats()
+        self.assertEqual(stats['pending'], 0)
+        self.assertGreater(stats['dropped'], 0)
+
+    def test_batch_and_ensemble_records(self):
+        batch = {'results': [{'prediction': 'dog', 'probability': 0.9, 'file': 'a.wav'}],
+                 'prediction_data': {'predictions': [[0.9, 0.1]]}}
+        records = prediction_records(('/predict-batch', 'job-1', batch, 5.0, False, 'now'))
+        self.assertEqual(records[0]['file'], 'a.wav')
+        ensemble = {'models': [{'status': 'success', 'job_id': 'job-2', 'prediction': 'cat',
+                                'probability': 0.7, 'predictions': [0.3, 0.7]},
+                               {'status': 'fail', 'job_id': 'job-3', 'message': 'down'}]}
+        records = prediction_records(('/predict-ensemble', None, ensemble, 5.0, False, 'now'))
+        self.assertEqual([record['job_id'] for record in records], ['job-2'])
+
+    def test_window_records(self):
+        windows = {'timeline': [{'prediction': 'dog', 'probability': 0.9, 'probabilities': [0.9, 0.1],
+                                 'start': 0.0, 'end': 1.0},
+                                {'prediction': 'cat', 'probability': 0.6, 'probabilities': [0.4, 0.6],
+                                 'start': 0.5, 'end': 1.5}]}
+        records = prediction_records(('/predict-windows', 'job-1', windows, 5.0, False, 'now'))
+        self.assertEqual([(record['prediction'], record['start']) for record in records],
+                         [('dog', 0.0), ('cat', 0.5)])
+
+    def test_unrecordable_responses_are_counted(self):
+        s3_client = MagicMock()
+        logger = PredictionLogger()
+        logger.configure(s3_client, 'bucket', batch_size=100)
+        logger.log('/predict-ensemble', None, {'models': [{'status': 'success'}]}, 5.0)
+        logger.log('/predict', 'job-1', RESULT, 12.0)
+        logger.close()
+        self.assertEqual(logger.stats()['failed_records'], 1)
+        self.assertEqual(len(written_records(s3_client)), 1)
+
+    def test_sigterm_flushes_and_calls_previous_handler(self):
+        original = signal.getsignal(signal.SIGTERM)
+        calls = []
+        signal.signal(signal.SIGTERM, lambda signum, frame: calls.append(signum))
+        try:
+            s3_client = MagicMock()
+            logger = PredictionLogger()
+            logger.configure(s3_client, 'bucket', batch_size=100, flush_seconds=60)
+            logger.log('/predict', 'job-1', RESULT, 12.0)
+            signal.getsignal(signal.SIGTERM)(signal.SIGTERM, None)
+            self.assertEqual(s3_client.put_object.call_count, 1)
+            self.assertEqual(calls, [signal.SIGTERM])
+        finally:
+            signal.signal(signal.SIGTERM, original)
+
+
+if __name__ == '__main__':
+    unittest.main()
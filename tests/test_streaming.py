@@ -0,0 +1,38 @@
+import unittest
+import numpy as np
+from app.services.audio_features import MelFeatureExtractor
+from app.services.streaming import StreamingFeatures
+
+
+def make_pcm(duration=3.0, sr=22050):
+    t = np.arange(int(duration * sr)) / sr
+    audio = 0.3 * np.sin(2 * np.pi * 440 * t) + 0.05 * np.random.default_rng(0).standard_normal(len(t))
+    return (audio * 32767).astype('<i2')
+
+
+class TestStreamingFeatures(unittest.TestCase):
+
+    def test_windows_follow_the_hop(self):
+        stream = StreamingFeatures(22050, window_seconds=1.0, hop_seconds=0.5)
+        pcm = make_pcm().tobytes()
+        windows = []
+        # odd chunk sizes split samples across messages
+        for i in range(0, len(pcm), 4097):
+            windows.extend(stream.feed(pcm[i:i + 4097]))
+        self.assertEqual(len(windows), 4)
+        starts = [start for start, _, _ in windows]
+        np.testing.assert_allclose(np.diff(starts), 22 * 512 / 22050)
+        self.assertEqual(windows[0][2].shape, (128,))
+
+    def test_features_match_the_clip_extractor(self):
+        extractor = MelFeatureExtractor()
+        stream = StreamingFeatures(22050, window_seconds=1.0, hop_seconds=1.0, extractor=extractor)
+        pcm = make_pcm()
+        start, end, features = stream.feed(pcm.tobytes())[0]
+        audio = pcm.astype(np.float32) / 32768
+        expected = extractor.extract(audio[int(round(start * 22050)):int(round(end * 22050))], 22050)
+        np.testing.assert_allclose(features, expected, rtol=0.05, atol=1e-3 * expected.max())
+
+
+if __name__ == '__main__':
+    unittest.main()
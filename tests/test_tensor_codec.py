@@ -0,0 +1,41 @@
+import unittest
+import json
+import numpy as np
+from app.services.tensor_codec import encode_tensor, decode_predictions, decode_npy, as_feature_batch, NPY_CONTENT_TYPE
+
+
+class TestTensorCodec(unittest.TestCase):
+
+    def test_npy_round_trip(self):
+        features = np.random.rand(4, 16, 8, 1).astype(np.float32)
+        body = encode_tensor(features, NPY_CONTENT_TYPE)
+        self.assertIsInstance(body, bytes)
+        np.testing.assert_array_equal(decode_npy(body), features)
+
+    def test_npy_decode_does_not_copy(self):
+        body = encode_tensor(np.ones((2, 3), dtype=np.float32), NPY_CONTENT_TYPE)
+        predictions = decode_predictions(body, 'application/x-npy')
+        self.assertFalse(predictions.flags.owndata)
+        self.assertEqual(predictions.shape, (2, 3))
+
+    def test_json_fallback(self):
+        body = json.dumps({'predictions': [[0.1, 0.9]]}).encode()
+        predictions = decode_predictions(body, 'application/json; charset=utf-8')
+        np.testing.assert_array_equal(predictions, [[0.1, 0.9]])
+        self.assertEqual(json.loads(encode_tensor(np.zeros((1, 2)))), [[0.0, 0.0]])
+
+
+    def test_feature_batch_shapes(self):
+        for shape, single in [((128,), True), ((16, 8, 1), True), ((3, 128), False), ((3, 16, 8, 1), False)]:
+            batch, is_single = as_feature_batch(np.ones(shape))
+            self.assertEqual(batch.shape[1:], (16, 8, 1))
+            self.assertEqual(batch.dtype, np.float32)
+            self.assertEqual(is_single, single)
+
+    def test_feature_batch_rejects_bad_input(self):
+        for features in [np.ones(127), np.ones((2, 64)), np.zeros((0, 128)), [[1.0] * 128, [1.0]], ['a'] * 128, [float('nan')] * 128]:
+            with self.assertRaises(ValueError):
+                as_feature_batch(features)
+
+if __name__ == '__main__':
+    unittest.main()
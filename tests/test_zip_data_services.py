@@ -3,6 +3,22 @@ from unittest.mock import MagicMock
 from flask import Flask, request
 from app.services.zip_data_services import DataService
 import io
+import json
+import time
+import zipfile
+import numpy as np
+import soundfile as sf
+from botocore.exceptions import ClientError
+from app.services.hash_index import class_lock
+from app.services.ingest_jobs import ingest_jobs
+
+NO_SUCH_KEY = ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+
+
+def wav(seed):
+    buffer = io.BytesIO()
+    sf.write(buffer, np.full(160, seed / 200, dtype=np.float32), 16000, format='WAV')
+    return buffer.getvalue()
 
 
 class TestDataService(unittest.TestCase):
@@ -55,6 +71,210 @@ class TestDataService(unittest.TestCase):
             self.assertIn('There are no file key in the request body',
                           response.get_json()['message'])
 
+    def test_upload_zip_fast_success(self):
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w') as z:
+            z.writestr('sounds/', b'')
+            z.writestr('sounds/a.wav', wav(1))
+            z.writestr('sounds/b.wav', wav(2))
+        buffer.seek(0)
+
+        self.mock_s3_client.reset_mock()
+        self.mock_s3_client.list_objects_v2.side_effect = None
+        self.mock_s3_client.get_object.side_effect = NO_SUCH_KEY
+        self.mock_s3_client.list_objects_v2.return_value = {'Contents': [
+            {'Key': 'zip_data/test_class/a.wav'}, {'Key': 'zip_data/test_class/b.wav'}]}
+        with self.app.test_request_context('/upload-zip-fast', method='POST', data={
+                'class_name': 'test_class', 'file': (buffer, 'sounds.zip')}):
+            response, status_code = self.data_service.upload_zip_fast(request)
+            self.assertEqual(status_code, 201)
+            self.assertEqual(response.get_json()['uploaded_count'], 2)
+            self.assertEqual(response.get_json()['failed_count'], 0)
+            self.assertEqual(response.get_json()['total_count'], 2)
+            keys = sorted(call.args[2] for call in self.mock_s3_client.upload_fileobj.call_args_list)
+            self.assertEqual(keys, ['zip_data/test_class/a.wav', 'zip_data/test_class/b.wav'])
+
+    def test_upload_zip_fast_in_background(self):
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w') as z:
+            z.writestr('sounds/', b'')
+            for i in range(3):
+                z.writestr(f'sounds/{i}.wav', wav(i))
+        buffer.seek(0)
+
+        s3_client = MagicMock()
+        s3_client.get_object.side_effect = NO_SUCH_KEY
+        s3_client.list_objects_v2.return_value = {'Contents': [{'Key': f'zip_data/dog/{i}.wav'} for i in range(3)]}
+        data_service = DataService(s3_client, self.bucket_name)
+        ingest_jobs.configure(min_members=3)
+        try:
+            with self.app.test_request_context('/upload-zip-fast', method='POST', data={
+                    'class_name': 'dog', 'file': (buffer, 'sounds.zip')}):
+                response, status_code = data_service.upload_zip_fast(request)
+                self.assertEqual(status_code, 202)
+                job_id = response.get_json()['job_id']
+        finally:
+            ingest_jobs.configure()
+
+        # the request closed its files, the job still reads the archive
+        job = ingest_jobs.get(job_id)
+        deadline = time.monotonic() + 5
+        while not job.done and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        with self.app.app_context():
+            response, status_code = data_service.get_ingest_job(job_id)
+            self.assertEqual(status_code, 200)
+            self.assertEqual(response.get_json()['job']['state'], 'succeeded')
+            self.assertEqual(response.get_json()['job']['uploaded_count'], 3)
+            self.assertEqual(response.get_json()['job']['total_count'], 3)
+
+            response, status_code = data_service.get_ingest_job('missing')
+            self.assertEqual(status_code, 404)
+
+    def test_start_direct_upload(self):
+        s3_client = MagicMock()
+        s3_client.create_multipart_upload.return_value = {'UploadId': 'upload-1'}
+        s3_client.generate_presigned_url.side_effect = lambda method, Params, ExpiresIn: \
+            f"https://s3/{Params['Key']}?partNumber={Params['PartNumber']}"
+        data_service = DataService(s3_client, self.bucket_name, part_size=5 * 1024 * 1024)
+
+        with self.app.test_request_context('/direct-upload/start', method='POST', json={
+                'class_name': 'dog', 'size': 12 * 1024 * 1024}):
+            response, status_code = data_service.start_direct_upload(request)
+            self.assertEqual(status_code, 201)
+            body = response.get_json()
+            self.assertEqual(body['upload_id'], 'upload-1')
+            self.assertTrue(body['key'].startswith('zip_staging/'))
+            self.assertEqual([part['part_number'] for part in body['parts']], [1, 2, 3])
+            self.assertEqual(
+                s3_client.create_multipart_upload.call_args.kwargs['Metadata'], {'class_name': 'dog'})
+
+    def staged_s3_client(self, data):
+        s3_client = MagicMock()
+        s3_client.list_parts.return_value = {
+            'Parts': [{'PartNumber': 1, 'Size': len(data), 'ETag': '"etag"'}], 'IsTruncated': False}
+        s3_client.head_object.return_value = {'ContentLength': len(data), 'Metadata': {'class_name': 'dog'}}
+
+        def get_object(Bucket, Key, Range=None):
+            if Range is None:
+                raise NO_SUCH_KEY  # the class hash index
+            start, end = map(int, Range[len('bytes='):].split('-'))
+            return {'Body': io.BytesIO(data[start:end + 1])}
+
+        s3_client.get_object.side_effect = get_object
+        s3_client.list_objects_v2.return_value = {'Contents': [
+            {'Key': 'zip_data/dog/a.wav'}, {'Key': 'zip_data/dog/b.wav'}]}
+        return s3_client
+
+    def test_finalize_direct_upload(self):
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w') as z:
+            z.writestr('sounds/', b'')
+            z.writestr('sounds/a.wav', wav(1))
+            z.writestr('sounds/b.wav', wav(2))
+        data = buffer.getvalue()
+        s3_client = self.staged_s3_client(data)
+        data_service = DataService(s3_client, self.bucket_name)
+
+        key = 'zip_staging/abc/sounds.zip'
+        with self.app.test_request_context('/direct-upload/finalize', method='POST', json={
+                'key': key, 'upload_id': 'upload-1', 'part_count': 1, 'size': len(data)}):
+            response, status_code = data_service.finalize_direct_upload(request)
+            self.assertEqual(status_code, 201)
+            self.assertEqual(response.get_json()['uploaded_count'], 2)
+            s3_client.complete_multipart_upload.assert_called_once_with(
+                Bucket=self.bucket_name, Key=key, UploadId='upload-1',
+                MultipartUpload={'Parts': [{'PartNumber': 1, 'ETag': '"etag"'}]})
+            keys = sorted(call.args[2] for call in s3_client.upload_fileobj.call_args_list)
+            self.assertEqual(keys, ['zip_data/dog/a.wav', 'zip_data/dog/b.wav'])
+            s3_client.delete_object.assert_called_once_with(Bucket=self.bucket_name, Key=key)
+
+    def test_finalize_direct_upload_reports_missing_parts(self):
+        s3_client = self.staged_s3_client(b'')
+        s3_client.list_parts.return_value = {'Parts': [
+            {'PartNumber': 1, 'Size': 5, 'ETag': '"1"'}, {'PartNumber': 3, 'Size': 5, 'ETag': '"3"'}], 'IsTruncated': False}
+        s3_client.generate_presigned_url.return_value = 'https://upload'
+        data_service = DataService(s3_client, self.bucket_name)
+        with self.app.test_request_context('/direct-upload/finalize', method='POST', json={
+                'key': 'zip_staging/abc/sounds.zip', 'upload_id': 'upload-1', 'part_count': 4, 'size': 20}):
+            response, status_code = data_service.finalize_direct_upload(request)
+            self.assertEqual(status_code, 409)
+            self.assertEqual(response.get_json()['missing_parts'], [2, 4])
+            self.assertEqual([part['part_number'] for part in response.get_json()['parts']], [2, 4])
+
+        # every part is there but they do not add up to the archive
+        s3_client.list_parts.return_value = {'Parts': [
+            {'PartNumber': n, 'Size': 4, 'ETag': f'"{n}"'} for n in range(1, 5)], 'IsTruncated': False}
+        with self.app.test_request_context('/direct-upload/finalize', method='POST', json={
+                'key': 'zip_staging/abc/sounds.zip', 'upload_id': 'upload-1', 'part_count': 4, 'size': 20}):
+            response, status_code = data_service.finalize_direct_upload(request)
+            self.assertEqual(status_code, 400)
+
+        with self.app.test_request_context('/direct-upload/finalize', method='POST', json={
+                'key': 'zip_staging/abc/sounds.zip', 'upload_id': 'upload-1'}):
+            response, status_code = data_service.finalize_direct_upload(request)
+            self.assertEqual(status_code, 400)
+        s3_client.complete_multipart_upload.assert_not_called()
+
+    def test_finalize_direct_upload_keeps_the_archive_when_the_ingest_fails(self):
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w') as z:
+            z.writestr('sounds/', b'')
+            z.writestr('sounds/a.wav', wav(1))
+        data = buffer.getvalue()
+        s3_client = self.staged_s3_client(data)
+        s3_client.upload_fileobj.side_effect = Exception('Access Denied')
+        data_service = DataService(s3_client, self.bucket_name)
+        with self.app.test_request_context('/direct-upload/finalize', method='POST', json={
+                'key': 'zip_staging/abc/sounds.zip', 'upload_id': 'upload-1', 'part_count': 1, 'size': len(data)}):
+            response, status_code = data_service.finalize_direct_upload(request)
+            self.assertEqual(response.get_json()['failed_count'], 1)
+        s3_client.delete_object.assert_not_called()
+
+        # not a zip file, kept for the client to abort
+        s3_client = self.staged_s3_client(b'not a zip file')
+        data_service = DataService(s3_client, self.bucket_name)
+        with self.app.test_request_context('/direct-upload/finalize', method='POST', json={
+                'key': 'zip_staging/abc/sounds.zip', 'upload_id': 'upload-1', 'part_count': 1, 'size': 14}):
+            response, status_code = data_service.finalize_direct_upload(request)
+            self.assertEqual(status_code, 400)
+        s3_client.delete_object.assert_not_called()
+
+        s3_client.abort_multipart_upload.side_effect = ClientError({'Error': {'Code': 'NoSuchUpload'}}, 'AbortMultipartUpload')
+        with self.app.test_request_context('/direct-upload/abort', method='DELETE', json={
+                'key': 'zip_staging/abc/sounds.zip', 'upload_id': 'upload-1'}):
+            response, status_code = data_service.abort_direct_upload(request)
+            self.assertEqual(status_code, 200)
+        s3_client.delete_object.assert_called_once_with(Bucket=self.bucket_name, Key='zip_staging/abc/sounds.zip')
+
+    def test_direct_upload_class_name_is_validated(self):
+        s3_client = MagicMock()
+        data_service = DataService(s3_client, self.bucket_name)
+        with self.app.test_request_context('/direct-upload/start', method='POST', json={
+                'class_name': '../other', 'size': 1024}):
+            response, status_code = data_service.start_direct_upload(request)
+            self.assertEqual(status_code, 400)
+        s3_client.create_multipart_upload.assert_not_called()
+
+        # a staged archive whose metadata names another prefix is not ingested
+        data = b'PK' + b'\x00' * 64
+        s3_client = self.staged_s3_client(data)
+        s3_client.head_object.return_value = {'ContentLength': len(data), 'Metadata': {'class_name': 'dog/../cat'}}
+        data_service = DataService(s3_client, self.bucket_name)
+        with self.app.test_request_context('/direct-upload/finalize', method='POST', json={
+                'key': 'zip_staging/abc/sounds.zip', 'upload_id': 'upload-1', 'part_count': 1, 'size': len(data)}):
+            response, status_code = data_service.finalize_direct_upload(request)
+            self.assertEqual(status_code, 400)
+            self.assertIn('Invalid class name', response.get_json()['message'])
+        s3_client.upload_fileobj.assert_not_called()
+
+    def test_finalize_direct_upload_rejects_other_keys(self):
+        with self.app.test_request_context('/direct-upload/finalize', method='POST', json={
+                'key': 'zip_data/dog/a.wav', 'upload_id': 'upload-1'}):
+            response, status_code = self.data_service.finalize_direct_upload(request)
+            self.assertEqual(status_code, 400)
+
     # def test_upload_zip_fast_invalid_zip_file(self):
     #     with self.app.test_request_context('/upload-zip-fast', method='POST', data={'class_name': 'test_class', 'file': (io.BytesIO(b'some data'), 'sounds.zip')}):
     #         request.files = {'file': (io.BytesIO(b'some data'), 'invalid.zip')}
@@ -102,6 +322,21 @@ class TestDataService(unittest.TestCase):
             self.assertIn('class name is required',
                           response.get_json()['message'])
 
+    def test_get_all_audios_with_metadata(self):
+        s3_client = MagicMock()
+        s3_client.list_objects_v2.return_value = {'Contents': [
+            {'Key': 'zip_data/dog/a.wav', 'LastModified': '2024-01-01T12:00:00Z', 'Size': 12345}]}
+        s3_client.generate_presigned_url.return_value = 'https://s3/a.wav'
+        s3_client.head_object.return_value = {'Metadata': {'sample-rate': '16000', 'channels': '1'}}
+        data_service = DataService(s3_client, self.bucket_name)
+        with self.app.test_request_context('/get-all-audios', method='POST', json={
+                'class_name': 'dog', 'include_metadata': True}):
+            response, status_code = data_service.get_all_audios(request)
+            self.assertEqual(status_code, 200)
+            self.assertEqual(response.get_json()['audio_files'][0]['metadata'],
+                             {'sample-rate': '16000', 'channels': '1'})
+            s3_client.head_object.assert_called_once_with(Bucket=self.bucket_name, Key='zip_data/dog/a.wav')
+
     # def test_get_all_audios_success(self):
     #     self.mock_s3_client.list_objects_v2.return_value = {'Contents': [
     #         {'Key': 'zip_data/class1/file.wav', 'LastModified': '2024-01-01T12:00:00Z', 'Size': 12345}]}
@@ -148,6 +383,59 @@ class TestDataService(unittest.TestCase):
             self.assertIn('class name and valid percentage are required',
                           response.get_json()['message'])
 
+    def test_delete_all_class_audios_drops_the_hash_index(self):
+        s3_client = MagicMock()
+        s3_client.list_objects_v2.return_value = {'Contents': [{'Key': 'zip_data/dog/a.wav'}]}
+        data_service = DataService(s3_client, self.bucket_name)
+        with self.app.test_request_context('/delete-all-class-audios', method='DELETE', json={'class_name': 'dog'}):
+            response, status_code = data_service.delete_all_class_audios(request)
+            self.assertEqual(status_code, 200)
+            s3_client.delete_object.assert_called_once_with(
+                Bucket=self.bucket_name, Key='zip_data_index/dog/hashes.json')
+
+    def test_delete_class_being_ingested(self):
+        s3_client = MagicMock()
+        s3_client.list_objects_v2.return_value = {'Contents': [{'Key': 'zip_data/dog/a.wav'}]}
+        data_service = DataService(s3_client, self.bucket_name)
+        with class_lock('dog'):
+            with self.app.test_request_context('/delete-all-audios-from-set-of-classes', method='DELETE', json={
+                    'class_names': ['cat', 'dog']}):
+                response, status_code = data_service.delete_all_audios_from_set_of_classes(request)
+                self.assertEqual(status_code, 409)
+            with self.app.test_request_context('/delete-all-class-audios', method='DELETE', json={'class_name': 'dog'}):
+                response, status_code = data_service.delete_all_class_audios(request)
+                self.assertEqual(status_code, 409)
+        # no class of the request is touched, the other one's lock is released again
+        s3_client.delete_objects.assert_not_called()
+        self.assertFalse(class_lock('cat').locked())
+
+    def test_delete_set_of_classes_with_a_repeated_class(self):
+        s3_client = MagicMock()
+        s3_client.list_objects_v2.return_value = {'Contents': [{'Key': 'zip_data/dog/a.wav'}]}
+        data_service = DataService(s3_client, self.bucket_name)
+        with self.app.test_request_context('/delete-all-audios-from-set-of-classes', method='DELETE', json={
+                'class_names': ['dog', 'dog']}):
+            response, status_code = data_service.delete_all_audios_from_set_of_classes(request)
+            self.assertEqual(status_code, 200)
+            self.assertEqual(response.get_json()['deleted_classes'], ['dog'])
+
+    def test_delete_percentage_audios_updates_the_hash_index(self):
+        s3_client = MagicMock()
+        s3_client.list_objects_v2.return_value = {'Contents': [
+            {'Key': 'zip_data/dog/a.wav'}, {'Key': 'zip_data/dog/b.wav'}]}
+        s3_client.get_object.return_value = {'Body': io.BytesIO(json.dumps({'version': 1, 'hashes': {
+            'h1': 'zip_data/dog/a.wav', 'h2': 'zip_data/dog/b.wav'}}).encode())}
+        data_service = DataService(s3_client, self.bucket_name)
+        with self.app.test_request_context('/delete-percentage-audios', method='DELETE', json={
+                'class_name': 'dog', 'percentage': 50}):
+            response, status_code = data_service.delete_percentage_audios(request)
+            self.assertEqual(status_code, 200)
+
+        deleted = s3_client.delete_objects.call_args.kwargs['Delete']['Objects'][0]['Key']
+        saved = json.loads(s3_client.put_object.call_args.kwargs['Body'])['hashes']
+        self.assertEqual(len(saved), 1)
+        self.assertNotIn(deleted, saved.values())
+
     def test_delete_percentage_audios_invalid_percentage(self):
         with self.app.test_request_context('/delete-percentage-audios', method='DELETE', json={'class_name': 'class1', 'percentage': 'invalid'}):
             response, status_code = self.data_service.delete_percentage_audios(
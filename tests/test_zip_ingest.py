@@ -0,0 +1,484 @@
+import io
+import tempfile
+import unittest
+import zipfile
+from unittest.mock import MagicMock, patch
+import hashlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import soundfile as sf
+from botocore.exceptions import ClientError
+from app.services.hash_index import ClassHashIndex, class_lock
+from app.services.ingest_jobs import IngestJob
+from app.services.zip_ingest import (ZipIngester, ConcurrencyLimit, audio_members, member_key, spool,
+                                     archive_error, open_s3_object, part_size_for, uploaded_parts,
+                                     is_staging_key, staging_key, MIN_PART_SIZE)
+
+
+def wav(seed, sample_rate=16000, frames=160, subtype='PCM_16', file_format='WAV'):
+    # a short, distinct clip per seed
+    buffer = io.BytesIO()
+    audio = np.full(frames, (seed % 100) / 200, dtype=np.float32)
+    sf.write(buffer, audio, sample_rate, format=file_format, subtype=subtype)
+    return buffer.getvalue()
+
+
+def make_zip(files, folder='sounds'):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as z:
+        z.writestr(f'{folder}/', b'')
+        for name, data in files.items():
+            z.writestr(f'{folder}/{name}', data)
+    return buffer.getvalue()
+
+
+def recording_s3_client(fail=()):
+    # Keeps what is uploaded and put, the class hash index starts out missing. s3_client.stored
+    # is every key head_object finds.
+    uploads = {}
+    objects = {}
+    s3_client = MagicMock()
+    s3_client.stored = set()
+
+    def upload_fileobj(fileobj, bucket_name, key, ExtraArgs=None, Config=None):
+        if key.split('/')[-1] in fail:
+            raise Exception('SlowDown')
+        uploads[key] = fileobj.read()
+        s3_client.stored.add(key)
+
+    def head_object(Bucket, Key):
+        if Key not in s3_client.stored:
+            raise ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+        return {}
+
+    def put_object(Bucket, Key, Body, **kwargs):
+        objects[Key] = Body
+
+    def get_object(Bucket, Key):
+        if Key not in objects:
+            raise ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+        return {'Body': io.BytesIO(objects[Key])}
+
+    s3_client.upload_fileobj.side_effect = upload_fileobj
+    s3_client.put_object.side_effect = put_object
+    s3_client.get_object.side_effect = get_object
+    s3_client.head_object.side_effect = head_object
+    return s3_client, uploads
+
+
+def object_s3_client(data, metadata=None):
+    # head_object and ranged get_object of one S3 object holding data
+    s3_client = MagicMock()
+    s3_client.head_object.return_value = {'ContentLength': len(data), 'Metadata': metadata or {}}
+
+    def get_object(Bucket, Key, Range):
+        start, end = map(int, Range[len('bytes='):].split('-'))
+        return {'Body': io.BytesIO(data[start:end + 1])}
+
+    s3_client.get_object.side_effect = get_object
+    return s3_client
+
+
+class TestZipIngester(unittest.TestCase):
+
+    def test_members_are_uploaded_once(self):
+        files = {f'{i}.wav': wav(i) for i in range(40)}
+        s3_client, uploads = recording_s3_client()
+        ingester = ZipIngester(workers=4, queue_size=2)
+
+        with zipfile.ZipFile(io.BytesIO(make_zip(files))) as z:
+            result = ingester.ingest(s3_client, 'bucket', 'dog', z, audio_members(z)).snapshot()
+
+        self.assertEqual(result['uploaded_count'], 40)
+        self.assertEqual(result['failed_files'], [])
+        self.assertEqual(result['bytes'], sum(len(data) for data in files.values()))
+        self.assertEqual(s3_client.upload_fileobj.call_count, 40)
+        self.assertEqual(uploads, {member_key('dog', f'sounds/{name}'): data
+                                   for name, data in files.items()})
+
+    def test_concurrent_ingests_share_the_upload_limit(self):
+        s3_client, uploads = recording_s3_client()
+        lock = threading.Lock()
+        in_flight = {'now': 0, 'peak': 0}
+        record = s3_client.upload_fileobj.side_effect
+
+        def upload_fileobj(*args, **kwargs):
+            with lock:
+                in_flight['now'] += 1
+                in_flight['peak'] = max(in_flight['peak'], in_flight['now'])
+            time.sleep(0.01)
+            try:
+                record(*args, **kwargs)
+            finally:
+                with lock:
+                    in_flight['now'] -= 1
+
+        s3_client.upload_fileobj.side_effect = upload_fileobj
+        ingester = ZipIngester(workers=3, queue_size=2, deduplicate=False)
+        archives = {class_name: make_zip({f'{i}.wav': wav(i) for i in range(12)})
+                    for class_name in ('dog', 'cat')}
+
+        def ingest(class_name):
+            with zipfile.ZipFile(io.BytesIO(archives[class_name])) as z:
+                return ingester.ingest(s3_client, 'bucket', class_name, z, audio_members(z)).snapshot()
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            results = list(executor.map(ingest, archives))
+
+        self.assertEqual([result['uploaded_count'] for result in results], [12, 12])
+        self.assertEqual(len(uploads), 24)
+        self.assertLessEqual(in_flight['peak'], 3)
+
+    def test_failed_workers_do_not_hang_the_ingest(self):
+        s3_client, _ = recording_s3_client()
+        ingester = ZipIngester(workers=2, queue_size=1)
+        outcome = []
+
+        def ingest():
+            with zipfile.ZipFile(io.BytesIO(make_zip({f'{i}.wav': wav(i) for i in range(20)}))) as z:
+                try:
+                    ingester.ingest(s3_client, 'bucket', 'dog', z, audio_members(z))
+                except RuntimeError as e:
+                    outcome.append(e)
+
+        with patch.object(ZipIngester, 'probe_error', side_effect=RuntimeError('worker bug')):
+            thread = threading.Thread(target=ingest, daemon=True)
+            thread.start()
+            thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(str(outcome[0]), 'worker bug')
+        # the class lock is released again
+        self.assertFalse(class_lock('dog').locked())
+
+    def test_failed_uploads_are_reported(self):
+        files = {f'{i}.wav': wav(i) for i in range(5)}
+        s3_client, uploads = recording_s3_client(fail={'3.wav'})
+
+        with zipfile.ZipFile(io.BytesIO(make_zip(files))) as z:
+            result = ZipIngester(workers=2).ingest(
+                s3_client, 'bucket', 'dog', z, audio_members(z)).snapshot()
+
+        self.assertEqual(result['uploaded_count'], 4)
+        self.assertEqual(result['failed_files'], [{'file': 'sounds/3.wav', 'error': 'SlowDown'}])
+        self.assertNotIn('zip_data/dog/3.wav', uploads)
+
+    def test_duplicates_are_skipped(self):
+        s3_client, uploads = recording_s3_client()
+        ingester = ZipIngester(workers=3)
+        a, b, c = wav(1), wav(2), wav(3)
+        first = {'a.wav': a, 'b.wav': b, 'copy-of-a.wav': a}
+        with zipfile.ZipFile(io.BytesIO(make_zip(first))) as z:
+            result = ingester.ingest(s3_client, 'bucket', 'dog', z, audio_members(z)).snapshot()
+
+        self.assertEqual(result['uploaded_count'], 2)
+        self.assertEqual(result['deduplicated_count'], 1)
+        self.assertEqual(sorted(uploads.values()), sorted([a, b]))
+        digest = s3_client.upload_fileobj.call_args.kwargs['ExtraArgs']['Metadata']['sha256']
+        self.assertEqual(len(digest), 64)
+
+        # a second, overlapping archive only uploads what is new
+        uploads.clear()
+        second = {'a2.wav': a, 'c.wav': c}
+        with zipfile.ZipFile(io.BytesIO(make_zip(second))) as z:
+            result = ingester.ingest(s3_client, 'bucket', 'dog', z, audio_members(z)).snapshot()
+        self.assertEqual(result['uploaded_count'], 1)
+        self.assertEqual(result['deduplicated_count'], 1)
+        self.assertEqual(uploads, {'zip_data/dog/c.wav': c})
+
+        # whichever copy of a was claimed first is the one stored
+        index = ClassHashIndex.load(s3_client, 'bucket', 'dog')
+        self.assertEqual(len(index), 3)
+        self.assertEqual(index.hashes[hashlib.sha256(c).hexdigest()], 'zip_data/dog/c.wav')
+        self.assertIn(index.hashes[hashlib.sha256(a).hexdigest()],
+                      ['zip_data/dog/a.wav', 'zip_data/dog/copy-of-a.wav'])
+
+    def test_duplicate_of_a_failed_upload_is_uploaded(self):
+        s3_client, uploads = recording_s3_client()
+        record = s3_client.upload_fileobj.side_effect
+        calls = []
+
+        def fail_first(*args, **kwargs):
+            calls.append(None)
+            if len(calls) == 1:
+                # the other copy is claimed meanwhile
+                time.sleep(0.1)
+                raise Exception('InternalError')
+            record(*args, **kwargs)
+
+        s3_client.upload_fileobj.side_effect = fail_first
+        a = wav(1)
+        with zipfile.ZipFile(io.BytesIO(make_zip({'a.wav': a, 'copy-of-a.wav': a}))) as z:
+            result = ZipIngester(workers=2, retries=0).ingest(
+                s3_client, 'bucket', 'dog', z, audio_members(z)).snapshot()
+
+        self.assertEqual(result['uploaded_count'], 1)
+        self.assertEqual(result['deduplicated_count'], 0)
+        self.assertEqual(len(result['failed_files']), 1)
+        self.assertEqual(list(uploads.values()), [a])
+
+    def test_ingests_without_deduplication_keep_the_index(self):
+        s3_client, uploads = recording_s3_client()
+        a = wav(1)
+        with zipfile.ZipFile(io.BytesIO(make_zip({'a.wav': a, 'copy-of-a.wav': a}))) as z:
+            result = ZipIngester(workers=1, deduplicate=False).ingest(
+                s3_client, 'bucket', 'dog', z, audio_members(z)).snapshot()
+        self.assertEqual(result['uploaded_count'], 2)
+        self.assertEqual(ClassHashIndex.load(s3_client, 'bucket', 'dog').keys,
+                         {'zip_data/dog/copy-of-a.wav': hashlib.sha256(a).hexdigest()})
+
+        uploads.clear()
+        with zipfile.ZipFile(io.BytesIO(make_zip({'a-again.wav': a}))) as z:
+            result = ZipIngester(workers=1).ingest(
+                s3_client, 'bucket', 'dog', z, audio_members(z)).snapshot()
+        self.assertEqual(result['deduplicated_count'], 1)
+        self.assertEqual(uploads, {})
+
+    def test_objects_deleted_behind_the_index_are_uploaded_again(self):
+        s3_client, uploads = recording_s3_client()
+        a = wav(1)
+        with zipfile.ZipFile(io.BytesIO(make_zip({'a.wav': a}))) as z:
+            ZipIngester(workers=1).ingest(s3_client, 'bucket', 'dog', z, audio_members(z))
+
+        # removed without updating the index
+        s3_client.stored.discard('zip_data/dog/a.wav')
+        uploads.clear()
+        with zipfile.ZipFile(io.BytesIO(make_zip({'a-again.wav': a}))) as z:
+            result = ZipIngester(workers=1).ingest(
+                s3_client, 'bucket', 'dog', z, audio_members(z)).snapshot()
+
+        self.assertEqual(result['uploaded_count'], 1)
+        self.assertEqual(result['deduplicated_count'], 0)
+        self.assertEqual(uploads, {'zip_data/dog/a-again.wav': a})
+        self.assertEqual(ClassHashIndex.load(s3_client, 'bucket', 'dog').keys,
+                         {'zip_data/dog/a-again.wav': hashlib.sha256(a).hexdigest()})
+
+    def test_index_save_error_does_not_hide_the_ingest_error(self):
+        s3_client, _ = recording_s3_client()
+
+        def members():
+            raise RuntimeError('archive went away')
+            yield
+
+        with patch.object(ClassHashIndex, 'save', side_effect=Exception('index write failed')) as save:
+            with self.assertRaisesRegex(RuntimeError, 'archive went away'):
+                ZipIngester(workers=1).ingest(s3_client, 'bucket', 'dog', MagicMock(), members(), IngestJob('dog'))
+        save.assert_called_once()
+
+    def test_failed_uploads_are_not_indexed(self):
+        s3_client, uploads = recording_s3_client(fail={'a.wav'})
+        with zipfile.ZipFile(io.BytesIO(make_zip({'a.wav': wav(1), 'b.wav': wav(1)}))) as z:
+            result = ZipIngester(workers=1).ingest(
+                s3_client, 'bucket', 'dog', z, audio_members(z)).snapshot()
+
+        # the copy goes up in place of the member that failed
+        self.assertEqual(result['failed_count'], 1)
+        self.assertEqual(result['uploaded_count'], 1)
+        self.assertEqual(ClassHashIndex.load(s3_client, 'bucket', 'dog').keys, {
+            'zip_data/dog/b.wav': hashlib.sha256(wav(1)).hexdigest()})
+
+    def test_invalid_members_are_quarantined(self):
+        files = {
+            'good.wav': wav(1),
+            'empty.wav': b'',
+            'corrupt.wav': b'RIFF' + bytes(40),
+            'no-frames.wav': wav(2, frames=0),
+            'flac.wav': wav(3, file_format='FLAC'),
+            'odd-rate.wav': wav(4, sample_rate=4000)
+        }
+        s3_client, uploads = recording_s3_client()
+        with zipfile.ZipFile(io.BytesIO(make_zip(files))) as z:
+            result = ZipIngester(workers=3).ingest(
+                s3_client, 'bucket', 'dog', z, audio_members(z)).snapshot()
+
+        self.assertEqual(result['uploaded_count'], 1)
+        self.assertEqual(result['rejected_count'], 5)
+        reasons = {rejected['file'].split('/')[1]: rejected['reason'] for rejected in result['rejected_files']}
+        self.assertTrue(reasons['empty.wav'].startswith('Unreadable WAV header'))
+        self.assertTrue(reasons['corrupt.wav'].startswith('Unreadable WAV header'))
+        self.assertEqual(reasons['no-frames.wav'], 'No audio frames')
+        self.assertEqual(reasons['flac.wav'], 'Not a WAV file: FLAC')
+        self.assertEqual(reasons['odd-rate.wav'], 'Sample rate 4000 Hz is outside 8000-192000 Hz')
+        self.assertEqual(sorted(key for key in uploads if key.startswith('zip_data/')), ['zip_data/dog/good.wav'])
+        self.assertIn('zip_quarantine/dog/flac.wav', uploads)
+
+        # the probed header travels with the object
+        metadata = {call.args[2]: call.kwargs['ExtraArgs']['Metadata']
+                    for call in s3_client.upload_fileobj.call_args_list}
+        self.assertEqual(metadata['zip_data/dog/good.wav']['sample-rate'], '16000')
+        self.assertEqual(metadata['zip_data/dog/good.wav']['channels'], '1')
+        self.assertEqual(metadata['zip_data/dog/good.wav']['frames'], '160')
+        self.assertEqual(metadata['zip_data/dog/good.wav']['duration-seconds'], '0.010000')
+        self.assertEqual(metadata['zip_quarantine/dog/no-frames.wav'], {'reason': 'No audio frames'})
+
+        # rejected members are not indexed
+        self.assertEqual(len(ClassHashIndex.load(s3_client, 'bucket', 'dog')), 1)
+
+    def test_rejected_members_are_only_reported_without_quarantine(self):
+        s3_client, uploads = recording_s3_client()
+        with zipfile.ZipFile(io.BytesIO(make_zip({'a.wav': b'', 'b.wav': wav(1, sample_rate=4000)}))) as z:
+            result = ZipIngester(quarantine=False, min_sample_rate=0).ingest(
+                s3_client, 'bucket', 'dog', z, audio_members(z)).snapshot()
+
+        self.assertEqual(result['uploaded_count'], 1)
+        self.assertEqual(result['rejected_files'][0]['quarantine_key'], None)
+        self.assertEqual(list(uploads), ['zip_data/dog/b.wav'])
+
+    def test_throttled_uploads_are_retried(self):
+        files = {f'{i}.wav': wav(i) for i in range(6)}
+        s3_client, uploads = recording_s3_client()
+        slow_down = ClientError({'Error': {'Code': 'SlowDown'}}, 'PutObject')
+        upload = s3_client.upload_fileobj.side_effect
+        calls = []
+
+        def throttle_first(*args, **kwargs):
+            calls.append(None)
+            if len(calls) == 1:
+                raise slow_down
+            return upload(*args, **kwargs)
+
+        s3_client.upload_fileobj.side_effect = throttle_first
+
+        ingester = ZipIngester(workers=1, max_workers=4, window_seconds=0)
+        with zipfile.ZipFile(io.BytesIO(make_zip(files))) as z:
+            result = ingester.ingest(s3_client, 'bucket', 'dog', z, audio_members(z)).snapshot()
+
+        self.assertEqual(result['uploaded_count'], 6)
+        self.assertEqual(result['retried_count'], 1)
+        self.assertEqual(result['failed_files'], [])
+        self.assertEqual(result['concurrency']['throttled'], 1)
+        self.assertEqual(len(uploads), 6)
+
+    def test_spool_copies_unseekable_streams(self):
+        data = make_zip({'a.wav': b'RIFF'})
+        stream = MagicMock()
+        stream.seek.side_effect = io.UnsupportedOperation('seek')
+        stream.read.side_effect = io.BytesIO(data).read
+
+        spooled = spool(stream)
+        self.assertEqual(spooled.read(), data)
+        spooled.close()
+
+        seekable = io.BytesIO(data)
+        seekable.read(10)
+        self.assertIs(spool(seekable), seekable)
+        self.assertEqual(seekable.tell(), 0)
+
+    def test_spool_reuses_werkzeug_spooled_upload(self):
+        data = make_zip({'a.wav': b'RIFF'})
+        for max_size in (len(data) * 2, 16):
+            upload = tempfile.SpooledTemporaryFile(max_size=max_size, mode='rb+')
+            upload.write(data)
+            with patch('app.services.zip_ingest.tempfile.TemporaryFile') as temporary_file:
+                spooled = spool(upload)
+            temporary_file.assert_not_called()
+            self.assertIs(spooled, upload._file)
+            with zipfile.ZipFile(spooled) as z:
+                self.assertEqual(z.read('sounds/a.wav'), b'RIFF')
+            upload.close()
+
+
+class TestStagedArchives(unittest.TestCase):
+
+    def test_archive_error(self):
+        with zipfile.ZipFile(io.BytesIO(make_zip({'a.wav': b'RIFF'}))) as z:
+            self.assertIsNone(archive_error(z))
+        with zipfile.ZipFile(io.BytesIO(make_zip({'a.mp3': b'ID3'}))) as z:
+            self.assertEqual(archive_error(z), 'Invalid file type in zip: sounds/a.mp3')
+        with zipfile.ZipFile(io.BytesIO(make_zip({}))) as z:
+            self.assertEqual(archive_error(z), 'No files in the zip file')
+
+    def test_archive_is_extracted_through_ranged_reads(self):
+        files = {f'{i}.wav': bytes([i]) * 50000 for i in range(60)}
+        data = make_zip(files)
+        s3_client = object_s3_client(data)
+
+        with open_s3_object(s3_client, 'bucket', 'zip_staging/x/sounds.zip', buffer_size=1024 * 1024) as archive:
+            with zipfile.ZipFile(archive) as z:
+                extracted = {info.filename.split('/')[1]: z.read(info) for info in audio_members(z)}
+            requests = archive.raw.requests
+
+        self.assertEqual(extracted, files)
+        # members are read in archive order, one GET covers many of them, a few more read the
+        # end of central directory record and the central directory
+        self.assertLessEqual(requests, len(data) // (1024 * 1024) + 4)
+        self.assertLess(requests, len(files) // 5)
+
+    def test_part_size_fits_the_archive_in_10000_parts(self):
+        self.assertEqual(part_size_for(None, 1024), MIN_PART_SIZE)
+        self.assertEqual(part_size_for(10 ** 9, 64 * 1024 * 1024), 64 * 1024 * 1024)
+        self.assertEqual(part_size_for(10 ** 12, 64 * 1024 * 1024), 10 ** 8)
+
+    def test_uploaded_parts_are_paginated(self):
+        s3_client = MagicMock()
+        s3_client.list_parts.side_effect = [
+            {'Parts': [{'PartNumber': 1, 'Size': 5, 'ETag': '"a"'}], 'IsTruncated': True,
+             'NextPartNumberMarker': 1},
+            {'Parts': [{'PartNumber': 3, 'Size': 5, 'ETag': '"c"'}], 'IsTruncated': False}]
+
+        parts = uploaded_parts(s3_client, 'bucket', 'key', 'upload')
+        self.assertEqual([part['part_number'] for part in parts], [1, 3])
+        self.assertEqual(s3_client.list_parts.call_args.kwargs['PartNumberMarker'], 1)
+
+    def test_staging_keys(self):
+        self.assertTrue(is_staging_key(staging_key('abc')))
+        self.assertFalse(is_staging_key('zip_data/dog/a.wav'))
+        self.assertFalse(is_staging_key('zip_staging/../sounds.zip/x'))
+        self.assertFalse(is_staging_key(None))
+
+
+class TestConcurrencyLimit(unittest.TestCase):
+
+    def complete(self, limit, count, seconds):
+        for _ in range(count):
+            limit.acquire()
+            limit.release(completed=True)
+        time.sleep(seconds)
+
+    def test_ramps_up_while_throughput_rises(self):
+        limit = ConcurrencyLimit(4, maximum=16, window_seconds=0.02)
+        self.complete(limit, 1, 0.03)
+        limit.acquire()
+        limit.release(completed=True)
+        self.assertEqual(limit.limit, 6)
+
+        # a faster window keeps ramping, up to the maximum
+        for _ in range(5):
+            self.complete(limit, 50, 0.03)
+            limit.acquire()
+            limit.release(completed=True)
+        self.assertGreater(limit.limit, 6)
+        self.assertLessEqual(limit.limit, 16)
+
+    def test_steps_back_when_an_increase_hurts(self):
+        limit = ConcurrencyLimit(4, maximum=16, window_seconds=0.02)
+        limit._previous = (4, 1000.0)
+        limit.limit = 6
+        self.complete(limit, 1, 0.03)
+        limit.acquire()
+        limit.release(completed=True)
+        self.assertEqual(limit.limit, 4)
+
+    def test_throttling_halves_once_per_window(self):
+        limit = ConcurrencyLimit(4, maximum=16, window_seconds=10)
+        limit.limit = 16
+        for _ in range(3):
+            limit.acquire()
+            limit.release(throttle=True)
+        self.assertEqual(limit.limit, 8)
+        self.assertEqual(limit.stats()['throttled'], 3)
+
+    def test_fixed_without_maximum(self):
+        limit = ConcurrencyLimit(5, window_seconds=0)
+        for _ in range(10):
+            limit.acquire()
+            limit.release(completed=True)
+        limit.acquire()
+        limit.release(throttle=True)
+        self.assertEqual(limit.limit, 5)
+        self.assertFalse(limit.stats()['adaptive'])
+
+
+if __name__ == '__main__':
+    unittest.main()